@@ -5,3 +5,6 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend_deposit.settings")
 app = Celery("backend_deposit")
 app.config_from_object("django.conf:settings", namespace="CELERY")
 app.autodiscover_tasks()
+
+# Замер задержки очередей (сигналы отправки и старта задач)
+import core.queue_func  # noqa: E402,F401
@@ -102,6 +102,25 @@ DATABASES = {
     }
 }
 
+# Общий кэш для web и celery. Без redis_host - локальный кэш процесса.
+if os.getenv('redis_host'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': f"redis://:{os.getenv('REDIS_PASSWORD', '')}@{os.getenv('redis_host')}:"
+                        f"{os.getenv('REDIS_PORT', 6379)}/{os.getenv('DJANGO_REDIS_DB', 2)}",
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+# Кэш общий для всех процессов (web, celery). Локальный кэш у каждого процесса свой:
+# счетчики, блокировки и версии в нем не видны другим процессам.
+CACHE_SHARED = bool(os.getenv('redis_host'))
+
 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -185,6 +204,8 @@ REST_FRAMEWORK = {
 }
 
 
+ORDER_LOG_INDEX_FILE = os.path.join(BASE_DIR, 'logs', 'order_log.sqlite3')
+
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
@@ -257,6 +278,14 @@ LOGGING = {
             'formatter': 'plain_console',
             'level': 'ERROR',
         },
+        "order_log_index": {
+            # Индекс строк лога по birpay_id / merchant_transaction_id / birpay_order_id
+            "class": "core.log_index.OrderLogIndexHandler",
+            'filename': ORDER_LOG_INDEX_FILE,
+            'retention_days': 30,
+            'formatter': 'plain_console',
+            'level': 'DEBUG',
+        },
         "root": {
             "class": "logging.handlers.TimedRotatingFileHandler",
             'filename': 'logs/root.log',
@@ -275,7 +304,7 @@ LOGGING = {
             "propagate": True,
         },
         "deposit": {
-            "handlers": ["console", "deposit", "deposit_info", "errors"],
+            "handlers": ["console", "deposit", "deposit_info", "errors", "order_log_index"],
             "level": "DEBUG",
             "propagate": False,
         },
@@ -386,12 +415,102 @@ CELERYD_LOG_FILE = os.path.join(BASE_DIR, "logs", "celery_work.log")
 CELERYBEAT_LOG_FILE = os.path.join(BASE_DIR, "logs", "celery_beat.log")
 CELERYD_HIJACK_ROOT_LOGGER = False
 CELERY_BROKER_CONNECTION_RETRY_ON_STARTUP = True
+# Очереди по типу задач: медленные загрузки и GPT не задерживают опрос birpay и проверки.
+# Воркеры на каждую группу очередей - celery_entrypoint.sh и docker-compose.yml
+CELERY_TASK_DEFAULT_QUEUE = 'default'
+CELERY_TASK_ROUTES = {
+    # Опрос birpay/UM и проверки - должны выполняться по расписанию даже под нагрузкой
+    'deposit.tasks.refresh_birpay_data': {'queue': 'ingest'},
+    'deposit.tasks.check_cards_activity': {'queue': 'ingest'},
+    'deposit.tasks.check_macros': {'queue': 'ingest'},
+    'deposit.tasks.check_incoming': {'queue': 'ingest'},
+    'deposit.tasks.check_incomings_batch_task': {'queue': 'ingest'},
+    'deposit.tasks.relay_outbox_task': {'queue': 'ingest'},
+    'deposit.tasks.adaptive_poll_tick': {'queue': 'ingest'},
+    'deposit.tasks.match_incomings_task': {'queue': 'ingest'},
+    'deposit.tasks.send_new_transactions_from_um_to_asu_v2': {'queue': 'ingest'},
+    'deposit.tasks.send_new_transactions_from_birpay_to_asu': {'queue': 'ingest'},
+    # Распознавание скринов - нагрузка на CPU
+    'deposit.tasks.process_screen_task': {'queue': 'ocr'},
+    'ocr.tasks.response_parts': {'queue': 'ocr'},
+    # Медленные внешние запросы
+    'deposit.tasks.download_birpay_check_file': {'queue': 'downloads'},
+    'deposit.tasks.send_image_to_gpt_task': {'queue': 'gpt'},
+    # Передача в другие сервисы
+    'deposit.tasks.send_screen_to_payment': {'queue': 'notifications'},
+    'deposit.tasks.send_transaction_action_task': {'queue': 'notifications'},
+    'deposit.tasks.confirm_z_asu_transaction_task': {'queue': 'notifications'},
+    # Отчеты и обслуживание
+    'deposit.tasks.render_chart_task': {'queue': 'maintenance'},
+    'deposit.tasks.refresh_charts_task': {'queue': 'maintenance'},
+    'deposit.tasks.refresh_cards_report_task': {'queue': 'maintenance'},
+    'deposit.tasks.refresh_card_day_volume_task': {'queue': 'maintenance'},
+    'deposit.tasks.reparse_trash_task': {'queue': 'maintenance'},
+    'deposit.tasks.cleanup_outbox_task': {'queue': 'maintenance'},
+}
+# Задержка от постановки задачи до начала выполнения, после которой пишем предупреждение, мс
+QUEUE_LAG_WARNING_MS = 30000
+# Опросы birpay/UM с интервалом по частоте изменений (core/poll_func.py), min/max интервала в секундах.
+# При включении убрать эти задачи из расписания django_celery_beat, иначе опросы будут дублироваться
+ADAPTIVE_POLLING = os.getenv('ADAPTIVE_POLLING', 'False') == 'True'
+ADAPTIVE_POLLERS = {
+    'birpay_refill': {'task': 'deposit.tasks.refresh_birpay_data', 'min': 3, 'max': 30},
+    'um_transactions': {'task': 'deposit.tasks.send_new_transactions_from_um_to_asu_v2', 'min': 3, 'max': 60},
+    'birpay_withdraw': {'task': 'deposit.tasks.send_new_transactions_from_birpay_to_asu', 'min': 5, 'max': 120},
+}
 CELERY_BEAT_SCHEDULE = {
     "check_cards_activity": {
         "task": "deposit.tasks.check_cards_activity",
         "schedule": 60.0,  # Каждую минуту
     },
+    "refresh_charts": {
+        "task": "deposit.tasks.refresh_charts_task",
+        "schedule": 600.0,  # Каждые 10 минут
+    },
+    "refresh_cards_report": {
+        "task": "deposit.tasks.refresh_cards_report_task",
+        "schedule": 300.0,  # Каждые 5 минут
+    },
+    "refresh_card_day_volume": {
+        "task": "deposit.tasks.refresh_card_day_volume_task",
+        "schedule": 3600.0,  # Каждый час
+    },
+    "relay_outbox": {
+        "task": "deposit.tasks.relay_outbox_task",
+        "schedule": 5.0,  # Задачи, не отправленные сразу после коммита
+    },
+    "cleanup_outbox": {
+        "task": "deposit.tasks.cleanup_outbox_task",
+        "schedule": 3600.0,  # Каждый час
+    },
+    "check_incomings_batch": {
+        "task": "deposit.tasks.check_incomings_batch_task",
+        "schedule": 5.0,  # Проверки привязок к birpay пакетом
+    },
+    "adaptive_poll_tick": {
+        "task": "deposit.tasks.adaptive_poll_tick",
+        "schedule": 2.0,  # Постановка опросов, у которых подошло время (ADAPTIVE_POLLING)
+    },
 }
+# Время жизни графиков статистики в кэше (текущий день)
+CHART_CACHE_TIMEOUT = 600
+
+# Распознавание скринов в фоне: screen/ отвечает 202 с id, при переполнении очереди - 429.
+# По умолчанию выключено (screen/ отвечает результатом распознавания), работает только с общим кэшем (CACHE_SHARED)
+SCREEN_OCR_ASYNC = os.getenv('SCREEN_OCR_ASYNC', 'False') == 'True'
+SCREEN_OCR_QUEUE_LIMIT = int(os.getenv('SCREEN_OCR_QUEUE_LIMIT', 50))
+SCREEN_OCR_IN_FLIGHT_TTL = 600
+SCREEN_OCR_RESULT_TTL = 60 * 60
+# Максимум смс в одном запросе sms/batch/
+SMS_BATCH_LIMIT = 1000
+# Через сколько секунд без распознанных скринов макрос устройства считается неактивным
+MACROS_HEARTBEAT_TIMEOUT = 15
+# Через сколько секунд после ручной привязки проверять платеж в birpay
+INCOMING_CHECK_DELAY = 60
+# Насколько свежей должна быть синхронизация BirpayOrder, чтобы проверять по ней без запроса в birpay, сек
+BIRPAY_LOCAL_MAX_AGE = 90
+# Потоков для подбора порогов распознавания (0 - по числу ядер): каждый ждет свой процесс tesseract
+OCR_CALIBRATION_THREADS = int(os.getenv('OCR_CALIBRATION_THREADS', 0)) or os.cpu_count() or 1
 REMOTE_SERVER = os.getenv('REMOTE_SERVER')
 
 BIRPAY_NEW_LOGIN = os.getenv('BIRPAY_NEW_LOGIN')
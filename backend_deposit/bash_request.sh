@@ -1,2 +0,0 @@
-#!/bin/sh
-cat logs/deposit.log | grep 76635004
\ No newline at end of file
@@ -2,6 +2,15 @@
 
 #cp celery.service /etc/systemd/system/
 #systemctl start celery.service
-celery -A backend_deposit worker -l warning -n myworker1  --concurrency=7
+# Очереди, пул и параллельность воркера задаются переменными окружения (см. CELERY_TASK_ROUTES в settings.py).
+# По умолчанию один воркер на все очереди, как раньше.
+# prefork - для CPU и задач с time_limit, threads - для медленных внешних запросов (time_limit в нем не работает).
+CELERY_QUEUES=${CELERY_QUEUES:-default,ingest,ocr,downloads,gpt,notifications,maintenance}
+CELERY_POOL=${CELERY_POOL:-prefork}
+CELERY_CONCURRENCY=${CELERY_CONCURRENCY:-7}
+CELERY_PREFETCH=${CELERY_PREFETCH:-1}
+CELERY_WORKER_NAME=${CELERY_WORKER_NAME:-myworker1}
+celery -A backend_deposit worker -l warning -n "$CELERY_WORKER_NAME" --concurrency="$CELERY_CONCURRENCY" \
+  -Q "$CELERY_QUEUES" -P "$CELERY_POOL" --prefetch-multiplier="$CELERY_PREFETCH" -O fair
 #celery multi start 1 -A backend_deposit worker -l INFO -n myworker1  --concurrency=4 --pidfile=/var/run/celery/%n.pid
-#celery multi restart 1 --pidfile=/var/run/celery/%n.pid
\ No newline at end of file
+#celery multi restart 1 --pidfile=/var/run/celery/%n.pid
@@ -6,3 +6,15 @@ from django.conf import settings
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend_deposit.settings')
 django.setup()
 
+
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def reset_singleton_cache():
+    # Копии SingletonModel в памяти процесса не должны переживать откат БД между тестами
+    from users.models import SingletonModel
+    SingletonModel._loaded.clear()
+    yield
+    SingletonModel._loaded.clear()
@@ -0,0 +1,146 @@
+"""
+Привязка смс (Incoming) к заявке birpay (BirpayOrder) - одно место для ручной привязки в списке смс,
+корректировки смс, подтверждения в панели birpay и автоподтверждения по GPT.
+
+В одной транзакции: блокировка смс, затем одним запросом новой и прежней заявки (всегда в этом
+порядке, чтобы параллельные привязки не взаимоблокировались), проверки, запись обеих сторон
+и истории IncomingChange. Запись после подтверждения в birpay идет в точке сохранения: если она
+упала, подтверждение уже не откатить - возвращается ошибка с confirmed=True.
+"""
+import datetime
+from dataclasses import dataclass
+from typing import Any
+
+import structlog
+from django.apps import apps
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+
+logger = structlog.get_logger('deposit')
+
+
+@dataclass
+class BindResult:
+    ok: bool
+    error: str = ''
+    # Смс и заявка после привязки (заявка None, если birpay_id очищен)
+    incoming: Any = None
+    order: Any = None
+    # Заявка, от которой смс отвязана при смене birpay_id
+    unbound_order: Any = None
+    changed: bool = False
+    confirm_time: datetime.datetime | None = None
+    # confirm выполнен, но привязка не записана
+    confirmed: bool = False
+
+
+def bind_incoming_to_order(incoming_id: int, merchant_transaction_id: str | None, user=None, *,
+                           free_only: bool = False, require_pending: bool = False, check_amount: bool = False,
+                           empty_value: str | None = None, order_fields: dict | None = None, incoming=None,
+                           history: bool = True, confirm=None) -> BindResult:
+    """
+    Привязывает смс к заявке с MerchTxID merchant_transaction_id (пустой - отвязывает, birpay_id = empty_value).
+    free_only - смс должна быть свободна (birpay_id is None), require_pending - заявка в статусе pending,
+    check_amount - сумма смс равна сумме заявки.
+    order_fields - дополнительные поля заявки, записываются вместе с привязкой.
+    incoming - экземпляр смс с другими измененными полями (форма корректировки): сохраняется целиком.
+    history - записать смену birpay_id в IncomingChange (если передан user).
+    confirm - вызывается с заявкой после проверок, под блокировкой и до записи (подтверждение в birpay).
+    Вернула текст ошибки - привязка не выполняется. Запись после confirm упала - ошибка с confirmed=True.
+    confirmed_time заявки ставится только при новой привязке к этой смс.
+    """
+    Incoming = apps.get_model('deposit', 'Incoming')
+    BirpayOrder = apps.get_model('deposit', 'BirpayOrder')
+    IncomingChange = apps.get_model('deposit', 'IncomingChange')
+    new_id = (merchant_transaction_id or '').strip()
+    with transaction.atomic():
+        locked = Incoming.objects.select_for_update().filter(pk=incoming_id).first()
+        if locked is None:
+            return BindResult(False, f'Смс {incoming_id} не найдена')
+        if free_only and locked.birpay_id is not None:
+            return BindResult(False, f'Смс {incoming_id} уже привязана к {locked.birpay_id}', incoming=locked)
+        old_id = (locked.birpay_id or '').strip()
+
+        orders = {}
+        ids = {mtx_id for mtx_id in (old_id, new_id) if mtx_id}
+        if ids:
+            for order in BirpayOrder.objects.select_for_update().filter(
+                    merchant_transaction_id__in=ids).order_by('-created_at'):
+                orders.setdefault(order.merchant_transaction_id, order)
+        order = orders.get(new_id)
+        if new_id:
+            if order is None:
+                return BindResult(False, f'BirpayOrder с MerchTxID "{new_id}" не найден. '
+                                         f'Проверьте правильность номера.', incoming=locked)
+            other_incoming = Incoming.objects.filter(birpay_id=new_id).exclude(pk=incoming_id).values_list(
+                'id', flat=True).first()
+            if other_incoming:
+                return BindResult(False, f'MerchTxID "{new_id}" уже привязан к Incoming ID {other_incoming}. '
+                                         f'Нельзя привязывать один номер к нескольким записям.', incoming=locked)
+            if order.incoming_id and order.incoming_id != locked.pk:
+                return BindResult(False, f'BirpayOrder с MerchTxID "{new_id}" уже привязан к Incoming ID '
+                                         f'{order.incoming_id}. Нельзя привязывать один заказ к нескольким записям.',
+                                  incoming=locked, order=order)
+            if require_pending and order.status != 0:
+                return BindResult(False, f'Заявка {new_id} уже не в статусе pending ({order.status})',
+                                  incoming=locked, order=order)
+            if check_amount and locked.pay != order.amount:
+                return BindResult(False, f'Сумма в смс {locked.pk} {locked.pay} и заказе {order.amount} отличаются. '
+                                         f'Подтверждение и привязка не возможна', incoming=locked, order=order)
+            if confirm is not None:
+                error = confirm(order)
+                if error:
+                    return BindResult(False, error, incoming=locked, order=order)
+
+        target = incoming if incoming is not None else locked
+        new_value = new_id or empty_value
+        changed = locked.birpay_id != new_value
+        confirm_time = timezone.now()
+        try:
+            with transaction.atomic():
+                unbound_order = _write_binding(target, locked, order, orders.get(old_id), new_value, changed,
+                                               confirm_time, incoming is not None, order_fields)
+                if history and changed and user is not None:
+                    IncomingChange.objects.create(incoming=target, user=user, val_name='birpay_id',
+                                                  new_val=new_value)
+        except DatabaseError as err:
+            if confirm is None or not new_id:
+                raise
+            text = f'Заявка {new_id} подтверждена в birpay, но привязка к смс {locked.pk} не записана: {err}'
+            logger.error(text, exc_info=True)
+            return BindResult(False, text, incoming=locked, order=order, confirmed=True)
+    return BindResult(True, incoming=target, order=order, unbound_order=unbound_order, changed=changed,
+                      confirm_time=confirm_time)
+
+
+def _write_binding(target, locked, order, old_order, new_value, changed: bool, confirm_time,
+                   save_all: bool, order_fields: dict | None):
+    """Запись привязки смс и заявки, возвращает заявку, от которой смс отвязана"""
+    unbound_order = None
+    if changed:
+        target.birpay_id = new_value
+        target.birpay_confirm_time = confirm_time
+        # merchant_user_id из заявки, при отвязке очищается
+        target.merchant_user_id = order.merchant_user_id if order else None
+        if old_order is not None and old_order is not order and old_order.incoming_id == locked.pk:
+            old_order.incoming = None
+            old_order.save(update_fields=['incoming'])
+            unbound_order = old_order
+            logger.info(f'Отвязан BirpayOrder {old_order.merchant_transaction_id} от Incoming {locked.pk}')
+    if save_all:
+        target.save()
+    elif changed:
+        target.save(update_fields=['birpay_id', 'birpay_confirm_time', 'merchant_user_id'])
+
+    if order is not None:
+        fields = ['incoming', *(order_fields or {})]
+        if order.incoming_id != locked.pk:
+            # Время подтверждения - только при новой привязке, повторная сохраняет прежнее
+            order.confirmed_time = confirm_time
+            fields.append('confirmed_time')
+        order.incoming = target
+        for field, value in (order_fields or {}).items():
+            setattr(order, field, value)
+        order.save(update_fields=fields)
+        logger.info(f'Привязан BirpayOrder {order.merchant_transaction_id} к Incoming {locked.pk}')
+    return unbound_order
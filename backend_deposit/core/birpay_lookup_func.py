@@ -0,0 +1,184 @@
+"""
+Данные заявок birpay сначала из локальной копии BirpayOrder, потом из API.
+
+Копию обновляет refresh_birpay_data: при каждой выгрузке в кэше отмечается время и самая
+старая заявка выгрузки. Заявка из окна выгрузки считается актуальной, пока с выгрузки прошло
+не больше BIRPAY_LOCAL_MAX_AGE секунд (BirpayOrder.updated_at - время изменения на стороне birpay,
+по нему свежесть копии не определить). Иначе - запрос в birpay.
+Почасовые счетчики источников: birpay_lookup_stats.
+"""
+import datetime
+
+import structlog
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from core.birpay_func import find_birpay_from_id, get_birpays
+
+logger = structlog.get_logger('deposit')
+
+BIRPAY_SYNC_KEY = 'birpay_sync'
+BIRPAY_LOOKUP_SOURCES = ('local', 'remote', 'batch')
+BIRPAY_LOOKUP_STATS_TIMEOUT = 60 * 60 * 48
+# Старые заявки вне окна выгрузки запрашиваются поштучно, не больше стольких за пакет
+BIRPAY_SINGLE_LIMIT = 10
+
+
+def _created_at(row: dict) -> datetime.datetime | None:
+    """createdAt заявки birpay (ISO, в том числе с Z). Непонятное значение пропускается"""
+    value = row.get('createdAt')
+    if not value:
+        return None
+    try:
+        created = parse_datetime(value)
+    except (TypeError, ValueError):
+        created = None
+    if created is None:
+        logger.warning(f'Непонятное время createdAt заявки birpay {row.get("merchantTransactionId")}: {value!r}')
+        return None
+    return timezone.make_aware(created) if timezone.is_naive(created) else created
+
+
+def mark_birpay_synced(rows: list[dict]):
+    """Отметка выгрузки BirpayOrder: время и самая старая заявка в выгрузке"""
+    created = [created for created in map(_created_at, rows) if created is not None]
+    if created:
+        cache.set(BIRPAY_SYNC_KEY, {'time': timezone.now(), 'oldest': min(created)}, None)
+
+
+def _stats_key(source: str, hour: datetime.datetime) -> str:
+    return f'birpay_lookup:{source}:{hour:%Y%m%d%H}'
+
+
+def count_lookup(source: str, count: int = 1):
+    if not count:
+        return
+    key = _stats_key(source, timezone.localtime())
+    cache.add(key, 0, timeout=BIRPAY_LOOKUP_STATS_TIMEOUT)
+    try:
+        cache.incr(key, count)
+    except ValueError:
+        pass
+
+
+def birpay_lookup_stats(hours: int = 24) -> dict:
+    """Ответы из локальной копии и запросы в birpay по часам: {source: {'2024-01-01 10:00': 5, ...}}"""
+    now = timezone.localtime()
+    hour_list = [now - datetime.timedelta(hours=i) for i in range(hours)]
+    result = {}
+    for source in BIRPAY_LOOKUP_SOURCES:
+        values = cache.get_many([_stats_key(source, hour) for hour in hour_list])
+        result[source] = {
+            f'{hour:%Y-%m-%d %H}:00': values.get(_stats_key(source, hour), 0) for hour in hour_list
+        }
+    return result
+
+
+def fresh_sync_oldest(max_age: int | None = None) -> datetime.datetime | None:
+    """Самая старая заявка последней выгрузки, если выгрузка не старше max_age секунд, иначе None"""
+    max_age = settings.BIRPAY_LOCAL_MAX_AGE if max_age is None else max_age
+    sync = cache.get(BIRPAY_SYNC_KEY)
+    if sync and timezone.now() - sync['time'] <= datetime.timedelta(seconds=max_age):
+        return sync['oldest']
+    return None
+
+
+def is_order_fresh(order, max_age: int | None = None) -> bool:
+    oldest = fresh_sync_oldest(max_age)
+    return oldest is not None and order.created_at >= oldest
+
+
+def check_from_order(order) -> dict:
+    # Та же форма, что у find_birpay_from_id
+    return {
+        'transaction_id': order.merchant_transaction_id,
+        'status': order.status,
+        'pay': order.amount,
+        'operator': {'username': order.operator} if order.operator else None,
+    }
+
+
+def _check_from_row(row: dict) -> dict:
+    return {
+        'transaction_id': row.get('merchantTransactionId'),
+        'status': row.get('status'),
+        'pay': float(row.get('amount')),
+        'operator': row.get('operator'),
+    }
+
+
+def find_birpay(transaction_id, max_age: int | None = None) -> dict | None:
+    """find_birpay_from_id с ответом из локальной копии, если она актуальна"""
+    transaction_id = str(transaction_id).strip()
+    oldest = fresh_sync_oldest(max_age)
+    if oldest is not None:
+        BirpayOrder = apps.get_model('deposit', 'BirpayOrder')
+        order = BirpayOrder.objects.filter(
+            merchant_transaction_id=transaction_id, created_at__gte=oldest).order_by('-created_at').first()
+        if order:
+            count_lookup('local')
+            return check_from_order(order)
+    count_lookup('remote')
+    return find_birpay_from_id(birpay_id=transaction_id)
+
+
+def find_birpays(transaction_ids: set[str], max_age: int | None = None) -> tuple[dict[str, dict], set[str]]:
+    """
+    Пакетный find_birpay: ({id: данные как у find_birpay_from_id}, отложенные id).
+    Актуальные - из локальной копии, остальные - одним запросом последних заявок,
+    старые вне окна - поштучно (не больше BIRPAY_SINGLE_LIMIT, остальные откладываются).
+    Не найденных id в результате нет.
+    """
+    BirpayOrder = apps.get_model('deposit', 'BirpayOrder')
+    found = {}
+    transaction_ids = {str(transaction_id).strip() for transaction_id in transaction_ids}
+
+    oldest = fresh_sync_oldest(max_age)
+    if oldest is not None:
+        orders = BirpayOrder.objects.filter(
+            merchant_transaction_id__in=transaction_ids, created_at__gte=oldest).order_by('created_at')
+        for order in orders:
+            found[order.merchant_transaction_id] = check_from_order(order)
+        count_lookup('local', len(found))
+
+    rest = transaction_ids - found.keys()
+    if rest:
+        # Один запрос последних заявок вместо запроса на каждый id
+        count_lookup('batch')
+        for row in get_birpays() or []:
+            transaction_id = row.get('merchantTransactionId')
+            if transaction_id in rest and transaction_id not in found:
+                found[transaction_id] = _check_from_row(row)
+        rest -= found.keys()
+
+    rest = sorted(rest)
+    for transaction_id in rest[:BIRPAY_SINGLE_LIMIT]:
+        count_lookup('remote')
+        check = find_birpay_from_id(birpay_id=transaction_id)
+        if check:
+            found[transaction_id] = check
+    return found, set(rest[BIRPAY_SINGLE_LIMIT:])
+
+
+def actual_order_status(order, max_age: int | None = None) -> int:
+    """
+    Статус заявки для проверок перед действиями оператора. Если локальная копия устарела -
+    статус запрашивается в birpay и сохраняется в заявку. При DEBUG и ошибке API - локальный статус.
+    """
+    if is_order_fresh(order, max_age) or settings.DEBUG:
+        count_lookup('local')
+        return order.status
+    count_lookup('remote')
+    try:
+        check = find_birpay_from_id(birpay_id=order.merchant_transaction_id)
+    except Exception as err:
+        logger.warning(f'Не удалось получить статус {order.merchant_transaction_id} из birpay: {err}')
+        return order.status
+    if check and check.get('status') is not None and check['status'] != order.status:
+        logger.info(f'Статус {order.merchant_transaction_id} в birpay {check["status"]}, локально {order.status}')
+        order.status = check['status']
+        type(order).objects.filter(pk=order.pk).update(status=order.status)
+    return order.status
@@ -0,0 +1,108 @@
+"""
+Кэш графиков статистики.
+
+Графики рисуются в фоне задачей render_chart_task и хранятся в кэше Django
+по ключу (график, дата, параметры). Вьюхи отдают готовую картинку или
+заглушку «график строится», не рисуя matplotlib в запросе.
+"""
+import datetime
+import hashlib
+import json
+
+import structlog
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from core.global_func import TZ
+
+logger = structlog.get_logger('deposit')
+
+CHART_DAY_GRAPH = 'day_graph'
+CHART_OPERATOR_SPEED = 'operator_speed'
+CHARTS = (CHART_DAY_GRAPH, CHART_OPERATOR_SPEED)
+
+# Сколько держим в кэше график за прошедший день (данные уже не меняются)
+CHART_PAST_DAY_TIMEOUT = 60 * 60 * 24
+# Сколько держим флаг «уже рисуется», чтобы не ставить одну задачу дважды
+CHART_RENDER_LOCK_TIMEOUT = 120
+# Сколько показываем ошибку построения, прежде чем попробовать снова
+CHART_ERROR_TIMEOUT = 60
+
+
+def chart_cache_key(chart: str, chart_date: datetime.date | None = None, params: dict | None = None) -> str:
+    params_hash = hashlib.md5(json.dumps(params or {}, sort_keys=True, default=str).encode()).hexdigest()[:12]
+    return f'chart:{chart}:{chart_date.isoformat() if chart_date else "all"}:{params_hash}'
+
+
+def _chart_timeout(chart_date: datetime.date | None, params: dict | None = None) -> int:
+    last_date = (params or {}).get('date_to') or chart_date
+    if isinstance(last_date, str):
+        last_date = datetime.date.fromisoformat(last_date)
+    if last_date and last_date < timezone.now().astimezone(TZ).date():
+        return CHART_PAST_DAY_TIMEOUT
+    return settings.CHART_CACHE_TIMEOUT
+
+
+def get_chart(chart: str, chart_date: datetime.date | None = None, params: dict | None = None) -> dict | None:
+    """Готовый график из кэша или None"""
+    return cache.get(chart_cache_key(chart, chart_date, params))
+
+
+def get_chart_error(chart: str, chart_date: datetime.date | None = None, params: dict | None = None) -> str | None:
+    """Ошибка последнего построения графика или None"""
+    return cache.get(f'{chart_cache_key(chart, chart_date, params)}:error')
+
+
+def record_chart_error(chart: str, chart_date: datetime.date | None, params: dict | None, error: Exception):
+    """Запоминает ошибку построения, чтобы страница показала ее, а не ждала график бесконечно"""
+    key = chart_cache_key(chart, chart_date, params)
+    cache.set(f'{key}:error', str(error) or type(error).__name__, timeout=CHART_ERROR_TIMEOUT)
+    cache.delete(f'{key}:rendering')
+
+
+def render_chart(chart: str, chart_date: datetime.date | None = None, params: dict | None = None) -> dict:
+    """
+    Рисует график и кладет в кэш.
+    Возвращает {'png': bytes | None, 'etag': str, 'rendered_at': str, 'data': dict}
+    """
+    from core.stat_func import get_png_for_day_graph, operator_speed_report
+
+    key = chart_cache_key(chart, chart_date, params)
+    data = {}
+    if chart == CHART_DAY_GRAPH:
+        png = get_png_for_day_graph()
+    elif chart == CHART_OPERATOR_SPEED:
+        date_to = (params or {}).get('date_to')
+        data = operator_speed_report(chart_date, datetime.date.fromisoformat(date_to) if date_to else None)
+        png = data.pop('png')
+    else:
+        raise ValueError(f'Неизвестный график {chart}')
+    entry = {
+        'png': png,
+        'etag': hashlib.md5(png or b'').hexdigest(),
+        'rendered_at': timezone.now().isoformat(),
+        'data': data,
+    }
+    cache.set(key, entry, timeout=_chart_timeout(chart_date, params))
+    cache.delete_many([f'{key}:rendering', f'{key}:error'])
+    logger.info(f'График {key} построен')
+    return entry
+
+
+def request_chart(chart: str, chart_date: datetime.date | None = None, params: dict | None = None) -> dict | None:
+    """
+    Возвращает график из кэша. Если его нет - ставит задачу на построение
+    (не более одной на ключ) и возвращает None.
+    После ошибки построения новая задача не ставится CHART_ERROR_TIMEOUT секунд (см. get_chart_error).
+    """
+    entry = get_chart(chart, chart_date, params)
+    if entry is not None:
+        return entry
+    key = chart_cache_key(chart, chart_date, params)
+    if cache.get(f'{key}:error') is not None:
+        return None
+    if cache.add(f'{key}:rendering', 1, timeout=CHART_RENDER_LOCK_TIMEOUT):
+        from deposit.tasks import render_chart_task
+        render_chart_task.delay(chart, chart_date.isoformat() if chart_date else None, params)
+    return None
@@ -0,0 +1,95 @@
+"""
+Вспомогательные функции для работы с БД: оценка количества строк для пагинации
+и индексы, которые нельзя описать в Meta модели.
+"""
+import json
+
+import structlog
+from django.core.paginator import EmptyPage, Paginator
+from django.db import connections, DatabaseError, transaction
+from django.db.models import QuerySet
+from django.utils.functional import cached_property
+
+logger = structlog.get_logger('deposit')
+
+# Если план обещает больше строк - считаем по оценке планировщика, без COUNT(*)
+ESTIMATE_COUNT_THRESHOLD = 10000
+
+
+def estimate_count(queryset: QuerySet) -> int | None:
+    """Оценка количества строк запроса по плану PostgreSQL (EXPLAIN). None если оценить нельзя"""
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = queryset.query.sql_with_params()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+    except DatabaseError as err:
+        logger.warning(f'Не удалось оценить количество строк: {err}')
+        return None
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Пагинатор для больших выборок: при большом результате количество берется из оценки
+    планировщика вместо полного COUNT(*). estimated - признак, что count приблизительный.
+    Если страница выходит за реальный конец выборки (оценка завышена) или упирается в него,
+    количество пересчитывается точно, а вместо пустой страницы отдается последняя реальная.
+    """
+    estimated = False
+
+    @cached_property
+    def count(self):
+        if isinstance(self.object_list, QuerySet) and not self.object_list.query.is_sliced:
+            estimate = estimate_count(self.object_list)
+            if estimate is not None and estimate > ESTIMATE_COUNT_THRESHOLD:
+                self.estimated = True
+                return estimate
+        return super().count
+
+    def page(self, number):
+        try:
+            page = super().page(number)
+        except EmptyPage:
+            if not self.estimated:
+                raise
+            page = None
+        if not self.estimated or (page is not None and len(page) == self.per_page):
+            return page
+        # Оценка разошлась с концом выборки - точный COUNT(*) только в этом случае
+        self.estimated = False
+        self.__dict__['count'] = Paginator.count.func(self)
+        self.__dict__.pop('num_pages', None)
+        try:
+            number = self.validate_number(number)
+        except EmptyPage:
+            number = self.num_pages if int(number) > 1 else 1
+        return super().page(number)
+
+
+SEARCH_INDEXES = (
+    # Поиск по части birpay_id (LIKE '%...%')
+    'CREATE INDEX IF NOT EXISTS incoming_birpay_id_trgm ON deposit_incoming USING gin (birpay_id gin_trgm_ops)',
+)
+
+
+def ensure_search_indexes(sender=None, using='default', **kwargs):
+    """
+    Триграммные индексы поиска (post_migrate). Требуют расширение pg_trgm -
+    если его нет на сервере, поиск работает без индекса.
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+    try:
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            for statement in SEARCH_INDEXES:
+                cursor.execute(statement)
+    except DatabaseError as err:
+        logger.warning(f'Индексы поиска не созданы: {err}')
@@ -13,6 +13,15 @@ TZ = pytz.timezone(TIME_ZONE)
 logger = structlog.get_logger('deposit')
 
 
+def cache_redis_client():
+    """Клиент redis общего кэша (для множеств SADD/SREM), None - кэш не redis"""
+    from django.core.cache import cache
+    from django.core.cache.backends.redis import RedisCache
+    if isinstance(cache, RedisCache):
+        return cache._cache.get_client(write=True)
+    return None
+
+
 def send_message_tg(message: str, chat_ids: list = settings.ADMIN_IDS):
     if not message:
         return
@@ -54,29 +63,31 @@ def hash_gen(text, salt):
 
 
 
+def card_visible_parts(card_mask: str) -> tuple[str, str]:
+    """Видимые цифры маски карты: подряд с начала и подряд с конца (до символа маски *•.)"""
+    card_mask = (card_mask or '').strip()
+    # Берём подряд цифры с начала
+    start_digits = ''
+    for c in card_mask:
+        if c.isdigit():
+            start_digits += c
+        elif c in '*•.':
+            break
+    # Берём подряд цифры с конца
+    end_digits = ''
+    for c in reversed(card_mask):
+        if c.isdigit():
+            end_digits = c + end_digits
+        elif c in '*•.':
+            break
+    return start_digits, end_digits
+
+
 def mask_compare(mask1, mask2):
     if not mask1 or not mask2:
         return False
-    def get_visible_parts(card_mask):
-        # Берём подряд цифры с начала
-        start_digits = ''
-        for c in card_mask:
-            if c.isdigit():
-                start_digits += c
-            elif c in '*•.':
-                break
-        # Берём подряд цифры с конца
-        end_digits = ''
-        for c in reversed(card_mask):
-            if c.isdigit():
-                end_digits = c + end_digits
-            elif c in '*•.':
-                break
-        return start_digits, end_digits
-    mask1 = mask1.strip()
-    mask2 = mask2.strip()
-    start1, end1 = get_visible_parts(mask1)
-    start2, end2 = get_visible_parts(mask2)
+    start1, end1 = card_visible_parts(mask1)
+    start2, end2 = card_visible_parts(mask2)
     # Сравниваем первые N символов, где N - минимальная длина начальных видимых цифр
     n_start = min(len(start1), len(start2))
     n_end = min(len(end1), len(end2))
@@ -85,6 +96,30 @@ def mask_compare(mask1, mask2):
     return start_match and end_match
 
 
+def card_recipient_parts(card_mask: str) -> tuple[str, str]:
+    """Значения колонок поиска по маске: цифры с начала и цифры с конца в обратном порядке"""
+    start, end = card_visible_parts(card_mask)
+    return start, end[::-1]
+
+
+def mask_compare_q(card_mask: str, prefix_field: str = 'recipient_prefix',
+                   suffix_rev_field: str = 'recipient_suffix_rev'):
+    """
+    Q-фильтр, совпадающий с mask_compare(card_mask, recipient) по колонкам видимых цифр получателя.
+    Одна маска - префикс другой: либо колонка из префиксов маски (индекс по равенству),
+    либо колонка начинается с маски (индекс по LIKE 'x%'). Цифры с конца хранятся в обратном
+    порядке, поэтому совпадение окончаний - тоже сравнение префиксов, без LIKE '%x'.
+    """
+    from django.db.models import Q
+    start, end_rev = card_recipient_parts(card_mask)
+    q = Q()
+    for field, digits in ((prefix_field, start), (suffix_rev_field, end_rev)):
+        if digits:
+            q &= Q(**{f'{field}__in': [digits[:i] for i in range(len(digits) + 1)]}) | Q(
+                **{f'{field}__startswith': digits})
+    return q
+
+
 class Timer:
 
     def __init__(self, text):
@@ -0,0 +1,166 @@
+"""
+Пульс макросов и телефонов.
+
+На каждый принятый скрин/смс пишется ключ heartbeat:<kind>:<устройство> со временем
+последнего сообщения (SET с TTL в общем кэше/redis) - без записи в БД на приеме.
+Устройство - телефон: серийный номер из имени скрина (как Incoming.phone_serial), без него - worker.
+Worker запоминается за серийным номером, поэтому телефон - одно устройство и одна тревога.
+Список устройств - множество redis (SADD, без чтения-записи всего списка), в локальном кэше - под блокировкой.
+check_macros проверяет каждое устройство отдельно и шлет тревогу по устройству.
+Без общего кэша (settings.CACHE_SHARED) пульс приема воркеру не виден: check_macros берет последний
+скрин устройств из БД на каждой проверке.
+"""
+import datetime
+import threading
+import time
+
+import structlog
+from django.core.cache import cache
+
+from core.global_func import cache_redis_client
+
+logger = structlog.get_logger('deposit')
+
+# Сколько помним устройство без сообщений
+HEARTBEAT_TIMEOUT = 60 * 60 * 24
+DEVICES_KEY = 'heartbeat_devices:{kind}'
+
+# Список устройств в локальном кэше (тесты, разработка) меняется под блокировкой процесса
+_devices_lock = threading.Lock()
+
+
+def serial_from_image_name(name: str | None) -> str | None:
+    """Серийный номер телефона из имени скрина вида ..._from_<serial>.jpg"""
+    if not name:
+        return None
+    from_part = name.split('_from_')
+    if len(from_part) == 2:
+        return from_part[1][:-4]
+    return None
+
+
+def _beat_key(kind: str, device: str) -> str:
+    return f'heartbeat:{kind}:{device}'
+
+
+def _alias_key(kind: str, worker: str) -> str:
+    return f'heartbeat_alias:{kind}:{worker}'
+
+
+def _add_devices(kind: str, devices: set[str]):
+    key = DEVICES_KEY.format(kind=kind)
+    client = cache_redis_client()
+    if client is not None:
+        client.sadd(cache.make_key(key), *devices)
+        return
+    with _devices_lock:
+        cache.set(key, (cache.get(key) or set()) | devices, timeout=None)
+
+
+def _remove_devices(kind: str, devices: set[str]):
+    key = DEVICES_KEY.format(kind=kind)
+    client = cache_redis_client()
+    if client is not None:
+        client.srem(cache.make_key(key), *devices)
+        return
+    with _devices_lock:
+        cache.set(key, (cache.get(key) or set()) - devices, timeout=None)
+
+
+def _get_devices(kind: str) -> set[str]:
+    key = DEVICES_KEY.format(kind=kind)
+    client = cache_redis_client()
+    if client is not None:
+        return {device.decode() for device in client.smembers(cache.make_key(key))}
+    return set(cache.get(key) or set())
+
+
+def _device(kind: str, worker: str | None, serial: str | None) -> str | None:
+    """Устройство сообщения: серийный номер, без него - серийный номер, ранее пришедший с этим worker"""
+    if serial:
+        if worker and worker != serial:
+            cache.set(_alias_key(kind, worker), serial, timeout=HEARTBEAT_TIMEOUT)
+        return serial
+    if worker:
+        return cache.get(_alias_key(kind, worker)) or worker
+    return None
+
+
+def heartbeat(kind: str, worker: str | None = None, serial: str | None = None, timestamp: float = None):
+    """Отмечает сообщение от телефона (worker и/или серийный номер, пустые пропускаются)"""
+    worker = str(worker) if worker else None
+    serial = str(serial) if serial else None
+    device = _device(kind, worker, serial)
+    if device is None:
+        return
+    beat = {'time': timestamp or time.time(), 'worker': worker}
+    cache.set(_beat_key(kind, device), beat, timeout=HEARTBEAT_TIMEOUT)
+    _add_devices(kind, {device})
+
+
+def seed_devices(kind: str, beats: dict[str, tuple[str | None, float]], overwrite: bool = False):
+    """
+    Восстанавливает устройства (например после очистки кэша): {устройство: (worker, время последнего сообщения)}.
+    Пульс пишется, только если его нет - более свежий из приема не затирается.
+    overwrite - пульс заменяется (кэш не общий с приемом, источник - БД).
+    """
+    write = cache.set if overwrite else cache.add
+    devices = set()
+    for device, (worker, timestamp) in beats.items():
+        if not device:
+            continue
+        device = str(device)
+        write(_beat_key(kind, device), {'time': timestamp, 'worker': worker}, timeout=HEARTBEAT_TIMEOUT)
+        if worker and worker != device:
+            write(_alias_key(kind, worker), device, timeout=HEARTBEAT_TIMEOUT)
+        devices.add(device)
+    if devices:
+        _add_devices(kind, devices)
+
+
+def need_seed(kind: str) -> bool:
+    """Нужно ли восстановить устройства из БД: не чаще раза в HEARTBEAT_TIMEOUT и после очистки кэша"""
+    return cache.add(f'heartbeat_seeded:{kind}', 1, timeout=HEARTBEAT_TIMEOUT)
+
+
+def _label(device: str, worker: str | None) -> str:
+    return f'{worker} ({device})' if worker and worker != device else device
+
+
+def _beats(kind: str) -> dict[str, dict]:
+    """Пульс по устройствам. Устройства с истекшим ключом удаляются из списка"""
+    devices = _get_devices(kind)
+    values = cache.get_many([_beat_key(kind, device) for device in devices])
+    result = {}
+    for device in sorted(devices):
+        beat = values.get(_beat_key(kind, device))
+        if beat is not None:
+            result[device] = beat
+    expired = devices - set(result)
+    if expired:
+        _remove_devices(kind, expired)
+    return result
+
+
+def last_seen(kind: str) -> dict[str, datetime.datetime]:
+    """Время последнего сообщения по устройствам: {'worker (серийный номер)': время}"""
+    return {_label(device, beat['worker']): datetime.datetime.fromtimestamp(beat['time'])
+            for device, beat in _beats(kind).items()}
+
+
+def dead_devices(kind: str, timeout: int) -> dict[str, int]:
+    """
+    Устройства без сообщений дольше timeout секунд, о которых еще не сообщали в текущем простое.
+    Возвращает {'worker (серийный номер)': секунд без сообщений} и помечает их как сообщенные.
+    """
+    now = time.time()
+    beats = _beats(kind)
+    alerted = cache.get_many([f'heartbeat_alerted:{kind}:{device}' for device in beats])
+    result = {}
+    for device, beat in beats.items():
+        delta = int(now - beat['time'])
+        alert_key = f'heartbeat_alerted:{kind}:{device}'
+        if delta > timeout and alerted.get(alert_key) != beat['time']:
+            cache.set(alert_key, beat['time'], timeout=HEARTBEAT_TIMEOUT)
+            result[_label(device, beat['worker'])] = delta
+    return result
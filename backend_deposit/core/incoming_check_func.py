@@ -0,0 +1,134 @@
+"""
+Пакетная проверка привязок платежей к заявкам birpay (IncomingCheck).
+
+Проверки, созданные при ручной привязке, собираются задачей check_incomings_batch_task,
+сначала новые. Старые непроверенные записи (до пакетной проверки) закрывает команда close_incoming_checks.
+Заявки ищутся пакетом через find_birpays (локальная BirpayOrder, затем один запрос в birpay).
+Результат - bulk_update и одно сообщение в телеграм.
+"""
+import datetime
+
+import structlog
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from core.birpay_lookup_func import find_birpays
+from core.global_func import send_message_tg
+
+logger = structlog.get_logger('deposit')
+
+INCOMING_CHECK_LOCK_KEY = 'incoming_check_batch_lock'
+INCOMING_CHECK_BATCH = 200
+INCOMING_CHECK_MAX_ATTEMPTS = 5
+# Длина одного сообщения телеграм с запасом
+TG_MESSAGE_LIMIT = 3500
+
+
+def incoming_check_message(incoming_check, check: dict | None) -> str:
+    """Текст предупреждения по результату проверки. Пустая строка - все в порядке"""
+    pk = incoming_check.pk
+    if not check:
+        return (
+            f'<b>Ничего не найдено</b> при проверке birpay {pk}\n'
+            f'({incoming_check.birpay_id})\n'
+            f'Платеж {incoming_check.incoming.id} на сумму {incoming_check.incoming.pay} azn'
+        )
+    pay_birpay = check.get('pay')
+    operator = check.get('operator')
+    if operator:
+        operator = operator.get('username')
+    status = check.get('status')
+    pay_incoming = incoming_check.incoming.pay
+    text_incoming = f'Проверка платежа {incoming_check.incoming.id} на сумму {pay_incoming} azn.\nCheck №{pk} birpay_id: {incoming_check.birpay_id}:\n'
+    delta = round(pay_incoming - pay_birpay, 2)
+    msg = ''
+    if status == 0:
+        if pay_incoming == pay_birpay:
+            # Не подтвержден. Сумма равна
+            msg = f'{text_incoming}<b>Статус 0</b>'
+        elif pay_birpay < pay_incoming:
+            # Не подтвержден. Пришло больше чем нужно
+            msg = f'{text_incoming}<b>Статус 0. Пришло {pay_incoming} azn вместо {pay_birpay} azn (на {delta} больше)</b>'
+        else:
+            # Не подтвержден. Пришло меньше чем нужно
+            msg = f'{text_incoming}<b>Статус 0. Пришло {pay_incoming} azn вместо {pay_birpay} azn (на {-delta} меньше)</b>'
+    elif status == -1:
+        # Пришло больше
+        if pay_incoming > pay_birpay:
+            msg = f'{text_incoming}<b>Статус -1. Лишние {delta} azn<>'
+    elif status == 1:
+        # Подтвержден
+        if pay_birpay > pay_incoming:
+            # Пришло меньше
+            msg = f'{text_incoming}<b>Статус 1. Не хватает {delta} azn {operator}</b>'
+        elif pay_birpay < pay_incoming:
+            # Пришло больше
+            msg = f'{text_incoming}<b>Статус 1. Лишние {delta} azn {operator}</b>'
+    else:
+        msg = f'{text_incoming}<b>Неизвестный статус {status}</b>'
+    return msg
+
+
+def apply_incoming_check(incoming_check, check: dict | None):
+    """Заполняет поля проверки по найденной заявке (без сохранения)"""
+    incoming_check.checked_at = incoming_check.change_time = timezone.now()
+    if check:
+        operator = check.get('operator')
+        incoming_check.pay_birpay = check.get('pay')
+        incoming_check.operator = operator.get('username') if operator else None
+        incoming_check.status = check.get('status')
+
+
+def send_digest(messages: list[str]):
+    """Одно сообщение на проход (с разбиением по длине сообщения телеграм)"""
+    part = ''
+    for msg in messages:
+        if part and len(part) + len(msg) > TG_MESSAGE_LIMIT:
+            send_message_tg(part, settings.ALARM_IDS)
+            part = ''
+        part = f'{part}\n\n{msg}' if part else msg
+    if part:
+        send_message_tg(part, settings.ALARM_IDS)
+
+
+def process_incoming_checks(limit: int = INCOMING_CHECK_BATCH) -> dict:
+    """Проверяет накопившиеся IncomingCheck одним проходом, начиная с новых"""
+    IncomingCheck = apps.get_model('deposit', 'IncomingCheck')
+    if not cache.add(INCOMING_CHECK_LOCK_KEY, 1, 60):
+        return {'skipped': True}
+    try:
+        threshold = timezone.now() - datetime.timedelta(seconds=settings.INCOMING_CHECK_DELAY)
+        checks = list(IncomingCheck.objects.filter(
+            checked_at__isnull=True, create_at__lte=threshold, attempts__lt=INCOMING_CHECK_MAX_ATTEMPTS
+        ).select_related('incoming').order_by('-id')[:limit])
+        if not checks:
+            return {'checked': 0}
+        try:
+            found, deferred = find_birpays({check.birpay_id for check in checks})
+        except Exception as err:
+            logger.error(f'Ошибка пакетной проверки birpay: {err}')
+            for incoming_check in checks:
+                incoming_check.attempts += 1
+            IncomingCheck.objects.bulk_update(checks, ['attempts'])
+            failed = [check.pk for check in checks if check.attempts >= INCOMING_CHECK_MAX_ATTEMPTS]
+            if failed:
+                send_message_tg(f'Превышено количество попыток проверки birpay: {failed}', settings.ALARM_IDS)
+            return {'checked': 0, 'error': str(err)}
+
+        checks = [check for check in checks if check.birpay_id.strip() not in deferred]
+        messages = []
+        for incoming_check in checks:
+            check = found.get(incoming_check.birpay_id.strip())
+            apply_incoming_check(incoming_check, check)
+            msg = incoming_check_message(incoming_check, check)
+            if msg:
+                messages.append(msg)
+        IncomingCheck.objects.bulk_update(checks, ['checked_at', 'pay_birpay', 'operator', 'status', 'change_time'])
+        send_digest(messages)
+        result = {'checked': len(checks), 'found': len(found), 'deferred': len(deferred), 'alerts': len(messages)}
+        logger.info(f'Пакетная проверка birpay: {result}')
+        return result
+    finally:
+        cache.delete(INCOMING_CHECK_LOCK_KEY)
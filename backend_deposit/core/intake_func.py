@@ -0,0 +1,77 @@
+"""
+Быстрая проверка повторов на приеме скринов и смс.
+
+Макросы часто присылают один и тот же скрин/смс по много раз. Ключ уже принятого
+сообщения хранится в общем кэше (redis) с TTL, поэтому повтор отсекается без запроса в БД.
+Первое появление по-прежнему проверяется в БД и уникальным индексом.
+Почасовые счетчики повторов ведутся только в общем кэше (CACHE_SHARED): в локальном кэше
+каждого процесса они неполные.
+"""
+import datetime
+import hashlib
+
+import structlog
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+logger = structlog.get_logger('deposit')
+
+# Сколько помним принятое сообщение
+INTAKE_SEEN_TIMEOUT = 60 * 60 * 24
+# Сколько храним почасовые счетчики повторов
+INTAKE_HITS_TIMEOUT = 60 * 60 * 48
+
+
+def _intake_key(kind: str, parts: tuple) -> str:
+    digest = hashlib.sha1('|'.join(str(part) for part in parts).encode()).hexdigest()
+    return f'intake_seen:{kind}:{digest}'
+
+
+def _hits_key(kind: str, hour: datetime.datetime) -> str:
+    return f'intake_dedup_hits:{kind}:{hour:%Y%m%d%H}'
+
+
+def intake_seen(kind: str, *parts) -> str | None:
+    """
+    Было ли уже сообщение с такими данными. Возвращает сохраненный результат приема или None.
+    Каждое попадание увеличивает почасовой счетчик повторов.
+    """
+    value = cache.get(_intake_key(kind, parts))
+    if value is not None and settings.CACHE_SHARED:
+        hits_key = _hits_key(kind, timezone.localtime())
+        cache.add(hits_key, 0, timeout=INTAKE_HITS_TIMEOUT)
+        try:
+            cache.incr(hits_key)
+        except ValueError:
+            pass
+    return value
+
+
+def remember_intake(kind: str, *parts, value: str = 'seen', timeout: int = INTAKE_SEEN_TIMEOUT,
+                    first_only: bool = False):
+    """
+    Запоминает принятое сообщение (после записи в БД или найденного в БД дубликата).
+    first_only - не продлевать срок уже запомненного: окно повтора считается от первого приема,
+    а не от последнего повтора.
+    """
+    if first_only:
+        cache.add(_intake_key(kind, parts), value, timeout=timeout)
+    else:
+        cache.set(_intake_key(kind, parts), value, timeout=timeout)
+
+
+def intake_dedup_stats(kinds=('screen', 'sms'), hours: int = 24) -> dict:
+    """
+    Повторы по часам за последние hours часов: {kind: {'2024-01-01 10:00': 5, ...}, 'shared_cache': bool}.
+    Без общего кэша счетчики не ведутся.
+    """
+    now = timezone.localtime()
+    result = {'shared_cache': settings.CACHE_SHARED}
+    for kind in kinds:
+        hour_list = [now - datetime.timedelta(hours=i) for i in range(hours)]
+        values = cache.get_many([_hits_key(kind, hour) for hour in hour_list])
+        result[kind] = {
+            f'{hour:%Y-%m-%d %H}:00': values.get(_hits_key(kind, hour), 0) for hour in hour_list
+        }
+    return result
@@ -0,0 +1,164 @@
+"""
+Индекс логов по заявкам birpay.
+
+OrderLogIndexHandler подключается к логгеру deposit и складывает строки лога,
+у которых в контексте structlog есть birpay_id / merchant_transaction_id / birpay_order_id,
+в отдельную SQLite-базу с индексами по этим полям (фоновым потоком, пачками). Поиск лога заявки -
+индексный запрос вместо grep по всему deposit.log.
+"""
+import logging
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+
+INDEX_KEYS = ('birpay_id', 'merchant_transaction_id', 'birpay_order_id')
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS order_log ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, created REAL NOT NULL, level TEXT, '
+    'birpay_id TEXT, merchant_transaction_id TEXT, birpay_order_id TEXT, line TEXT NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS order_log_birpay_id ON order_log (birpay_id)',
+    'CREATE INDEX IF NOT EXISTS order_log_merchant_transaction_id ON order_log (merchant_transaction_id)',
+    'CREATE INDEX IF NOT EXISTS order_log_birpay_order_id ON order_log (birpay_order_id)',
+    'CREATE INDEX IF NOT EXISTS order_log_created ON order_log (created)',
+)
+
+
+def connect(filename: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(filename, timeout=5, check_same_thread=False, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    for statement in SCHEMA:
+        conn.execute(statement)
+    return conn
+
+
+class OrderLogIndexHandler(logging.Handler):
+    """
+    Handler для индексации строк лога по id заявки.
+    emit только кладет строку в очередь, в SQLite пишет фоновый поток пачками до batch_size строк
+    в одной транзакции - логирование не ждет диска и блокировки базы другими процессами.
+    При переполнении очереди (queue_size) строки индекса отбрасываются (в deposit.log они остаются).
+    filename: путь к базе SQLite
+    retention_days: сколько дней хранить строки (чистка раз в cleanup_every записей)
+    """
+
+    def __init__(self, filename: str, retention_days: int = 30, cleanup_every: int = 5000, batch_size: int = 500,
+                 queue_size: int = 10000, level=logging.NOTSET):
+        super().__init__(level)
+        self.filename = filename
+        self.retention_days = retention_days
+        self.cleanup_every = cleanup_every
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.dropped = 0
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _get_queue(self) -> queue.Queue:
+        # После fork (gunicorn, celery prefork) потока родителя в дочернем процессе нет - запускаем свой
+        if self._pid != os.getpid():
+            with self._start_lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue(self.queue_size)
+                    self._thread = threading.Thread(target=self._writer, args=(self._queue,),
+                                                    name='order-log-index', daemon=True)
+                    self._thread.start()
+                    self._pid = os.getpid()
+        return self._queue
+
+    def emit(self, record: logging.LogRecord) -> None:
+        event = record.msg if isinstance(record.msg, dict) else {}
+        ids = [event.get(key) for key in INDEX_KEYS]
+        if not any(value is not None for value in ids):
+            return
+        try:
+            row = [record.created, record.levelname] + [str(value) if value is not None else None for value in ids]
+            self._get_queue().put_nowait(row + [self.format(record)])
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _write_batch(self, conn: sqlite3.Connection, batch: list) -> None:
+        conn.execute('BEGIN')
+        try:
+            conn.executemany(
+                'INSERT INTO order_log (created, level, birpay_id, merchant_transaction_id, birpay_order_id, line) '
+                'VALUES (?, ?, ?, ?, ?, ?)', batch)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _writer(self, rows: queue.Queue) -> None:
+        conn = None
+        inserted = 0
+        stop = False
+        while not stop:
+            row = rows.get()
+            batch = []
+            while row is not None:
+                batch.append(row)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    row = rows.get_nowait()
+                except queue.Empty:
+                    break
+            stop = row is None
+            if not batch:
+                continue
+            try:
+                conn = conn or connect(self.filename)
+                self._write_batch(conn, batch)
+                inserted += len(batch)
+                if inserted >= self.cleanup_every:
+                    inserted = 0
+                    conn.execute('DELETE FROM order_log WHERE created < ?',
+                                 [time.time() - self.retention_days * 24 * 3600])
+            except Exception as err:
+                # Не через logging - handler сам подключен к логгеру
+                sys.stderr.write(f'OrderLogIndexHandler: не записано {len(batch)} строк: {err}\n')
+        if conn is not None:
+            conn.close()
+
+    def close(self) -> None:
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                # Дописываем очередь перед выходом (logging.shutdown)
+                try:
+                    self._queue.put(None, timeout=10)
+                    self._thread.join(timeout=10)
+                except queue.Full:
+                    pass
+            self._thread = None
+            self._queue = None
+            self._pid = None
+        if self.dropped:
+            sys.stderr.write(f'OrderLogIndexHandler: отброшено {self.dropped} строк при переполнении очереди\n')
+        super().close()
+
+
+def search_order_log(filename: str, query: str, limit: int = 5000) -> list[str]:
+    """Строки лога по birpay_id, merchant_transaction_id или birpay_order_id в порядке записи"""
+    if not os.path.exists(filename):
+        return []
+    conn = connect(filename)
+    try:
+        rows = conn.execute(
+            'SELECT line FROM order_log WHERE id IN ('
+            'SELECT id FROM order_log WHERE birpay_id = ? '
+            'UNION SELECT id FROM order_log WHERE merchant_transaction_id = ? '
+            'UNION SELECT id FROM order_log WHERE birpay_order_id = ?) '
+            'ORDER BY id LIMIT ?',
+            [query, query, query, limit],
+        ).fetchall()
+    finally:
+        conn.close()
+    return [row[0] for row in rows]
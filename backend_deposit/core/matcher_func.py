@@ -0,0 +1,211 @@
+"""
+Сопоставление заявок birpay со смс, пришедшими после ответа GPT.
+
+Автоподтверждение в send_image_to_gpt_task ищет смс сразу после распознавания чека. Если по заявке
+не хватает только флагов смс (sms, balance_match), она попадает в индекс ожидающих смс в кэше:
+ключ - сумма и 5-минутный интервал времени из чека, значение - множество birpay_id (SADD/SREM в redis,
+без блокировок; в локальном кэше - под блокировкой процесса). Новая свободная смс (post_save Incoming,
+пакетный прием, повторное распознавание мусора) проверяется по индексу, и при совпадении в той же
+транзакции через outbox ставится match_incomings_task: она заново проверяет заявку и привязывает смс
+так же, как автоподтверждение.
+Поздняя смс ищется в окне от MATCHER_DELTA_BEFORE минут до чека до MATCHER_DELTA_AFTER минут после
+(шире, чем ±2 минуты при проверке GPT - смс доходят с задержкой). Ключ индекса живет до конца
+этого окна для последнего чека интервала: позже подходящая смс прийти не может.
+Индекс пишет celery (send_image_to_gpt_task), читает прием смс в web, поэтому он ведется только
+в общем кэше (CACHE_SHARED); без него поздняя смс не сопоставляется. Счетчики auto_approve_stats -
+тоже только в общем кэше.
+Автоподтверждения по часам, сразу и по поздней смс - auto_approve_stats.
+"""
+import datetime
+import json
+import threading
+import time
+
+import structlog
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from core.global_func import cache_redis_client
+from deposit.func import gpt_check_time, find_sms_for_order, sms_balance_matches
+
+logger = structlog.get_logger('deposit')
+
+MATCHER_BUCKET = 300
+# Окно поиска поздней смс вокруг времени чека, минут
+MATCHER_DELTA_BEFORE = 2
+MATCHER_DELTA_AFTER = 10
+# Запас времени жизни ключа индекса на обработку смс, сек
+MATCHER_INDEX_SLACK = 60
+AUTO_APPROVE_SOURCES = ('direct', 'late')
+AUTO_APPROVE_STATS_TIMEOUT = 60 * 60 * 48
+
+# Индекс в локальном кэше (тесты, разработка) меняется под блокировкой процесса
+_index_lock = threading.Lock()
+
+
+def _bucket(moment: datetime.datetime) -> int:
+    return int(moment.timestamp()) // MATCHER_BUCKET
+
+
+def _index_key(amount, bucket: int) -> str:
+    return f'matcher:orders:{float(amount):.2f}:{bucket}'
+
+
+def _index_expire_at(bucket: int) -> int:
+    """Время (unix) окончания окна поздней смс для последнего чека интервала"""
+    return (bucket + 1) * MATCHER_BUCKET + MATCHER_DELTA_AFTER * 60 + MATCHER_INDEX_SLACK
+
+
+def _window_keys(amount, moment: datetime.datetime) -> set[str]:
+    """Ключи индекса, в которых может быть заявка для смс, пришедшей в moment"""
+    first = _bucket(moment - datetime.timedelta(minutes=MATCHER_DELTA_AFTER))
+    last = _bucket(moment + datetime.timedelta(minutes=MATCHER_DELTA_BEFORE))
+    return {_index_key(amount, bucket) for bucket in range(first, last + 1)}
+
+
+def _index_add(amount, bucket: int, birpay_id: int) -> bool:
+    expire_at = _index_expire_at(bucket)
+    timeout = expire_at - int(time.time())
+    if timeout <= 0:
+        return False
+    key = _index_key(amount, bucket)
+    client = cache_redis_client()
+    if client is not None:
+        redis_key = cache.make_key(key)
+        pipe = client.pipeline()
+        pipe.sadd(redis_key, birpay_id)
+        pipe.expireat(redis_key, expire_at)
+        pipe.execute()
+        return True
+    with _index_lock:
+        cache.set(key, (cache.get(key) or set()) | {birpay_id}, timeout)
+    return True
+
+
+def _index_remove(amount, bucket: int, birpay_id: int):
+    key = _index_key(amount, bucket)
+    client = cache_redis_client()
+    if client is not None:
+        client.srem(cache.make_key(key), birpay_id)
+        return
+    with _index_lock:
+        ids = cache.get(key)
+        if ids and birpay_id in ids:
+            cache.set(key, ids - {birpay_id}, max(_index_expire_at(bucket) - int(time.time()), 1))
+
+
+def _index_get_many(keys: set[str]) -> dict[str, set[int]]:
+    client = cache_redis_client()
+    if client is None:
+        return cache.get_many(keys)
+    keys = sorted(keys)
+    pipe = client.pipeline()
+    for key in keys:
+        pipe.smembers(cache.make_key(key))
+    return {key: {int(birpay_id) for birpay_id in members} for key, members in zip(keys, pipe.execute()) if members}
+
+
+def is_waiting_sms(order) -> bool:
+    """Заявка ждет смс: свободна, и для автоподтверждения не хватает только флагов смс"""
+    GPTIMHO = type(order).GPTIMHO
+    flags = GPTIMHO(order.gpt_flags)
+    sms_flags = GPTIMHO.sms | GPTIMHO.balance_match
+    return (order.status == 0 and order.incoming_id is None and GPTIMHO.sms not in flags
+            and flags | sms_flags == GPTIMHO(255) and not order.is_moshennik() and not order.is_painter())
+
+
+def register_waiting_order(order, gpt_time: datetime.datetime):
+    if not settings.CACHE_SHARED:
+        logger.warning(f'Заявка {order.merchant_transaction_id} не ждет позднюю смс: нет общего кэша (redis_host)')
+        return
+    if _index_add(order.amount, _bucket(gpt_time), order.birpay_id):
+        logger.info(f'Заявка {order.merchant_transaction_id} ждет смс {order.amount} около {gpt_time}')
+
+
+def forget_waiting_order(order, gpt_time: datetime.datetime | None = None):
+    gpt_time = gpt_time or gpt_check_time(order.gpt_data)
+    _index_remove(order.amount, _bucket(gpt_time), order.birpay_id)
+
+
+def waiting_orders(incomings) -> dict[int, set[int]]:
+    """{id смс: birpay_id ожидающих заявок с ее суммой и временем} - один запрос в кэш"""
+    if not settings.CACHE_SHARED:
+        return {}
+    keys = {incoming.id: _window_keys(incoming.pay, incoming.register_date)
+            for incoming in incomings if incoming.id and incoming.pay and incoming.register_date}
+    values = _index_get_many({key for incoming_keys in keys.values() for key in incoming_keys})
+    result = {}
+    for incoming_id, incoming_keys in keys.items():
+        birpay_ids = {birpay_id for key in incoming_keys for birpay_id in values.get(key, ())}
+        if birpay_ids:
+            result[incoming_id] = birpay_ids
+    return result
+
+
+def notify_new_incomings(incomings):
+    """Ставит новые свободные смс, которых ждут заявки, на сопоставление (в текущей транзакции)"""
+    from core.outbox_func import enqueue_task
+    incoming_ids = sorted(waiting_orders([incoming for incoming in incomings if not incoming.birpay_id]))
+    if incoming_ids:
+        logger.info(f'Смс {incoming_ids} ждут заявки, ставим на сопоставление')
+        enqueue_task('deposit.tasks.match_incomings_task', args=[incoming_ids])
+
+
+def late_match_orders(incoming) -> list:
+    """Заявки из индекса, для которых смс подходит однозначно и автоподтверждение разрешено"""
+    BirpayOrder = apps.get_model('deposit', 'BirpayOrder')
+    Options = apps.get_model('users', 'Options')
+    birpay_ids = waiting_orders([incoming]).get(incoming.id)
+    if not birpay_ids or not Options.load().gpt_auto_approve:
+        return []
+    result = []
+    for order in BirpayOrder.objects.filter(birpay_id__in=birpay_ids).order_by('created_at'):
+        gpt_time = gpt_check_time(order.gpt_data)
+        if not is_waiting_sms(order):
+            forget_waiting_order(order, gpt_time)
+            continue
+        gpt_data = json.loads(order.gpt_data) if isinstance(order.gpt_data, str) else order.gpt_data or {}
+        gpt_recipient = gpt_data.get('recipient', '')
+        candidates = find_sms_for_order(order.amount, gpt_time, gpt_recipient,
+                                        delta_before=MATCHER_DELTA_BEFORE, delta_after=MATCHER_DELTA_AFTER)
+        if [sms.id for sms in candidates] == [incoming.id] and sms_balance_matches(candidates[0]):
+            result.append(order)
+    return result
+
+
+def _stats_key(source: str, hour: datetime.datetime) -> str:
+    return f'auto_approve:{source}:{hour:%Y%m%d%H}'
+
+
+def count_auto_approve(source: str):
+    if not settings.CACHE_SHARED:
+        return
+    key = _stats_key(source, timezone.localtime())
+    cache.add(key, 0, timeout=AUTO_APPROVE_STATS_TIMEOUT)
+    try:
+        cache.incr(key)
+    except ValueError:
+        pass
+
+
+def auto_approve_stats(hours: int = 24) -> dict:
+    """
+    Автоподтверждения по часам: сразу после GPT (direct) и по смс, пришедшей позже (late).
+    {'direct': {'2024-01-01 10:00': 5, ...}, 'late': {...}, 'total': {'direct', 'late', 'late_share'}}
+    Без общего кэша счетчики не ведутся.
+    """
+    now = timezone.localtime()
+    hour_list = [now - datetime.timedelta(hours=i) for i in range(hours)]
+    result = {'shared_cache': settings.CACHE_SHARED}
+    for source in AUTO_APPROVE_SOURCES:
+        values = cache.get_many([_stats_key(source, hour) for hour in hour_list])
+        result[source] = {
+            f'{hour:%Y-%m-%d %H}:00': values.get(_stats_key(source, hour), 0) for hour in hour_list
+        }
+    total = {source: sum(result[source].values()) for source in AUTO_APPROVE_SOURCES}
+    approved = sum(total.values())
+    total['late_share'] = round(total['late'] / approved, 3) if approved else 0
+    result['total'] = total
+    return result
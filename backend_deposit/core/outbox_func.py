@@ -0,0 +1,143 @@
+"""
+Постановка задач celery через outbox (TaskOutbox).
+
+Задача записывается в таблицу в той же транзакции, что и изменение данных, поэтому
+воркер не получит задачу раньше, чем строка станет видна, а сбой брокера не теряет задачу.
+В брокер задачи отправляет relay_outbox пачками: после коммита (с ограничением частоты)
+и по расписанию beat на случай, если сразу отправить не удалось.
+Задача с ошибкой отправки откладывается с растущей паузой и не задерживает остальные,
+после OUTBOX_MAX_ATTEMPTS ошибок отправка прекращается (failed_at, видно в админке).
+"""
+import datetime
+import time
+
+import structlog
+from celery import current_app
+from django.apps import apps
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+logger = structlog.get_logger('deposit')
+
+# Сколько задач отправлять за одну транзакцию relay. Отправленные в прерванной транзакции
+# уйдут повторно, поэтому пачка небольшая
+OUTBOX_RELAY_BATCH = 100
+# Сколько секунд relay берет новые пачки - с запасом до time_limit relay_outbox_task (60 с)
+OUTBOX_RELAY_SECONDS = 30
+# Ошибок подряд, после которых брокер считается недоступным и запуск прерывается
+OUTBOX_BROKER_ERRORS = 3
+# Пауза перед повтором отправки: OUTBOX_RETRY_DELAY * 2 ** (ошибок - 1), не больше OUTBOX_RETRY_MAX_DELAY, сек
+OUTBOX_RETRY_DELAY = 5
+OUTBOX_RETRY_MAX_DELAY = 600
+OUTBOX_MAX_ATTEMPTS = 10
+# Не чаще одного запуска relay после коммита за этот интервал, сек
+OUTBOX_KICK_INTERVAL = 1
+# Сколько хранить отправленные задачи
+OUTBOX_KEEP_DAYS = 3
+
+
+def _task_name(task) -> str:
+    return task if isinstance(task, str) else task.name
+
+
+def enqueue_task(task, args: list | tuple = (), kwargs: dict | None = None, countdown: int = 0,
+                 dedup_key: str | None = None):
+    """
+    Ставит задачу в outbox в текущей транзакции.
+    task - задача celery или ее имя. dedup_key - если неотправленная задача с таким ключом уже есть,
+    повтор не добавляется.
+    """
+    TaskOutbox = apps.get_model('deposit', 'TaskOutbox')
+    TaskOutbox.objects.bulk_create([TaskOutbox(
+        task=_task_name(task),
+        args=list(args),
+        kwargs=kwargs or {},
+        dedup_key=dedup_key,
+        available_at=timezone.now() + datetime.timedelta(seconds=countdown),
+    )], ignore_conflicts=True)
+    transaction.on_commit(kick_outbox_relay)
+
+
+def kick_outbox_relay():
+    """Быстрый запуск relay после коммита. При всплеске задач - один запуск на интервал"""
+    if not cache.add('outbox_relay_kick', 1, OUTBOX_KICK_INTERVAL):
+        return
+    try:
+        current_app.send_task('deposit.tasks.relay_outbox_task', countdown=OUTBOX_KICK_INTERVAL)
+    except Exception as err:
+        # Задачи останутся в outbox и уйдут по расписанию
+        logger.warning(f'Не удалось запустить relay outbox: {err}')
+
+
+def _publish(row, now: datetime.datetime):
+    task = current_app.tasks.get(row.task)
+    eta = row.available_at if row.available_at > now else None
+    if task is not None:
+        task.apply_async(args=row.args, kwargs=row.kwargs, eta=eta)
+    else:
+        current_app.send_task(row.task, args=row.args, kwargs=row.kwargs, eta=eta)
+
+
+def _retry_delay(attempts: int) -> int:
+    return min(OUTBOX_RETRY_DELAY * 2 ** (attempts - 1), OUTBOX_RETRY_MAX_DELAY)
+
+
+def relay_outbox(limit: int = OUTBOX_RELAY_BATCH, max_seconds: float = OUTBOX_RELAY_SECONDS) -> dict:
+    """
+    Отправляет неотправленные задачи outbox в брокер пачками по limit, новые пачки - не дольше max_seconds.
+    Строки блокируются (skip locked), поэтому параллельные relay не отправят задачу дважды.
+    Задача с ошибкой откладывается до retry_at, отправка продолжается со следующей.
+    После OUTBOX_BROKER_ERRORS ошибок подряд (брокер недоступен) отправка прерывается до следующего запуска.
+    """
+    TaskOutbox = apps.get_model('deposit', 'TaskOutbox')
+    sent = failed = dead = 0
+    deadline = time.monotonic() + max_seconds
+    broker_down = False
+    while not broker_down:
+        with transaction.atomic():
+            now = timezone.now()
+            rows = list(TaskOutbox.objects.select_for_update(skip_locked=True).filter(
+                Q(retry_at__isnull=True) | Q(retry_at__lte=now), sent_at__isnull=True, failed_at__isnull=True,
+            ).order_by('id')[:limit])
+            done = []
+            errors_in_row = 0
+            for row in rows:
+                try:
+                    _publish(row, now)
+                except Exception as err:
+                    failed += 1
+                    errors_in_row += 1
+                    row.attempts += 1
+                    row.last_error = str(err)
+                    if row.attempts >= OUTBOX_MAX_ATTEMPTS:
+                        row.failed_at = now
+                        dead += 1
+                        logger.error(f'Задача outbox {row} не отправлена после {row.attempts} попыток: {err}')
+                    else:
+                        row.retry_at = now + datetime.timedelta(seconds=_retry_delay(row.attempts))
+                        logger.warning(f'Ошибка отправки задачи outbox {row}: {err}')
+                    done.append(row)
+                    if errors_in_row >= OUTBOX_BROKER_ERRORS:
+                        broker_down = True
+                        break
+                    continue
+                errors_in_row = 0
+                row.sent_at = now
+                done.append(row)
+            TaskOutbox.objects.bulk_update(done, ['sent_at', 'attempts', 'last_error', 'retry_at', 'failed_at'])
+        sent += sum(1 for row in done if row.sent_at)
+        if len(rows) < limit or time.monotonic() > deadline:
+            break
+    if sent or failed:
+        logger.info(f'Outbox: отправлено {sent}, ошибок {failed}, прекращено {dead}')
+    return {'sent': sent, 'failed': failed, 'dead': dead}
+
+
+def cleanup_outbox(days: int = OUTBOX_KEEP_DAYS) -> int:
+    """Удаляет отправленные задачи старше days дней"""
+    TaskOutbox = apps.get_model('deposit', 'TaskOutbox')
+    threshold = timezone.now() - datetime.timedelta(days=days)
+    deleted, _ = TaskOutbox.objects.filter(sent_at__lt=threshold).delete()
+    return deleted
@@ -0,0 +1,145 @@
+"""
+Адаптивный интервал опроса внешних API (birpay, UM).
+
+Задача adaptive_poll_tick запускается beat каждые пару секунд и ставит в очередь опросы
+из ADAPTIVE_POLLERS, у которых подошло время. Опрос, обернутый adaptive_poller, сообщает,
+сколько изменений нашел, сколько работал и была ли ошибка. Следующий интервал:
+- были изменения - в 2 раза короче;
+- изменений нет - в 1.5 раза длиннее (пока средняя частота изменений низкая);
+- ошибка внешнего API - в 2 раза длиннее (backoff);
+- не короче полуторного времени обработки, в пределах min/max, со случайным разбросом ±10%.
+Состояние опросов в кэше, текущие интервалы и частота изменений - poller_stats.
+"""
+import functools
+import random
+import time
+
+import structlog
+from celery import current_app
+from django.conf import settings
+from django.core.cache import cache
+
+logger = structlog.get_logger('deposit')
+
+POLLER_STATE_TIMEOUT = 60 * 60 * 24
+POLLER_JITTER = 0.1
+# Сглаживание частоты изменений и времени обработки
+POLLER_EWMA_ALPHA = 0.3
+# Изменений в минуту, при которых интервал не увеличиваем, даже если в этот раз пусто
+POLLER_BUSY_RATE = 0.5
+
+
+def _state_key(name: str) -> str:
+    return f'poller_state:{name}'
+
+
+def _running_key(name: str) -> str:
+    return f'poller_running:{name}'
+
+
+def get_poller_state(name: str) -> dict:
+    config = settings.ADAPTIVE_POLLERS[name]
+    return cache.get(_state_key(name)) or {
+        'interval': float(config['min']), 'rate': 0.0, 'duration': 0.0, 'errors': 0,
+        'next_run': 0.0, 'last_run': None, 'last_changes': 0,
+    }
+
+
+def next_interval(interval: float, config: dict, changes: int, rate: float, duration: float,
+                  error: bool) -> float:
+    """Следующий интервал опроса (без разброса), сек"""
+    if error:
+        interval *= 2
+    elif changes:
+        interval /= 2
+    elif rate < POLLER_BUSY_RATE:
+        interval *= 1.5
+    interval = max(interval, duration * 1.5)
+    return min(max(interval, config['min']), config['max'])
+
+
+def record_poll(name: str, changes: int, duration: float, error: Exception | None = None) -> dict:
+    """Учитывает результат опроса и назначает время следующего"""
+    config = settings.ADAPTIVE_POLLERS[name]
+    state = get_poller_state(name)
+    now = time.time()
+    if not error:
+        elapsed = now - state['last_run'] if state['last_run'] else state['interval']
+        per_minute = changes * 60 / max(elapsed, 1)
+        state['rate'] = POLLER_EWMA_ALPHA * per_minute + (1 - POLLER_EWMA_ALPHA) * state['rate']
+        state['duration'] = POLLER_EWMA_ALPHA * duration + (1 - POLLER_EWMA_ALPHA) * state['duration']
+        state['errors'] = 0
+        state['last_changes'] = changes
+        state['last_run'] = now
+    else:
+        state['errors'] += 1
+    state['interval'] = next_interval(state['interval'], config, changes, state['rate'],
+                                      max(state['duration'], duration), error is not None)
+    state['next_run'] = now + state['interval'] * random.uniform(1 - POLLER_JITTER, 1 + POLLER_JITTER)
+    cache.set(_state_key(name), state, timeout=POLLER_STATE_TIMEOUT)
+    cache.delete(_running_key(name))
+    if error:
+        logger.warning(f'Опрос {name}: ошибка {state["errors"]} подряд, следующий через {state["interval"]:.1f} c')
+    return state
+
+
+def adaptive_poller(name: str, changes=int):
+    """
+    Декоратор задачи опроса: после выполнения назначает следующий опрос.
+    changes - функция от результата задачи, возвращающая количество найденных изменений.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as err:
+                record_poll(name, 0, time.perf_counter() - start, error=err)
+                raise
+            try:
+                record_poll(name, changes(result) or 0, time.perf_counter() - start)
+            except Exception as err:
+                logger.error(f'Ошибка учета опроса {name}: {err}')
+            return result
+        return wrapper
+    return decorator
+
+
+def dispatch_due_pollers() -> list[str]:
+    """Ставит в очередь опросы, у которых подошло время. Опрос не ставится, пока выполняется предыдущий"""
+    now = time.time()
+    dispatched = []
+    for name, config in settings.ADAPTIVE_POLLERS.items():
+        if get_poller_state(name)['next_run'] > now:
+            continue
+        task = current_app.tasks.get(config['task'])
+        # Если задачу убил time_limit, блокировка снимется сама
+        lock_timeout = int((getattr(task, 'time_limit', None) or 60) * 2)
+        if not cache.add(_running_key(name), 1, lock_timeout):
+            continue
+        try:
+            current_app.send_task(config['task'])
+            dispatched.append(name)
+        except Exception as err:
+            cache.delete(_running_key(name))
+            logger.warning(f'Не удалось поставить опрос {name}: {err}')
+    return dispatched
+
+
+def poller_stats() -> dict:
+    """Текущие интервалы, частота изменений (в минуту), время обработки и ошибки опросов"""
+    now = time.time()
+    result = {}
+    for name in settings.ADAPTIVE_POLLERS:
+        state = get_poller_state(name)
+        result[name] = {
+            'interval': round(state['interval'], 1),
+            'rate_per_minute': round(state['rate'], 2),
+            'duration': round(state['duration'], 2),
+            'errors': state['errors'],
+            'last_changes': state['last_changes'],
+            'next_in': round(max(state['next_run'] - now, 0), 1),
+            'running': cache.get(_running_key(name)) is not None,
+        }
+    return result
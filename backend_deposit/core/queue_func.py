@@ -0,0 +1,120 @@
+"""
+Задержка очередей celery: время от постановки задачи до начала выполнения по каждой очереди.
+
+При отправке в заголовок задачи пишется время постановки (before_task_publish), при старте
+задачи в воркере (task_prerun) задержка добавляется в поминутные счетчики очереди в кэше.
+Для отложенных задач (countdown/eta) задержка считается от eta.
+"""
+import datetime
+import time
+
+import structlog
+from celery.signals import before_task_publish, task_prerun
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+logger = structlog.get_logger('deposit')
+
+QUEUE_LAG_TIMEOUT = 60 * 60 * 2
+
+
+def queue_names() -> list[str]:
+    queues = {route['queue'] for route in settings.CELERY_TASK_ROUTES.values()}
+    return [settings.CELERY_TASK_DEFAULT_QUEUE, *sorted(queues)]
+
+
+def _lag_key(queue: str, minute: datetime.datetime, field: str) -> str:
+    return f'queue_lag:{queue}:{minute:%Y%m%d%H%M}:{field}'
+
+
+@before_task_publish.connect
+def mark_enqueued_at(headers=None, **kwargs):
+    if headers is not None:
+        headers.setdefault('enqueued_at', time.time())
+
+
+def record_queue_lag(queue: str, lag_ms: int):
+    """Добавляет задержку задачи в поминутные счетчики очереди"""
+    minute = timezone.localtime()
+    for field, value in (('count', 1), ('sum', lag_ms)):
+        key = _lag_key(queue, minute, field)
+        cache.add(key, 0, timeout=QUEUE_LAG_TIMEOUT)
+        try:
+            cache.incr(key, value)
+        except ValueError:
+            pass
+    max_key = _lag_key(queue, minute, 'max')
+    if lag_ms > (cache.get(max_key) or 0):
+        cache.set(max_key, lag_ms, timeout=QUEUE_LAG_TIMEOUT)
+    if lag_ms > settings.QUEUE_LAG_WARNING_MS:
+        logger.warning(f'Задержка очереди {queue}: {lag_ms} мс')
+
+
+@task_prerun.connect
+def measure_queue_lag(task=None, **kwargs):
+    try:
+        request = task.request
+        enqueued_at = request.get('enqueued_at') or (request.get('headers') or {}).get('enqueued_at')
+        if not enqueued_at or request.is_eager:
+            return
+        start_from = float(enqueued_at)
+        if request.eta:
+            eta = request.eta if isinstance(request.eta, datetime.datetime) \
+                else datetime.datetime.fromisoformat(request.eta)
+            start_from = max(start_from, eta.timestamp())
+        queue = (request.delivery_info or {}).get('routing_key') or settings.CELERY_TASK_DEFAULT_QUEUE
+        record_queue_lag(queue, max(int((time.time() - start_from) * 1000), 0))
+    except Exception as err:
+        logger.warning(f'Ошибка замера задержки очереди: {err}')
+
+
+def queue_backlog(queues: list[str]) -> dict[str, int | None]:
+    """Количество задач, ожидающих в брокере, по очередям (None - не удалось получить)"""
+    from backend_deposit.celery import app
+    result = {}
+    try:
+        with app.connection_for_read() as connection:
+            channel = connection.default_channel
+            for queue in queues:
+                try:
+                    result[queue] = channel.queue_declare(queue=queue, passive=True).message_count
+                except Exception:
+                    result[queue] = None
+    except Exception as err:
+        logger.warning(f'Не удалось получить длину очередей: {err}')
+        result = {queue: None for queue in queues}
+    return result
+
+
+def queue_lag_stats(minutes: int = 15, backlog: bool = True) -> dict:
+    """
+    Задержка по очередям за последние minutes минут:
+    {queue: {'count', 'avg_ms', 'max_ms', 'backlog', 'by_minute': {'10:05': [count, avg_ms, max_ms], ...}}}
+    """
+    now = timezone.localtime()
+    minute_list = [now - datetime.timedelta(minutes=i) for i in range(minutes)]
+    queues = queue_names()
+    backlogs = queue_backlog(queues) if backlog else {}
+    result = {}
+    for queue in queues:
+        keys = [_lag_key(queue, minute, field) for minute in minute_list for field in ('count', 'sum', 'max')]
+        values = cache.get_many(keys)
+        total_count = total_sum = total_max = 0
+        by_minute = {}
+        for minute in minute_list:
+            count = values.get(_lag_key(queue, minute, 'count'), 0)
+            lag_sum = values.get(_lag_key(queue, minute, 'sum'), 0)
+            lag_max = values.get(_lag_key(queue, minute, 'max'), 0)
+            by_minute[f'{minute:%H:%M}'] = [count, round(lag_sum / count) if count else 0, lag_max]
+            total_count += count
+            total_sum += lag_sum
+            total_max = max(total_max, lag_max)
+        result[queue] = {
+            'count': total_count,
+            'avg_ms': round(total_sum / total_count) if total_count else 0,
+            'max_ms': total_max,
+            'backlog': backlogs.get(queue),
+            'by_minute': by_minute,
+        }
+    return result
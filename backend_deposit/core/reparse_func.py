@@ -0,0 +1,189 @@
+"""
+Повторное распознавание мусора (TrashIncoming) после добавления нового шаблона смс.
+
+Мусор читается серверным курсором порциями, распознавание идет в пуле процессов
+(шаблоны - чистые функции, БД в дочерних процессах не используется). Распознанные смс
+проверяются на повторы так же, как при пакетном приеме (смс без времени - по всей истории),
+записываются bulk_create со временем добавления мусора и удаляются из мусора.
+Баланс сшивается с соседними записями получателя по времени смс: история получателя
+читается из БД один раз за прогон, в следующих порциях дочитываются только новые записи.
+"""
+import bisect
+import datetime
+import multiprocessing
+from collections import Counter, deque
+from itertools import islice
+
+import structlog
+from django.db import connections, transaction
+from django.db.models.functions import Upper
+
+from core.matcher_func import notify_new_incomings
+from deposit.models import Incoming, TrashIncoming, CardDayVolume
+
+logger = structlog.get_logger('deposit')
+
+REPARSE_CHUNK_SIZE = 2000
+
+
+def _chunks(iterable, size: int):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def _parse_rows(rows: list[tuple]) -> tuple[int, list[tuple]]:
+    """
+    Распознавание порции мусора (в дочернем процессе).
+    Возвращает (размер порции, [(id, текст, worker, тип, поля, ошибки, время мусора)] только распознанных)
+    """
+    from deposit.views_api import parse_sms
+    result = []
+    for pk, text, worker, register_date in rows:
+        text = (text or '').replace('\r\n', '\n').replace('\\n', '\n')
+        try:
+            text_sms_type, responsed_pay, errors = parse_sms(text, worker, received=register_date)
+        except Exception as err:
+            logger.warning(f'Ошибка распознавания мусора {pk}: {err}')
+            continue
+        if text_sms_type:
+            result.append((pk, text, worker, text_sms_type, responsed_pay, errors, register_date))
+    return len(rows), result
+
+
+def _incoming_order(response_date, balance, pk):
+    # Возрастающий порядок, обратный Incoming.calculate_balance_fields (response_date DESC NULLS FIRST, balance DESC, id DESC)
+    return response_date is None, response_date or datetime.datetime.min.replace(tzinfo=datetime.timezone.utc), \
+        balance is None, balance or 0, pk
+
+
+def _balance_row_order(row: list):
+    return _incoming_order(row[1], row[2], row[0])
+
+
+def rechain_balances(incomings: list[Incoming], history: dict | None = None) -> int:
+    """
+    Пересчет prev_balance/check_balance для вставленных в прошлое записей и записей, идущих сразу за ними.
+    Предыдущая запись - ближайшая раньше по (response_date, balance, id) с балансом у того же получателя.
+    history - записи получателей {получатель: {'rows', 'max_id'}}, общий для порций одного прогона:
+    вся история получателя читается один раз, дальше - только записи с id больше прочитанных.
+    Возвращает количество обновленных записей.
+    """
+    history = {} if history is None else history
+    inserted = {}
+    for incoming in incomings:
+        if incoming.recipient:
+            inserted.setdefault(incoming.recipient.upper(), set()).add(incoming.id)
+
+    changed = []
+    for recipient, inserted_ids in inserted.items():
+        queryset = Incoming.objects.annotate(recipient_upper=Upper('recipient')).filter(recipient_upper=recipient)
+        known = history.get(recipient)
+        if known is not None:
+            queryset = queryset.filter(id__gt=known['max_id'])
+        new_rows = [list(row) for row in queryset.values_list(
+            'id', 'response_date', 'balance', 'pay', 'prev_balance', 'check_balance')]
+        if known is None:
+            known = history[recipient] = {'rows': sorted(new_rows, key=_balance_row_order), 'max_id': 0}
+        else:
+            for row in new_rows:
+                bisect.insort(known['rows'], row, key=_balance_row_order)
+        known['max_id'] = max([known['max_id'], *(row[0] for row in new_rows)])
+
+        prev_balance = None
+        prev_id = None
+        for row in known['rows']:
+            pk, response_date, balance, pay, old_prev, old_check = row
+            if pk in inserted_ids or prev_id in inserted_ids:
+                check_balance = prev_balance + pay if prev_balance is not None else None
+                if (old_prev, old_check) != (prev_balance, check_balance):
+                    row[4], row[5] = prev_balance, check_balance
+                    changed.append(Incoming(id=pk, prev_balance=prev_balance, check_balance=check_balance))
+            if balance is not None:
+                prev_balance = balance
+                prev_id = pk
+    Incoming.objects.bulk_update(changed, ['prev_balance', 'check_balance'], batch_size=1000)
+    return len(changed)
+
+
+def _save_recognized(recognized: list[tuple], history: dict | None = None) -> tuple[int, int]:
+    """
+    Запись порции распознанного мусора: (создано, повторов). Распознанные удаляются из мусора.
+    register_date смс - время добавления мусора, а не время повторного распознавания.
+    """
+    from core.intake_func import remember_intake
+    from deposit.views_api import sms_dedup_parts, mark_sms_duplicates, build_sms_incomings
+    parsed = []
+    for pk, text, worker, text_sms_type, responsed_pay, errors, register_date in recognized:
+        dedup_parts, dedup_timeout = sms_dedup_parts(text_sms_type, responsed_pay)
+        parsed.append({'trash_id': pk, 'text': text, 'type': text_sms_type, 'pay': responsed_pay, 'worker': worker,
+                       'register_date': register_date, 'dedup_parts': dedup_parts, 'dedup_timeout': dedup_timeout})
+    # Мусор бывает старше окна повторов приема - смс без времени сверяются со всей историей
+    mark_sms_duplicates(parsed, no_time_window=None)
+    new_items = [item for item in parsed if not item.get('duplicate')]
+    incomings = build_sms_incomings(new_items, chain_balances=False)
+    with transaction.atomic():
+        # register_date - auto_now_add, bulk_create ставит текущее время: возвращаем время мусора
+        Incoming.objects.bulk_create(incomings)
+        for incoming, item in zip(incomings, new_items):
+            if item['register_date'] is not None:
+                incoming.register_date = item['register_date']
+        Incoming.objects.bulk_update(incomings, ['register_date'], batch_size=1000)
+        rechain_balances(incomings, history)
+        CardDayVolume.add_incomings(incomings)
+        notify_new_incomings(incomings)
+        TrashIncoming.objects.filter(id__in=[item['trash_id'] for item in parsed]).delete()
+    for item in parsed:
+        remember_intake('sms', *item['dedup_parts'], timeout=item['dedup_timeout'], first_only=True)
+    return len(incomings), len(parsed) - len(incomings)
+
+
+def reparse_trash(dry_run=True, processes: int = 1, chunk_size: int = REPARSE_CHUNK_SIZE,
+                  since_id: int | None = None) -> dict:
+    """
+    Повторное распознавание мусора.
+    dry_run - только отчет: сколько смс захватит каждый шаблон.
+    processes - процессов для распознавания (в celery-воркере только 1: дочерние процессы запрещены).
+    Возвращает отчет {'scanned', 'recognized', 'by_type', 'created', 'duplicates'}.
+    """
+    report = {'scanned': 0, 'recognized': 0, 'by_type': Counter(), 'created': 0, 'duplicates': 0}
+    queryset = TrashIncoming.objects.order_by('id')
+    if since_id:
+        queryset = queryset.filter(id__gt=since_id)
+    # Серверный курсор: таблица не загружается в память целиком
+    rows = queryset.values_list('id', 'text', 'worker', 'register_date').iterator(chunk_size=chunk_size)
+    # История балансов получателей - общая для всех порций прогона
+    history = {}
+
+    def handle(scanned, recognized):
+        report['scanned'] += scanned
+        report['recognized'] += len(recognized)
+        report['by_type'].update(item[3] for item in recognized)
+        if recognized and not dry_run:
+            created, duplicates = _save_recognized(recognized, history)
+            report['created'] += created
+            report['duplicates'] += duplicates
+
+    pool = None
+    if processes > 1:
+        # Соединения с БД не должны наследоваться дочерними процессами
+        connections.close_all()
+        pool = multiprocessing.Pool(processes)
+    try:
+        # Курсор читается и результаты пишутся в основном процессе, в пуле не больше 2 порций на процесс
+        pending = deque()
+        for chunk in _chunks(rows, chunk_size):
+            if pool is None:
+                handle(*_parse_rows(chunk))
+                continue
+            pending.append(pool.apply_async(_parse_rows, (chunk,)))
+            if len(pending) >= processes * 2:
+                handle(*pending.popleft().get())
+        while pending:
+            handle(*pending.popleft().get())
+    finally:
+        if pool:
+            pool.terminate()
+    report['by_type'] = dict(report['by_type'].most_common())
+    logger.info(f'Повторное распознавание мусора{" (проверка)" if dry_run else ""}: {report}')
+    return report
@@ -5,7 +5,8 @@ from dataclasses import dataclass
 import pytz
 import structlog
 
-from django.db.models import Sum, Count, Max, Q, F, Avg, Value, Subquery, OuterRef, Window, DateField
+from django.db.models import Sum, Count, Max, Q, F, Avg, Value, Subquery, OuterRef, Window, DateField, Aggregate, \
+    FloatField
 import seaborn as sns
 import pandas as pd
 import matplotlib
@@ -52,30 +53,108 @@ def bad_incomings():
     return result
 
 
-def cards_report() -> dict:
-    # Возвращает словарь со статистикой по картам
-    credit_cards = CreditCard.objects.all()
-    print(credit_cards)
-    one_month_ago = timezone.now() - datetime.timedelta(days=30)
-
-    cards = Incoming.objects.filter(
-        pay__gt=0,
-        recipient__iregex=r'\*\d\d\d\d',
-        register_date__gte=one_month_ago,
-    ).all().values('recipient').annotate(
-        count=Count('pk'),
-        sum=Sum('pay'),
-        last_date=Max('response_date'),
-        last_id=Max('pk'),
-        text=Subquery(credit_cards.filter(name=OuterRef('recipient')).values('text')),
-        number=Subquery(credit_cards.filter(name=OuterRef('recipient')).values('number')),
-        expire=Subquery(credit_cards.filter(name=OuterRef('recipient')).values('expire')),
-        cvv=Subquery(credit_cards.filter(name=OuterRef('recipient')).values('cvv')),
-        status=Subquery(credit_cards.filter(name=OuterRef('recipient')).values('status')),
-        card_id=Subquery(credit_cards.filter(name=OuterRef('recipient')).values('id')),
-    ).order_by('-last_date')
-
-    return cards
+CARDS_REPORT_DAYS = 30
+
+
+def refresh_cards_report(days: int = CARDS_REPORT_DAYS) -> int:
+    """
+    Пересчитывает сводку CardStat по поступлениям на карты за days дней.
+    Агрегация и привязка к CreditCard - один запрос с LEFT JOIN по имени карты.
+    Замена строк в одной транзакции: страница статистики всегда видит целую сводку.
+    """
+    from django.db import connection, transaction
+    from deposit.models import CardStat
+
+    period_start = timezone.now() - datetime.timedelta(days=days)
+    sql = f"""
+        SELECT i.recipient, COUNT(i.id), SUM(i.pay), MAX(i.response_date), MAX(i.id), MAX(c.id)
+        FROM {Incoming._meta.db_table} i
+        LEFT JOIN {CreditCard._meta.db_table} c ON c.name = i.recipient
+        WHERE i.pay > 0 AND i.recipient ~* %s AND i.register_date >= %s
+        GROUP BY i.recipient
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [r'\*\d\d\d\d', period_start])
+        rows = cursor.fetchall()
+    stats = [
+        CardStat(recipient=recipient, count=count, sum=pay_sum, last_date=last_date, last_id=last_id, card_id=card_id)
+        for recipient, count, pay_sum, last_date, last_id, card_id in rows
+    ]
+    with transaction.atomic():
+        CardStat.objects.exclude(recipient__in=[stat.recipient for stat in stats]).delete()
+        CardStat.objects.bulk_create(
+            stats,
+            update_conflicts=True,
+            unique_fields=['recipient'],
+            update_fields=['card', 'count', 'sum', 'last_date', 'last_id', 'refreshed_at'],
+        )
+    logger.info(f'Сводка по картам пересчитана: {len(stats)} карт')
+    return len(stats)
+
+
+def cards_report():
+    # Возвращает статистику по картам из сводки CardStat
+    from deposit.models import CardStat
+    if not CardStat.objects.exists():
+        refresh_cards_report()
+    return CardStat.objects.select_related('card').order_by('-last_date')
+
+
+def refresh_card_day_volume(days: int | None = 3) -> int:
+    """
+    Пересчитывает объемы CardDayVolume из Incoming за последние days дней (None - за все время).
+    Исправляет расхождения после правки/удаления поступлений. Возвращает количество строк.
+    Под монопольной блокировкой объемов: смс, добавленные во время пересчета, не теряются и не удваиваются.
+    """
+    from django.db import connection, transaction
+    from deposit.models import CardDayVolume
+
+    table = CardDayVolume._meta.db_table
+    params = [TIME_ZONE]
+    period_filter = ''
+    since = None
+    if days is not None:
+        since = timezone.localdate() - datetime.timedelta(days=days - 1)
+        period_filter = 'AND i.register_date >= %s'
+        params.append(TZ.localize(datetime.datetime.combine(since, datetime.time())))
+    sql = f"""
+        INSERT INTO {table} (recipient, day, count, sum, last_date)
+        SELECT i.recipient, (i.register_date AT TIME ZONE %s)::date AS day, COUNT(i.id), SUM(i.pay), MAX(i.response_date)
+        FROM {Incoming._meta.db_table} i
+        WHERE i.pay > 0 AND i.recipient IS NOT NULL AND i.recipient <> '' {period_filter}
+        GROUP BY 1, 2
+        ON CONFLICT (recipient, day) DO UPDATE SET
+            count = EXCLUDED.count, sum = EXCLUDED.sum, last_date = EXCLUDED.last_date
+    """
+    with transaction.atomic():
+        CardDayVolume.lock(exclusive=True)
+        stale = CardDayVolume.objects.all()
+        if since:
+            stale = stale.filter(day__gte=since)
+        stale.delete()
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            count = cursor.rowcount
+    logger.info(f'Объемы по картам пересчитаны с {since or "начала"}: {count} строк')
+    return count
+
+
+def card_detail_report(recipient: str, days: int = CARDS_REPORT_DAYS) -> dict:
+    """
+    Детализация по одной карте: итоги по дням и последние поступления.
+    Итоги - по дню времени платежа (response_date) из тех же поступлений, что и список, а не из
+    CardDayVolume: там день добавления в базу, и смс, пришедшая после полуночи, ушла бы в другой день.
+    """
+    period_start = timezone.now() - datetime.timedelta(days=days)
+    incomings = Incoming.objects.filter(pay__gt=0, recipient=recipient, register_date__gte=period_start)
+    by_day = incomings.annotate(
+        day=TruncDate('response_date', tzinfo=TZ)
+    ).values('day').annotate(count=Count('pk'), sum=Sum('pay')).order_by('-day')
+    return {
+        'card': CreditCard.objects.filter(name=recipient).first(),
+        'by_day': by_day,
+        'incomings': incomings.order_by('-id')[:100],
+    }
 
 
 @dataclass
@@ -435,37 +514,20 @@ def day_reports_birpay_confirm(days=30) -> dict:
         err_log.error(err, exc_info=True)
 
 
-def get_img_for_day_graph():
+def get_png_for_day_graph() -> bytes:
+    """PNG-график количества и суммы платежей по дням"""
     bad_incomings_query = bad_incomings()
     all_incomings = Incoming.objects.filter(pay__gt=0).all()
     result_incomings = all_incomings.exclude(pk__in=bad_incomings_query).all()
-    print(result_incomings.count())
-    df = pd.DataFrame(list(result_incomings.values()))
-    print(df)
+    df = pd.DataFrame(list(result_incomings.values('id', 'response_date', 'recipient', 'pay')))
     df['response_date'] = df['response_date'].dt.tz_convert("Europe/Moscow")
     stat = df[['id', 'response_date', 'recipient', 'pay']]
     stat['reg_hr'] = stat.response_date.dt.hour
     stat['date'] = stat['response_date'].dt.date
-    # stat = stat[stat['pay'] > 0]
     stat = stat[['id', 'date', 'reg_hr', 'pay']]
-    print(stat)
     day_stat = stat.groupby('date').agg({'pay': ['sum', 'count']})
     day_stat = day_stat.reindex()
 
-    # sns_plot = sns.barplot(data=day_stat, x='date', y=("pay", 'sum'))
-    # sns_plot.bar_label(sns_plot.containers[0])
-    # plot_file = BytesIO()
-    # figure = sns_plot.get_figure()
-    # figure.savefig(plot_file, format='png')
-    # encoded_file = base64.b64encode(plot_file.getvalue()).decode()
-    #
-    # sns_plot2 = sns.barplot(data=day_stat, x='date', y=("pay", 'count'))
-    # sns_plot2.bar_label(sns_plot2.containers[0])
-    # plot_file2 = BytesIO()
-    # figure2 = sns_plot2.get_figure()
-    # figure2.savefig(plot_file2, format='png')
-    # encoded_file2 = base64.b64encode(plot_file2.getvalue()).decode()
-
     import matplotlib.pyplot as plt
     fig, axes = plt.subplots(2, 1, figsize=(12, 12))
     axes[0].set_title("Количество платежей")
@@ -479,8 +541,124 @@ def get_img_for_day_graph():
     plt.subplots_adjust(hspace=0.5)
 
     plot_file = BytesIO()
-    figure = fig.get_figure()
-    figure.savefig(plot_file, format='png')
-    encoded_file = base64.b64encode(plot_file.getvalue()).decode()
+    fig.savefig(plot_file, format='png')
+    plt.close(fig)
+    return plot_file.getvalue()
 
+
+def get_img_for_day_graph():
+    encoded_file = base64.b64encode(get_png_for_day_graph()).decode()
     return encoded_file
+
+
+class Percentile(Aggregate):
+    """PERCENTILE_CONT(p) WITHIN GROUP (ORDER BY expr) для PostgreSQL"""
+    function = 'PERCENTILE_CONT'
+    name = 'Percentile'
+    output_field = FloatField()
+    template = '%(function)s(%(percentile)s) WITHIN GROUP (ORDER BY %(expressions)s)'
+
+    def __init__(self, expression, percentile, **extra):
+        super().__init__(expression, percentile=float(percentile), **extra)
+
+
+# Интервалы скорости подтверждения в минутах: [0, 5), [5, 10), [10, 15), [15, 60]
+SPEED_BUCKETS = (
+    ('0–5', '<5 минут', Q(delta_minutes__lt=5)),
+    ('5–10', '<10 минут', Q(delta_minutes__gte=5, delta_minutes__lt=10)),
+    ('10–15', '<15 минут', Q(delta_minutes__gte=10, delta_minutes__lt=15)),
+    ('15+', '≥15 минут', Q(delta_minutes__gte=15)),
+)
+
+
+def operator_speed_report(date_from: datetime.date, date_to: datetime.date | None = None) -> dict:
+    """
+    Скорость подтверждения заявок операторами за день или период.
+    Все агрегаты считаются в PostgreSQL (COUNT ... FILTER, PERCENTILE_CONT),
+    в python приходит только матрица 24x4 по часам и таблица по операторам.
+    Возвращает {'png': bytes | None, 'stat_table_data': list | None, 'stat_table_columns': list | None, 'no_data': bool}
+    """
+    import matplotlib.pyplot as plt
+    from django.db.models import ExpressionWrapper, DurationField
+    from django.db.models.functions import Extract
+    from deposit.models import BirpayOrder
+
+    date_to = date_to or date_from
+    result = {'png': None, 'stat_table_data': None, 'stat_table_columns': None, 'no_data': False}
+    qs = BirpayOrder.objects.annotate(
+        delta=ExpressionWrapper(
+            F('confirmed_time') - F('sended_at'),
+            output_field=DurationField()
+        )
+    ).filter(
+        sended_at__date__range=(date_from, date_to),
+        confirmed_operator__isnull=False,
+        confirmed_time__isnull=False,
+        delta__lte=datetime.timedelta(hours=1)
+    ).annotate(
+        delta_minutes=ExpressionWrapper(Extract('delta', 'epoch') / 60.0, output_field=FloatField()),
+    )
+    bucket_counts = {f'b{i}': Count('id', filter=q) for i, (_, _, q) in enumerate(SPEED_BUCKETS)}
+
+    # --- Матрица по часам ---
+    hourly_rows = qs.annotate(
+        hour=ExtractHour('sended_at', tzinfo=TZ)
+    ).values('hour').annotate(**bucket_counts).order_by('hour')
+    hourly = {row['hour']: [row[f'b{i}'] for i in range(len(SPEED_BUCKETS))] for row in hourly_rows}
+    if not hourly:
+        result['no_data'] = True
+        return result
+    matrix = [hourly.get(hour, [0] * len(SPEED_BUCKETS)) for hour in range(24)]
+
+    # --- Таблица по операторам ---
+    operator_rows = qs.values('confirmed_operator__username').annotate(
+        total=Count('id'),
+        p50=Percentile('delta_minutes', 0.5),
+        p90=Percentile('delta_minutes', 0.9),
+        **bucket_counts,
+    ).order_by('confirmed_operator__username')
+    labels = [label for label, _, _ in SPEED_BUCKETS]
+    stat_table_data = []
+    for row in operator_rows:
+        total = row['total']
+        record = {'Оператор': row['confirmed_operator__username'], 'Кол-во': total}
+        for i, label in enumerate(labels):
+            record[label] = round(row[f'b{i}'] / total * 100, 1)
+        record['p50, мин'] = round(row['p50'], 1)
+        record['p90, мин'] = round(row['p90'], 1)
+        stat_table_data.append(record)
+    # Сортировка по первому периоду (0–5)
+    stat_table_data.sort(key=lambda x: x['0–5'], reverse=True)
+    result['stat_table_data'] = stat_table_data
+    result['stat_table_columns'] = ['Оператор', 'Кол-во'] + labels + ['p50, мин', 'p90, мин']
+
+    # --- График ---
+    period = f'{date_from}' if date_from == date_to else f'{date_from} — {date_to}'
+    speed_colors = ['mediumseagreen', 'gold', 'tomato', 'lightgray']
+    fig, ax = plt.subplots(figsize=(14, 5))
+    bottom = [0] * 24
+    for i, (_, title, _) in enumerate(SPEED_BUCKETS):
+        values = [matrix[hour][i] for hour in range(24)]
+        ax.bar(range(24), values, bottom=bottom, color=speed_colors[i], label=title)
+        bottom = [b + v for b, v in zip(bottom, values)]
+    ax.set_xlabel('Час (МСК)')
+    ax.set_ylabel('Количество подтверждений')
+    ax.set_title(f'Подтверждения по часам (МСК) за {period}')
+    ax.set_xticks(range(24))
+    ax.set_xticklabels([str(h) for h in range(24)], rotation=0)
+    ax.legend(title='Время подтверждения')
+    plt.tight_layout()
+
+    # Подписи
+    for hour, vals in enumerate(matrix):
+        ax.text(
+            hour, sum(vals) + 0.5,
+            f"{vals[0]}/{vals[1]}/{vals[2]}",
+            ha='center', va='bottom', fontsize=11, fontweight='bold'
+        )
+
+    buf = BytesIO()
+    fig.savefig(buf, format='png')
+    plt.close(fig)
+    result['png'] = buf.getvalue()
+    return result
@@ -20,6 +20,7 @@ from deposit.models import (
     CardMonitoringStatus,
     Bank,
     RequsiteZajon,
+    TaskOutbox,
 )
 
 
@@ -91,6 +92,12 @@ class IncomingCheckAdmin(admin.ModelAdmin):
     raw_id_fields = ('incoming',)
 
 
+class TaskOutboxAdmin(admin.ModelAdmin):
+    list_display = ('id', 'created_at', 'task', 'args', 'kwargs', 'available_at', 'sent_at', 'attempts', 'retry_at',
+                    'failed_at')
+    list_filter = ('task',)
+
+
 class RePatternAdmin(admin.ModelAdmin):
     pass
 
@@ -157,3 +164,4 @@ admin.site.register(IncomingCheck, IncomingCheckAdmin)
 admin.site.register(RePattern, RePatternAdmin)
 admin.site.register(CardMonitoringStatus, CardMonitoringStatusAdmin)
 admin.site.register(RequsiteZajon, RequsiteZajonAdmin)
+admin.site.register(TaskOutbox, TaskOutboxAdmin)
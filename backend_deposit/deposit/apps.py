@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class DepositConfig(AppConfig):
@@ -6,4 +7,6 @@ class DepositConfig(AppConfig):
     name = 'deposit'
 
     def ready(self):
-        import deposit.models
\ No newline at end of file
+        import deposit.models
+        from core.db_func import ensure_search_indexes
+        post_migrate.connect(ensure_search_indexes, sender=self)
\ No newline at end of file
@@ -286,6 +286,18 @@ class PainterListForm(forms.Form):
 
 class OperatorStatsDayForm(forms.Form):
     date = forms.DateField(label='День', widget=forms.DateInput(attrs={'type': 'date'}))
+    date_to = forms.DateField(label='По (для периода)', required=False, widget=forms.DateInput(attrs={'type': 'date'}))
+
+    def clean(self):
+        cleaned_data = super().clean()
+        date_from = cleaned_data.get('date')
+        date_to = cleaned_data.get('date_to')
+        if date_from and date_to:
+            if date_to < date_from:
+                raise ValidationError('Конец периода раньше начала')
+            if date_to == date_from:
+                cleaned_data['date_to'] = None
+        return cleaned_data
 
 
 def luhn_check(card_number):
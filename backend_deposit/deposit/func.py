@@ -1,8 +1,11 @@
 import datetime
+import json
 
 import structlog
 from django.apps import apps
 
+from core.global_func import TZ, mask_compare
+
 logger = structlog.get_logger('deposit')
 
 def find_possible_incomings(order_amount, target_time_value, delta_before=2, delta_after=2):
@@ -18,4 +21,54 @@ def find_possible_incomings(order_amount, target_time_value, delta_before=2, del
         birpay_id__isnull=True,
     )
     logger.info(f'Найдены смс: {incomings}')
-    return incomings
\ No newline at end of file
+    return incomings
+
+
+def gpt_check_time(gpt_data) -> datetime.datetime:
+    # Время из чека GPT (МСК+1) в aware datetime
+    if isinstance(gpt_data, str):
+        gpt_data = json.loads(gpt_data)
+    gpt_time_str = (gpt_data or {}).get('create_at')
+    if not gpt_time_str:
+        gpt_time_str = '2000-01-01T00:00:00'
+    gpt_time_naive = datetime.datetime.fromisoformat(gpt_time_str)
+    gpt_time_naive_msk = gpt_time_naive - datetime.timedelta(hours=1)
+    return TZ.localize(gpt_time_naive_msk)
+
+
+def find_sms_for_order(order_amount, gpt_time, gpt_recipient, delta_before=2, delta_after=2) -> list:
+    # Свободные смс с суммой заявки, временем около чека и получателем из чека
+    incomings = find_possible_incomings(order_amount, gpt_time, delta_before, delta_after)
+    logger.info(f'Найдено смс с суммой: {len(incomings)}')
+    result = []
+    for incoming in incomings:
+        logger.info(f'Проверка СМС {incoming}')
+        sms_recipient = incoming.recipient
+        recipient_is_correct = mask_compare(sms_recipient, gpt_recipient)
+        logger.info(f'маски равны? {recipient_is_correct}. {sms_recipient} и {gpt_recipient} ')
+        logger.info(f'Cумма подходит {incoming.pay}: {order_amount == incoming.pay}:{order_amount} и {incoming.pay}')
+        if recipient_is_correct and order_amount == incoming.pay:
+            logger.info(f'СМС подходит: {incoming}')
+            result.append(incoming)
+        else:
+            logger.info(f'Смс не подходит: {incoming}')
+    return result
+
+
+def sms_balance_matches(incoming_sms) -> bool:
+    # Расчетный баланс смс совпадает с фактическим (check_balance вычисляется только при создании Incoming)
+    if incoming_sms.check_balance is None or incoming_sms.balance is None:
+        logger.info(f'balance_match: ❌ (нет данных: check_balance={incoming_sms.check_balance}, '
+                    f'balance={incoming_sms.balance})')
+        return False
+    # Округляем до 0.1 перед сравнением для учета погрешностей округления
+    check_balance_rounded = round(incoming_sms.check_balance * 10) / 10
+    balance_rounded = round(incoming_sms.balance * 10) / 10
+    balance_match = check_balance_rounded == balance_rounded
+    logger.info(f'Проверка баланса: check_balance={incoming_sms.check_balance} (округлено {check_balance_rounded}), '
+                f'balance={incoming_sms.balance} (округлено {balance_rounded}), совпадают={balance_match}')
+    if balance_match:
+        logger.info(f'balance_match: ✅')
+    else:
+        logger.info(f'balance_match: ❌ (расчетный {incoming_sms.check_balance} != фактический {incoming_sms.balance})')
+    return balance_match
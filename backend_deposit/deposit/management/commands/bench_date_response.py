@@ -0,0 +1,48 @@
+"""
+Микро-бенчмарк разбора даты смс (ocr.text_response_func.date_response) по всем форматам.
+Сравнивает с прежним разбором: fromisoformat и перебор strptime.
+"""
+import datetime
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from ocr.text_response_func import date_response, DATE_FORMATS, tz
+
+SAMPLES = {
+    'iso': '2023-08-22 15:17:19',
+    '%d/%m/%y %H:%M:%S': '03/10/23 19:55:27',
+    '%d.%m.%y %H:%M': '03.10.23 20:54',
+    '%H:%M %d.%m.%y': '20:08 30.06.24',
+    '%d %B %Y %H:%M': '05 March 2024 12:30',
+    '%d %B %Y%H:%M': '05 March 202412:30',
+    '%d.%m.%Y %H:%M': '03.10.2023 20:54',
+}
+
+
+def old_date_response(data_text: str):
+    try:
+        return tz.localize(datetime.datetime.fromisoformat(data_text.strip()) - datetime.timedelta(hours=1))
+    except ValueError:
+        pass
+    for date_format in DATE_FORMATS[1:]:
+        try:
+            return tz.localize(datetime.datetime.strptime(data_text.strip(), date_format) - datetime.timedelta(hours=1))
+        except ValueError:
+            pass
+
+
+class Command(BaseCommand):
+    help = 'Скорость разбора даты смс по каждому формату: прежний способ и date_response'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=20000, help='Повторов на формат')
+
+    def handle(self, *args, **options):
+        number = options['number']
+        self.stdout.write(f'{"Формат":<22}{"было, мкс":>12}{"стало, мкс":>12}{"ускорение":>12}')
+        for date_format, text in SAMPLES.items():
+            assert date_response(text) == old_date_response(text), text
+            old = timeit.timeit(lambda: old_date_response(text), number=number) / number * 1e6
+            new = timeit.timeit(lambda: date_response(text), number=number) / number * 1e6
+            self.stdout.write(f'{date_format:<22}{old:>12.2f}{new:>12.2f}{old / new:>11.1f}x')
@@ -0,0 +1,45 @@
+"""
+Команда для закрытия старых непроверенных IncomingCheck (checked_at пустой).
+Используется после перехода на пакетную проверку: история не должна уходить в birpay
+и в телеграм, проверяются только новые привязки.
+"""
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from deposit.models import IncomingCheck
+
+
+class Command(BaseCommand):
+    help = 'Отмечает проверенными IncomingCheck старше указанного количества часов без запроса в birpay'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hours',
+            type=int,
+            default=24,
+            help='Закрыть проверки, созданные раньше стольких часов назад',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Количество записей для обработки за раз',
+        )
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        threshold = now - datetime.timedelta(hours=options['hours'])
+        # Проверки без create_at пакетная проверка не берет - закрываются тоже
+        queryset = IncomingCheck.objects.filter(Q(create_at__lt=threshold) | Q(create_at__isnull=True),
+                                                checked_at__isnull=True)
+        closed = 0
+        while True:
+            ids = list(queryset.order_by('id').values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            closed += IncomingCheck.objects.filter(id__in=ids).update(checked_at=now)
+            self.stdout.write(f'Обработано до id {ids[-1]}, закрыто: {closed}')
+        self.stdout.write(self.style.SUCCESS(f'Готово. Закрыто проверок: {closed}'))
@@ -0,0 +1,43 @@
+"""
+Команда для заполнения recipient_prefix и recipient_suffix_rev у существующих записей Incoming.
+Используется после добавления полей (поиск поступлений по маскам карт).
+"""
+
+from django.core.management.base import BaseCommand
+
+from core.global_func import card_recipient_parts
+from deposit.models import Incoming
+
+
+class Command(BaseCommand):
+    help = 'Заполняет видимые цифры получателя (recipient_prefix, recipient_suffix_rev) для записей Incoming'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Количество записей для обработки за раз',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        queryset = Incoming.objects.exclude(recipient__isnull=True).exclude(recipient='').only(
+            'id', 'recipient', 'recipient_prefix', 'recipient_suffix_rev').order_by('id')
+        last_id = 0
+        updated = 0
+        while True:
+            batch = list(queryset.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            changed = []
+            for incoming in batch:
+                parts = card_recipient_parts(incoming.recipient)
+                if parts != (incoming.recipient_prefix, incoming.recipient_suffix_rev):
+                    incoming.recipient_prefix, incoming.recipient_suffix_rev = parts
+                    changed.append(incoming)
+            Incoming.objects.bulk_update(changed, ['recipient_prefix', 'recipient_suffix_rev'])
+            updated += len(changed)
+            last_id = batch[-1].id
+            self.stdout.write(f'Обработано до id {last_id}, обновлено: {updated}')
+        self.stdout.write(self.style.SUCCESS(f'Готово. Обновлено записей: {updated}'))
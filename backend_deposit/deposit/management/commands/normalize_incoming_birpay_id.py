@@ -0,0 +1,31 @@
+"""
+Команда для замены пустого birpay_id ('') на NULL у существующих записей Incoming.
+Используется после перехода поиска "только пустые" на birpay_id IS NULL.
+"""
+
+from django.core.management.base import BaseCommand
+
+from deposit.models import Incoming
+
+
+class Command(BaseCommand):
+    help = "Заменяет birpay_id='' на NULL для записей Incoming"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Количество записей для обработки за раз',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        updated = 0
+        while True:
+            ids = list(Incoming.objects.filter(birpay_id='').values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            updated += Incoming.objects.filter(id__in=ids).update(birpay_id=None)
+            self.stdout.write(f'Обновлено: {updated}')
+        self.stdout.write(self.style.SUCCESS(f'Готово. Обновлено записей: {updated}'))
@@ -0,0 +1,24 @@
+"""
+Команда для пересчета объемов по картам (CardDayVolume) из Incoming.
+Используется при первом заполнении таблицы и для исправления расхождений.
+"""
+
+from django.core.management.base import BaseCommand
+
+from core.stat_func import refresh_card_day_volume
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает объемы поступлений по картам и дням'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=None,
+            help='Пересчитать только последние N дней (по умолчанию - за все время)',
+        )
+
+    def handle(self, *args, **options):
+        count = refresh_card_day_volume(options['days'])
+        self.stdout.write(self.style.SUCCESS(f'Готово. Строк объемов: {count}'))
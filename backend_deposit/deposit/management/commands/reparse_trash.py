@@ -0,0 +1,53 @@
+"""
+Команда для повторного распознавания мусора (TrashIncoming) после добавления нового шаблона смс.
+По умолчанию - проверка без записи: сколько смс захватит каждый шаблон.
+"""
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.reparse_func import reparse_trash, REPARSE_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Повторно распознает мусор по текущим шаблонам смс'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--apply',
+            action='store_true',
+            help='Записать распознанные смс в Incoming и удалить их из мусора (без флага - только отчет)',
+        )
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Количество процессов для распознавания',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=REPARSE_CHUNK_SIZE,
+            help='Количество записей мусора в порции',
+        )
+        parser.add_argument(
+            '--since-id',
+            type=int,
+            default=None,
+            help='Обработать только мусор с id больше указанного',
+        )
+
+    def handle(self, *args, **options):
+        dry_run = not options['apply']
+        start = time.perf_counter()
+        report = reparse_trash(dry_run=dry_run, processes=options['processes'],
+                               chunk_size=options['chunk_size'], since_id=options['since_id'])
+        self.stdout.write(f'Просмотрено: {report["scanned"]}, распознано: {report["recognized"]}')
+        for sms_type, count in report['by_type'].items():
+            self.stdout.write(f'  {sms_type}: {count}')
+        if dry_run:
+            self.stdout.write(self.style.WARNING('Проверка без записи. Для записи запустите с --apply'))
+        else:
+            self.stdout.write(f'Создано: {report["created"]}, повторов: {report["duplicates"]}')
+        self.stdout.write(self.style.SUCCESS(f'Готово за {time.perf_counter() - start:.1f} c'))
@@ -0,0 +1,85 @@
+"""
+Нагрузочный тест распознавания скринов.
+Прогоняет папку скриншотов либо локально через пул процессов (ScreenOcrPipeline),
+либо отправкой на эндпоинт screen/ (--url), и печатает пропускную способность.
+"""
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+
+SCREEN_REGIONS = {
+    'first': {'y_start': 5, 'y_end': 10, 'x_start': 10, 'x_end': 100},
+    'amount': {'y_start': 12, 'y_end': 28},
+    'info': {'y_start': 28, 'y_end': 70, 'psm': 4},
+}
+
+
+def recognize_file(path: str) -> tuple[str, float]:
+    from ocr.ocr_func import ScreenOcrPipeline
+    start = time.perf_counter()
+    try:
+        pipeline = ScreenOcrPipeline(Path(path), black=182, white=255)
+        pipeline.read(SCREEN_REGIONS)
+        result = 'ok'
+    except Exception as err:
+        result = type(err).__name__
+    return result, time.perf_counter() - start
+
+
+def post_file(url: str, path: str, worker: str) -> tuple[str, float]:
+    start = time.perf_counter()
+    try:
+        with open(path, 'rb') as file:
+            response = requests.post(url, data={'name': Path(path).name, 'worker': worker},
+                                     files={'image': file}, timeout=60)
+        result = str(response.status_code)
+    except Exception as err:
+        result = type(err).__name__
+    return result, time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    help = 'Нагрузочный тест распознавания скринов: пропускная способность на процесс/ядро'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', type=str, help='Папка со скриншотами (*.jpg, *.png)')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Количество процессов/потоков')
+        parser.add_argument('--repeat', type=int, default=1, help='Сколько раз прогнать папку')
+        parser.add_argument('--url', type=str, default=None,
+                            help='Адрес эндпоинта screen/. Без него распознавание идет локально')
+        parser.add_argument('--worker-name', type=str, default='load_test', help='Поле worker в запросе')
+
+    def handle(self, *args, **options):
+        directory = Path(options['directory'])
+        files = sorted(str(path) for path in directory.iterdir() if path.suffix.lower() in ('.jpg', '.jpeg', '.png'))
+        if not files:
+            raise CommandError(f'В {directory} нет скриншотов')
+        files = files * options['repeat']
+        workers = options['workers']
+        url = options['url']
+
+        start = time.perf_counter()
+        if url:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(post_file, [url] * len(files), files,
+                                            [options['worker_name']] * len(files)))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(recognize_file, files))
+        elapsed = time.perf_counter() - start
+
+        statuses = Counter(result for result, _ in results)
+        latencies = sorted(latency for _, latency in results)
+        throughput = len(files) / elapsed
+        self.stdout.write(f'Скринов: {len(files)}, процессов/потоков: {workers}, время: {elapsed:.2f} c')
+        self.stdout.write(f'Результаты: {dict(statuses)}')
+        self.stdout.write(f'Задержка p50: {latencies[len(latencies) // 2]:.3f} c, '
+                          f'p90: {latencies[int(len(latencies) * 0.9)]:.3f} c, max: {latencies[-1]:.3f} c')
+        self.stdout.write(self.style.SUCCESS(
+            f'Пропускная способность: {throughput:.2f} скр/с, на процесс: {throughput / workers:.2f} скр/с'
+        ))
@@ -4,7 +4,7 @@ from enum import Flag, auto
 import structlog
 from django.contrib.postgres.fields import ArrayField
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db import models
+from django.db import models, connection, transaction
 from django.db.models import SET_NULL, Q
 
 from django.dispatch import receiver
@@ -12,12 +12,15 @@ from django.dispatch import receiver
 from django.db.models.signals import post_delete, post_save, pre_save
 from django.urls import reverse
 
+from django.utils import timezone
 from django.utils.html import format_html
 from colorfield.fields import ColorField
 from django_currentuser.middleware import get_current_authenticated_user
 from structlog.contextvars import bind_contextvars, clear_contextvars
 
-from core.global_func import send_message_tg, Timer
+from core.global_func import send_message_tg, Timer, card_recipient_parts
+from core.heartbeat_func import serial_from_image_name
+from core.matcher_func import notify_new_incomings
 from deposit.tasks import check_incoming
 from ocr.views_api import *
 from users.models import Options
@@ -176,17 +179,13 @@ class BirpayOrder(models.Model):
         # Проверяем предвычисленное значение, если оно есть (для оптимизации в списках)
         if hasattr(self, '_is_moshennik'):
             return self._is_moshennik
-        options = Options.load()
-        birpay_moshennik_list = options.birpay_moshennik_list
-        return self.merchant_user_id in birpay_moshennik_list
+        return self.merchant_user_id in Options.fraud_sets()[0]
     
     def is_painter(self):
         # Проверяем предвычисленное значение, если оно есть (для оптимизации в списках)
         if hasattr(self, '_is_painter'):
             return self._is_painter
-        options = Options.load()
-        birpay_painter_list = options.birpay_painter_list
-        return self.merchant_user_id in birpay_painter_list
+        return self.merchant_user_id in Options.fraud_sets()[1]
     
 class Incoming(models.Model):
 
@@ -197,6 +196,10 @@ class Incoming(models.Model):
     register_date = models.DateTimeField('Время добавления в базу', auto_now_add=True)
     response_date = models.DateTimeField('Распознанное время', null=True, blank=True, db_index=True)
     recipient = models.CharField('Получатель', max_length=50, null=True, blank=True)
+    # Видимые цифры получателя (card_visible_parts) для поиска по маскам карт индексом:
+    # цифры с начала и цифры с конца в обратном порядке - оба сравниваются по префиксу (LIKE 'x%' по индексу)
+    recipient_prefix = models.CharField(max_length=50, default='', blank=True, editable=False, db_index=True)
+    recipient_suffix_rev = models.CharField(max_length=50, default='', blank=True, editable=False, db_index=True)
     sender = models.CharField('Отравитель/карта', max_length=50, null=True, blank=True)
     pay = models.FloatField('Платеж', db_index=True)
     balance = models.FloatField('Баланс', null=True, blank=True)
@@ -221,6 +224,14 @@ class Incoming(models.Model):
             ("can_hand_edit", "Может делать ручные корректировки"),
             # ("can_see_bad_warning", "Видит уведомления о новых BadScreen"),
         ]
+        # Под фильтры поиска IncomingSearch (триграммный индекс birpay_id - core.db_func)
+        indexes = [
+            models.Index(fields=['worker', '-response_date'], name='incoming_worker_response_idx'),
+            models.Index(fields=['worker', '-register_date'], name='incoming_worker_register_idx'),
+            models.Index(fields=['pay', '-response_date'], name='incoming_pay_response_idx'),
+            models.Index(fields=['-response_date'], condition=Q(birpay_id__isnull=True),
+                         name='incoming_empty_birpay_idx'),
+        ]
 
     def get_absolute_url(self):
         return reverse('deposit:incoming_edit', kwargs={'pk': self.pk})
@@ -237,10 +248,7 @@ class Incoming(models.Model):
         """Достает серийные номер из пути изображения"""
         if not self.image:
             return None
-        from_part = self.image.name.split('_from_')
-        if len(from_part) == 2:
-            return from_part[1][:-4]
-        return 'unknown'
+        return serial_from_image_name(self.image.name) or 'unknown'
 
     def calculate_balance_fields(self):
         """Вычисляет prev_balance и check_balance на основе предыдущих записей для того же получателя"""
@@ -301,10 +309,21 @@ class Incoming(models.Model):
                     f'calculate_balance_fields: Incoming {self.id if self.pk else "NEW"}, предыдущая запись не найдена для recipient={recipient_normalized}'
                 )
 
-    def save(self, *args, **kwargs):
+    def normalize_fields(self):
+        """Нормализация полей перед записью (в save и перед bulk_create)"""
         # Нормализуем recipient перед сохранением (убираем лишние пробелы)
         if self.recipient:
             self.recipient = self.recipient.strip()
+        self.recipient_prefix, self.recipient_suffix_rev = card_recipient_parts(self.recipient)
+        # Пустой birpay_id храним как NULL (один вид пустого значения для индекса и поиска)
+        if self.birpay_id == '':
+            self.birpay_id = None
+
+    def save(self, *args, **kwargs):
+        self.normalize_fields()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'recipient' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'recipient_prefix', 'recipient_suffix_rev'}
         
         # Вычисляем prev_balance и check_balance ТОЛЬКО при создании новой записи
         # При изменении существующей записи баланс не пересчитывается
@@ -313,7 +332,16 @@ class Incoming(models.Model):
             self.calculate_balance_fields()
         
         # Сохраняем текущую запись
-        super().save(*args, **kwargs)
+        if not is_new_record:
+            super().save(*args, **kwargs)
+        else:
+            # Смс и ее объем одной транзакцией: пересчет объемов не посчитает смс дважды
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+                try:
+                    CardDayVolume.add_incoming(self)
+                except Exception as err:
+                    logger.error(f'Ошибка добавления в объем карты {self.recipient}: {err}')
         
         # Пересчет последующих записей не выполняется автоматически
         # (можно сделать через команду управления при необходимости)
@@ -361,9 +389,14 @@ class IncomingCheck(models.Model):
     pay_operator = models.FloatField(null=True, blank=True)
     pay_birpay = models.FloatField(null=True, blank=True)
     status = models.CharField(max_length=10, null=True, blank=True)
+    checked_at = models.DateTimeField('Время проверки в birpay', null=True, blank=True)
+    attempts = models.SmallIntegerField('Неудачных попыток проверки', default=0)
 
     class Meta:
         ordering = ('-id',)
+        indexes = [
+            models.Index(fields=['id'], condition=Q(checked_at__isnull=True), name='incoming_check_pending_idx'),
+        ]
 
 
 class Bank(models.Model):
@@ -452,17 +485,24 @@ def after_save_incoming(sender, instance: Incoming, created, raw, using, update_
             logger.debug(f'instance.worker: {instance.worker}')
             if instance.worker != 'base2':
                 user = get_current_authenticated_user()
+                # Проверку выполнит пакетом check_incomings_batch_task через INCOMING_CHECK_DELAY
                 new_check, _ = IncomingCheck.objects.get_or_create(
                     user=user,
                     incoming=instance,
                     birpay_id=instance.birpay_id,
                     pay_operator=instance.pay)
                 logger.info(f'new_check: {new_check.id} {new_check}')
-                check_incoming.apply_async(kwargs={'pk': new_check.id, 'count': 0}, countdown=60)
 
     except Exception as err:
         logger.error(err)
 
+    # Новая свободная смс, которую может ждать заявка после ответа GPT
+    if created and not instance.birpay_id:
+        try:
+            notify_new_incomings([instance])
+        except Exception as err:
+            logger.error(f'Ошибка постановки смс {instance.id} на сопоставление: {err}')
+
     # # Обработка прихода на нашу карту
     # if created:
     #     try:
@@ -570,6 +610,126 @@ class CreditCard(models.Model):
             return ''
 
 
+class CardStat(models.Model):
+    """
+    Сводка поступлений по картам за 30 дней для страницы статистики.
+    Пересчитывается задачей refresh_cards_report_task.
+    """
+    recipient = models.CharField('Карта', unique=True, max_length=50)
+    card = models.ForeignKey(CreditCard, on_delete=models.SET_NULL, null=True, blank=True, related_name='stats')
+    count = models.IntegerField('Кол-во', default=0)
+    sum = models.FloatField('Сумма', default=0)
+    last_date = models.DateTimeField('Посл. платеж', null=True, blank=True)
+    last_id = models.IntegerField('Посл. id', null=True, blank=True)
+    refreshed_at = models.DateTimeField('Время пересчета', auto_now=True)
+
+    class Meta:
+        ordering = ('-last_date',)
+
+    def __str__(self):
+        return f'CardStat({self.recipient}: {self.count} / {self.sum})'
+
+
+class CardDayVolume(models.Model):
+    """
+    Объем поступлений (pay > 0) по карте-получателю за день (по времени добавления).
+    Пополняется при создании Incoming, пересчитывается задачей refresh_card_day_volume_task.
+    Читается google_writer (детализация карты считает итоги по времени платежа из Incoming).
+    Пересчет и добавление согласованы advisory-блокировкой (lock): добавление идет в транзакции
+    создания смс и ждет идущий пересчет, пересчет ждет незавершенные добавления.
+    """
+    LOCK_KEY = 'card_day_volume'
+
+    recipient = models.CharField('Карта', max_length=50)
+    day = models.DateField('День')
+    count = models.IntegerField('Кол-во', default=0)
+    sum = models.FloatField('Сумма', default=0)
+    last_date = models.DateTimeField('Посл. платеж', null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['recipient', 'day'], name='card_day_volume_unique'),
+        ]
+        ordering = ('-day',)
+
+    def __str__(self):
+        return f'CardDayVolume({self.recipient} {self.day}: {self.count} / {self.sum})'
+
+    @classmethod
+    def lock(cls, exclusive=False):
+        """Блокировка объемов до конца транзакции: монопольная - пересчет, разделяемая - добавление"""
+        func = 'pg_advisory_xact_lock' if exclusive else 'pg_advisory_xact_lock_shared'
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT {func}(hashtext(%s))', [cls.LOCK_KEY])
+
+    @classmethod
+    def add_incoming(cls, incoming: 'Incoming'):
+        """Добавляет новое поступление в объем карты за день"""
+        cls.add_incomings([incoming])
+
+    @classmethod
+    def add_incomings(cls, incomings: list['Incoming']):
+        """Добавляет новые поступления в объемы карт: одна строка upsert на карту и день"""
+        volumes = {}
+        for incoming in incomings:
+            if not incoming.recipient or not incoming.pay or incoming.pay <= 0:
+                continue
+            key = (incoming.recipient, timezone.localtime(incoming.register_date).date())
+            count, pay_sum, last_date = volumes.get(key, (0, 0, None))
+            if incoming.response_date and (last_date is None or incoming.response_date > last_date):
+                last_date = incoming.response_date
+            volumes[key] = (count + 1, pay_sum + incoming.pay, last_date)
+        if not volumes:
+            return
+        table = cls._meta.db_table
+        sql = f"""
+            INSERT INTO {table} (recipient, day, count, sum, last_date) VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (recipient, day) DO UPDATE SET
+                count = {table}.count + EXCLUDED.count,
+                sum = {table}.sum + EXCLUDED.sum,
+                last_date = GREATEST({table}.last_date, EXCLUDED.last_date)
+        """
+        with transaction.atomic(), connection.cursor() as cursor:
+            cls.lock()
+            cursor.executemany(sql, [[recipient, day, *values] for (recipient, day), values in volumes.items()])
+
+
+
+class TaskOutbox(models.Model):
+    """
+    Очередь задач celery, записанная в одной транзакции с изменением данных (outbox).
+    Задачи ставятся через core.outbox_func.enqueue_task, в брокер их отправляет relay_outbox_task.
+    Пока задача не отправлена, повтор с тем же dedup_key не добавляется.
+    При ошибке отправки задача откладывается до retry_at, после OUTBOX_MAX_ATTEMPTS ошибок - failed_at
+    (больше не отправляется и не блокирует dedup_key).
+    """
+    task = models.CharField('Задача', max_length=255)
+    args = models.JSONField(default=list, blank=True)
+    kwargs = models.JSONField(default=dict, blank=True)
+    dedup_key = models.CharField('Ключ повтора', max_length=255, null=True, blank=True)
+    available_at = models.DateTimeField('Выполнить не раньше', default=timezone.now)
+    created_at = models.DateTimeField('Создана', auto_now_add=True)
+    sent_at = models.DateTimeField('Отправлена', null=True, blank=True)
+    attempts = models.IntegerField('Ошибок отправки', default=0)
+    last_error = models.TextField('Последняя ошибка', null=True, blank=True)
+    retry_at = models.DateTimeField('Повтор отправки не раньше', null=True, blank=True)
+    failed_at = models.DateTimeField('Отправка прекращена', null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['dedup_key'], condition=Q(sent_at__isnull=True, failed_at__isnull=True),
+                                    name='task_outbox_pending_dedup'),
+        ]
+        indexes = [
+            models.Index(fields=['id'], condition=Q(sent_at__isnull=True, failed_at__isnull=True),
+                         name='task_outbox_pending_idx'),
+            models.Index(fields=['sent_at'], name='task_outbox_sent_idx'),
+        ]
+
+    def __str__(self):
+        return f'TaskOutbox({self.id} {self.task} {self.args} {self.kwargs})'
+
+
 class UmTransaction(models.Model):
     order_id = models.CharField(unique=True, max_length=10)
     payment_id = models.CharField(unique=True, max_length=36, null=True, blank=True)
@@ -24,8 +24,15 @@ from core.asu_pay_func import create_asu_withdraw, create_payment_v2, \
     send_sms_code_v2, should_send_to_z_asu, send_birpay_order_to_z_asu, confirm_z_asu_transaction
 from core.birpay_func import get_birpay_withdraw, find_birpay_from_id, get_birpays, approve_birpay_refill
 from core.birpay_new_func import get_um_transactions, create_payment_data_from_new_transaction, send_transaction_action
-from core.global_func import send_message_tg, TZ, Timer, mask_compare
-from deposit.func import find_possible_incomings
+from core.global_func import send_message_tg, TZ, Timer, mask_compare, mask_compare_q
+from core.bind_func import bind_incoming_to_order
+from core.birpay_lookup_func import find_birpay, mark_birpay_synced
+from core.incoming_check_func import apply_incoming_check, incoming_check_message
+from core.outbox_func import enqueue_task
+from core.poll_func import adaptive_poller
+from core.matcher_func import (count_auto_approve, is_waiting_sms, register_waiting_order, notify_new_incomings,
+                               MATCHER_DELTA_BEFORE, MATCHER_DELTA_AFTER)
+from deposit.func import find_possible_incomings, gpt_check_time, find_sms_for_order, sms_balance_matches
 from deposit.models import *
 from django.apps import apps
 from users.models import Options
@@ -36,60 +43,59 @@ User = get_user_model()
 logger = structlog.get_logger('deposit')
 
 
-def find_time_between_good_screen(last_good_screen_time) -> int:
-    """Находит время сколько прошло с момента прихода распознанного скрина в секундах"""
-    now = datetime.datetime.now()
-    delta = int((now - last_good_screen_time).total_seconds())
-    logger.debug(f'Последний хороший скрин приходил {delta} секунд назад')
-    return delta
-
-
-def do_if_macros_broken():
+def do_if_macros_broken(device: str, delta: int):
     """Действие если макрос сдох"""
     try:
-        send_message_tg('Макрос не активен более 15 секунд', settings.ALARM_IDS)
+        send_message_tg(f'Макрос {device} не активен {delta} секунд', settings.ALARM_IDS)
         Message = apps.get_model('deposit', 'Message')
-        Message.objects.create(title='Макрос не активен',
-                               text=f'Макрос не активен',
+        Message.objects.create(title=f'Макрос {device} не активен',
+                               text=f'Макрос {device} не активен {delta} секунд',
                                type='macros',
                                author=User.objects.get(username='Admin'))
     except Exception as err:
         logger.error(f'Ошибка если макрос сдох: {err}')
 
 
+def seed_macros_devices(overwrite: bool = False):
+    """
+    Устройства и их последний скрин из поступлений за сутки - после очистки кэша.
+    overwrite - пульс из БД заменяет пульс в кэше (без общего кэша - на каждой проверке)
+    """
+    from core.heartbeat_func import seed_devices, serial_from_image_name
+    Incoming = apps.get_model('deposit', 'Incoming')
+    threshold = timezone.now() - datetime.timedelta(days=1)
+    screens = Incoming.objects.filter(register_date__gte=threshold).exclude(image='').exclude(image__isnull=True)
+    beats = {}
+    # Последний скрин каждого worker (индекс worker, -register_date)
+    for worker, image, register_date in screens.order_by('worker', '-register_date').distinct('worker').values_list(
+            'worker', 'image', 'register_date'):
+        device = serial_from_image_name(image) or worker
+        if device and (device not in beats or beats[device][1] < register_date.timestamp()):
+            beats[device] = (worker, register_date.timestamp())
+    seed_devices('screen', beats, overwrite=overwrite)
+
+
 @shared_task(priority=1, time_limit=20)
 def check_macros():
-    """Функция проверки работоспособности макроса"""
-    Setting = apps.get_model('deposit', 'Setting')
+    """Функция проверки работоспособности макросов: тревога по каждому устройству без скринов"""
+    from core.heartbeat_func import dead_devices, need_seed
     logger.info('Проверка макроса')
-    now = datetime.datetime.now()
-    last_good_screen_time_obj, _ = Setting.objects.get_or_create(name='last_good_screen_time')
-    if last_good_screen_time_obj.value:
-        last_good_screen_time = datetime.datetime.fromisoformat(last_good_screen_time_obj.value)
-    else:
-        last_good_screen_time = now
-        last_good_screen_time_obj.value = now.isoformat()
-        last_good_screen_time_obj.save()
-
-    last_message_time_obj, _ = Setting.objects.get_or_create(name='last_message_time')
-    if last_message_time_obj.value:
-        last_message_time = datetime.datetime.fromisoformat(last_message_time_obj.value)
-    else:
-        last_message_time = datetime.datetime(2000, 1, 1)
-    delta = find_time_between_good_screen(last_good_screen_time)
-    logger.debug(
-        f'last_message_time: {last_message_time}\nlast_good_screen_time: {last_good_screen_time}\ndelta:{delta}')
-    if last_message_time < last_good_screen_time and delta > 15:
-        logger.info(f'Время больше 10')
-        do_if_macros_broken()
-        last_message_time_obj.value = datetime.datetime.now().isoformat()
-        last_message_time_obj.save()
-        return True
+    if not settings.CACHE_SHARED:
+        # Пульс пишет веб-процесс, без общего кэша воркер его не видит - последний скрин берется из БД
+        seed_macros_devices(overwrite=True)
+    elif need_seed('screen'):
+        # БД читается только после потери кэша (и раз в сутки), а не на каждой проверке
+        seed_macros_devices()
+    dead = dead_devices('screen', settings.MACROS_HEARTBEAT_TIMEOUT)
+    for device, delta in dead.items():
+        logger.info(f'Макрос {device} не активен {delta} секунд')
+        do_if_macros_broken(device, delta)
+    return bool(dead)
 
 
 @shared_task(bind=True, priority=1, time_limit=15, max_retries=5)
 def check_incoming(self, pk, count=0):
-    """Функция проверки incoming в birpay"""
+    """Проверка одной привязки incoming в birpay (ручная перепроверка, обычно - check_incomings_batch_task)"""
     check = {}
     try:
         # Очищаем контекст в начале задачи
@@ -112,7 +118,7 @@ def check_incoming(self, pk, count=0):
                     )
             except Exception:
                 pass
-        check = find_birpay_from_id(birpay_id=incoming_check.birpay_id)
+        check = find_birpay(incoming_check.birpay_id)
     except Exception as err:
         logger.error(f'Ошибка проверки incoming в birpay: {err}')
         try:
@@ -123,52 +129,9 @@ def check_incoming(self, pk, count=0):
 
     try:
         logger.info(f'check result {count}: {check}')
-        msg = ''
-        if check:
-            pay_birpay = check.get('pay')
-            operator = check.get('operator')
-            if operator:
-                operator = operator.get('username')
-            status = check.get('status')
-
-            incoming_check.pay_birpay = pay_birpay
-            incoming_check.operator = operator
-            incoming_check.status = status
-            incoming_check.save()
-            pay_incoming = incoming_check.incoming.pay
-            text_incoming = f'Проверка платежа {incoming_check.incoming.id} на сумму {pay_incoming} azn.\nCheck №{pk} birpay_id: {incoming_check.birpay_id}:\n'
-            delta = round(pay_incoming - pay_birpay, 2)
-            if status == 0:
-                if pay_incoming == pay_birpay:
-                    # Не подтвержден. Сумма равна
-                    msg = f'{text_incoming}<b>Статус 0</b>'
-                elif pay_birpay < pay_incoming:
-                    # Не подтвержден. Пришло больше чем нужно
-                    msg = f'{text_incoming}<b>Статус 0. Пришло {pay_incoming} azn вместо {pay_birpay} azn (на {delta} больше)</b>'
-                else:
-                    # Не подтвержден. Пришло меньше чем нужно
-                    msg = f'{text_incoming}<b>Статус 0. Пришло {pay_incoming} azn вместо {pay_birpay} azn (на {-delta} меньше)</b>'
-            elif status == -1:
-                # Пришло больше
-                if pay_incoming > pay_birpay:
-                    msg = f'{text_incoming}<b>Статус -1. Лишние {delta} azn<>'
-            elif status == 1:
-                # Подтвержден
-                if pay_birpay > pay_incoming:
-                    # Пришло меньше
-                    msg = f'{text_incoming}<b>Статус 1. Не хватает {delta} azn {operator}</b>'
-                elif pay_birpay < pay_incoming:
-                    # Пришло больше
-                    msg = f'{text_incoming}<b>Статус 1. Лишние {delta} azn {operator}</b>'
-            else:
-                msg = f'{text_incoming}<b>Неизвестный статус {status}</b>'
-
-        else:
-            msg = (
-                f'<b>Ничего не найдено</b> при проверке birpay {pk}\n'
-                f'({incoming_check.birpay_id})\n'
-                f'Платеж {incoming_check.incoming.id} на сумму {incoming_check.incoming.pay} azn'
-            )
+        apply_incoming_check(incoming_check, check)
+        incoming_check.save()
+        msg = incoming_check_message(incoming_check, check)
         if msg:
             send_message_tg(msg, settings.ALARM_IDS)
         return check
@@ -225,6 +188,7 @@ def send_transaction_action_task(transaction_id, action):
 
 
 @shared_task(priority=1, time_limit=60)
+@adaptive_poller('um_transactions', changes=lambda result: result['new'])
 def send_new_transactions_from_um_to_asu_v2():
     countdown = 7
     # Получение новых um транзакций и их обработка
@@ -321,10 +285,11 @@ def send_new_transactions_from_um_to_asu_v2():
             raise err
 
     logger.debug(f'Обработка новых транзакций закончена за {time.perf_counter() - start}')
-    return f'Новых: {len(new_transactions)}'
+    return {'new': len(new_transactions)}
 
 
 @shared_task(priority=2, time_limit=30)
+@adaptive_poller('birpay_withdraw', changes=len)
 def send_new_transactions_from_birpay_to_asu():
     # Задача по запросу выплат с бирпая со статусом pending (0).
     logger = structlog.get_logger('deposit')
@@ -422,7 +387,7 @@ def download_birpay_check_file(self, order_id, check_file_url):
             merchant_transaction_id=order.merchant_transaction_id,
             birpay_order_id=order.id
         )
-        response = requests.get(check_file_url)
+        response = requests.get(check_file_url, timeout=15)
         if response.ok:
             file_content = response.content
             suffix_path = urlparse(check_file_url).path
@@ -445,8 +410,11 @@ def download_birpay_check_file(self, order_id, check_file_url):
                 if not order.is_painter():
                     order.gpt_processing = True
                     update_fields.append('gpt_processing')
-                    send_image_to_gpt_task.delay(order.birpay_id)
-            order.save(update_fields=update_fields)
+            with transaction.atomic():
+                order.save(update_fields=update_fields)
+                if 'gpt_processing' in update_fields:
+                    enqueue_task(send_image_to_gpt_task, args=[order.birpay_id],
+                                 dedup_key=f'send_image_to_gpt:{order.birpay_id}')
             # Очищаем контекст после успешного завершения
             clear_contextvars()
             return f"OK: {filename}"
@@ -524,8 +492,10 @@ def process_birpay_order(data):
 
     if check_file_url and not order.check_file and not order.check_file_failed:
         order.check_file_failed = True   # Резервируем скачивание — повторно не поставим
-        order.save(update_fields=['check_file_failed'])
-        download_birpay_check_file.delay(order.id, check_file_url)
+        with transaction.atomic():
+            order.save(update_fields=['check_file_failed'])
+            enqueue_task(download_birpay_check_file, args=[order.id, check_file_url],
+                         dedup_key=f'download_check:{order.id}')
         logger.info(f"Задача на скачивание файла для заказа {birpay_id} отправлена в celery.")
     
     # Логика Z-ASU: проверка условия и отправка на ASU
@@ -547,6 +517,61 @@ def process_birpay_order(data):
     return order, created, updated
 
 
+def _auto_bind_and_approve(order, incoming_sms, update_fields: list, bind_fields: dict | None = None) -> bool:
+    """
+    Привязка смс к заявке (bind_incoming_to_order) и подтверждение заявки в birpay.
+    update_fields - поля заявки для сохранения, дополняются полями привязки. False - смс или заявка уже заняты.
+    bind_fields - поля заявки, которые записываются только вместе с привязкой.
+    """
+    logger.info(
+        f'Попытка автоматического подтверждения {order} {order.merchant_transaction_id}: смс{incoming_sms.id}')
+
+    # Привязка с блокировкой смс и заявки: смс должна быть свободна, заявка - в pending.
+    # Поля GPT сохраняются вместе с привязкой
+    sms_bound_successfully = False
+    try:
+        order_fields = {field: getattr(order, field) for field in update_fields}
+        order_fields.update(bind_fields or {})
+        order_fields['incomingsms_id'] = incoming_sms.id
+        result = bind_incoming_to_order(incoming_sms.id, order.merchant_transaction_id, free_only=True,
+                                        require_pending=True, order_fields=order_fields)
+        if result.ok:
+            for field, value in (bind_fields or {}).items():
+                setattr(order, field, value)
+            update_fields.extend(bind_fields or {})
+            order.incomingsms_id = incoming_sms.id
+            order.incoming = result.incoming
+            order.confirmed_time = result.order.confirmed_time
+            update_fields.extend(['incomingsms_id', 'incoming', 'confirmed_time'])
+            logger.info(
+                f'Автоматическое подтверждение {order} {order.merchant_transaction_id}: смс{incoming_sms.id} успешно привязана')
+            sms_bound_successfully = True
+        else:
+            logger.warning(
+                f'Автоматическое подтверждение {order} {order.merchant_transaction_id} отменено: {result.error}')
+            # Сохраняем order с gpt_flags без привязки к SMS
+            order.save(update_fields=update_fields)
+    except IntegrityError as e:
+        # Защита на случай, если IntegrityError все же произошел
+        logger.error(
+            f'IntegrityError при привязке SMS {incoming_sms.id} к заказу {order} {order.merchant_transaction_id}: {e}. '
+            f'Возможно, SMS уже привязана к другому заказу.')
+        # Не вызываем approve_birpay_refill при ошибке привязки
+        # Обновляем только gpt_flags без привязки
+        order.save(update_fields=update_fields)
+        sms_bound_successfully = False
+
+    # Вызываем approve_birpay_refill только после успешной привязки SMS (вне транзакции)
+    # Это гарантирует, что только один поток сможет подтвердить заказ в Birpay API
+    if sms_bound_successfully:
+        response = approve_birpay_refill(pk=order.birpay_id)
+        if response.status_code != 200:
+            text = f"ОШИБКА пдтверждения {order} mtx_id {order.merchant_transaction_id}: {response.text}"
+            logger.warning(text)
+            send_message_tg(message=text, chat_ids=settings.ALARM_IDS)
+    return sms_bound_successfully
+
+
 @shared_task(bind=True, max_retries=2)
 def send_image_to_gpt_task(self, birpay_id):
     logger = structlog.get_logger('deposit')
@@ -608,12 +633,7 @@ def send_image_to_gpt_task(self, birpay_id):
             gpt_status = gpt_data.get('status', 0)
             gpt_recipient = gpt_data.get('recipient', '')
             gpt_sender = gpt_data.get('gpt_sender', '')
-            gpt_time_str = gpt_data.get('create_at')
-            if not gpt_time_str:
-                gpt_time_str = '2000-01-01T00:00:00'
-            gpt_time_naive = datetime.datetime.fromisoformat(gpt_time_str)
-            gpt_time_naive_msk = gpt_time_naive - datetime.timedelta(hours=1)
-            gpt_time_aware = TZ.localize(gpt_time_naive_msk)
+            gpt_time_aware = gpt_check_time(gpt_data)
 
             now = timezone.now()
             gpt_imho_result = BirpayOrder.GPTIMHO(0)
@@ -639,20 +659,8 @@ def send_image_to_gpt_task(self, birpay_id):
                 gpt_imho_result |= BirpayOrder.GPTIMHO.time
 
             # Найдем подходящие смс:
-            incomings = find_possible_incomings(order_amount, gpt_time_aware)
-            logger.info(f'Найдено смс с суммой: {len(incomings)}')
-            incomings_with_correct_card_and_order_amount = []
-            for incoming in incomings:
-                logger.info(f'Проверка СМС {incoming}')
-                sms_recipient = incoming.recipient
-                recipient_is_correct = mask_compare(sms_recipient, gpt_recipient)
-                logger.info(f'маски равны? {recipient_is_correct}. {sms_recipient} и {gpt_recipient} ')
-                logger.info(f'Cумма подходит {incoming.pay}: {order_amount == incoming.pay}:{order_amount} и {incoming.pay}')
-                if recipient_is_correct and order_amount == incoming.pay:
-                    logger.info(f'СМС подходит: {incoming}')
-                    incomings_with_correct_card_and_order_amount.append(incoming)
-                else:
-                    logger.info(f'Смс не подходит: {incoming}')
+            incomings_with_correct_card_and_order_amount = find_sms_for_order(
+                order_amount, gpt_time_aware, gpt_recipient)
             if len(incomings_with_correct_card_and_order_amount) == 0:
                 logger.info(f'Ни одна смс не подходит')
             if len(incomings_with_correct_card_and_order_amount) == 1:
@@ -662,20 +670,8 @@ def send_image_to_gpt_task(self, birpay_id):
                 gpt_imho_result |= BirpayOrder.GPTIMHO.sms
                 
                 # Проверка баланса: расчетный баланс должен соответствовать фактическому балансу из SMS
-                # Используем уже рассчитанные значения из БД (check_balance вычисляется только при создании Incoming)
-                if incoming_sms.check_balance is not None and incoming_sms.balance is not None:
-                    # Округляем до 0.1 перед сравнением для учета погрешностей округления
-                    check_balance_rounded = round(incoming_sms.check_balance * 10) / 10
-                    balance_rounded = round(incoming_sms.balance * 10) / 10
-                    balance_match = check_balance_rounded == balance_rounded
-                    logger.info(f'Проверка баланса: check_balance={incoming_sms.check_balance} (округлено {check_balance_rounded}), balance={incoming_sms.balance} (округлено {balance_rounded}), совпадают={balance_match}')
-                    if balance_match:
-                        gpt_imho_result |= BirpayOrder.GPTIMHO.balance_match
-                        logger.info(f'balance_match: ✅')
-                    else:
-                        logger.info(f'balance_match: ❌ (расчетный {incoming_sms.check_balance} != фактический {incoming_sms.balance})')
-                else:
-                    logger.info(f'balance_match: ❌ (нет данных: check_balance={incoming_sms.check_balance}, balance={incoming_sms.balance})')
+                if sms_balance_matches(incoming_sms):
+                    gpt_imho_result |= BirpayOrder.GPTIMHO.balance_match
             else:
                 logger.info(f'Однозначная смс не найдена')
             
@@ -712,68 +708,8 @@ def send_image_to_gpt_task(self, birpay_id):
             if not order.is_moshennik() and not order.is_painter() and gpt_auto_approve and order.gpt_flags == 255:
                 # Автоматическое подтверждение с защитой от race condition
                 incoming_sms = incomings_with_correct_card_and_order_amount[0]
-                logger.info(
-                    f'Попытка автоматического подтверждения {order} {order.merchant_transaction_id}: смс{incoming_sms.id}')
-                
-                # Используем транзакцию с блокировкой для предотвращения race condition
-                sms_bound_successfully = False
-                try:
-                    with transaction.atomic():
-                        # Блокируем SMS для обновления и проверяем, что она все еще свободна
-                        Incoming = apps.get_model('deposit', 'Incoming')
-                        locked_incoming = Incoming.objects.select_for_update().filter(
-                            id=incoming_sms.id,
-                            birpay_id__isnull=True
-                        ).first()
-                        
-                        if locked_incoming is None:
-                            # SMS уже привязана к другому заказу
-                            logger.warning(
-                                f'SMS {incoming_sms.id} уже привязана к другому заказу. '
-                                f'Автоматическое подтверждение {order} {order.merchant_transaction_id} отменено.')
-                            # Не устанавливаем флаги привязки, но сохраняем gpt_flags
-                            # Сохраняем order с gpt_flags без привязки к SMS
-                            order.save(update_fields=update_fields)
-                            sms_bound_successfully = False
-                        else:
-                            # SMS свободна, привязываем
-                            # Контекст уже установлен в начале функции со всеми идентификаторами
-                            order.incomingsms_id = locked_incoming.id
-                            update_fields.append("incomingsms_id")
-                            order.incoming = locked_incoming
-                            order.confirmed_time = timezone.now()
-                            update_fields.append("incoming")
-                            update_fields.append("confirmed_time")
-                            locked_incoming.birpay_id = order.merchant_transaction_id
-                            # Автоматически заполняем merchant_user_id из BirpayOrder
-                            locked_incoming.merchant_user_id = order.merchant_user_id
-                            locked_incoming.save()
-                            
-                            # Сохраняем order в транзакции
-                            order.save(update_fields=update_fields)
-                            
-                            logger.info(
-                                f'Автоматическое подтверждение {order} {order.merchant_transaction_id}: смс{locked_incoming.id} успешно привязана')
-                            sms_bound_successfully = True
-                            
-                except IntegrityError as e:
-                    # Защита на случай, если IntegrityError все же произошел
-                    logger.error(
-                        f'IntegrityError при привязке SMS {incoming_sms.id} к заказу {order} {order.merchant_transaction_id}: {e}. '
-                        f'Возможно, SMS уже привязана к другому заказу.')
-                    # Не вызываем approve_birpay_refill при ошибке привязки
-                    # Обновляем только gpt_flags без привязки
-                    order.save(update_fields=update_fields)
-                    sms_bound_successfully = False
-                
-                # Вызываем approve_birpay_refill только после успешной привязки SMS (вне транзакции)
-                # Это гарантирует, что только один поток сможет подтвердить заказ в Birpay API
-                if sms_bound_successfully:
-                    response = approve_birpay_refill(pk=order.birpay_id)
-                    if response.status_code != 200:
-                        text = f"ОШИБКА пдтверждения {order} mtx_id {order.merchant_transaction_id}: {response.text}"
-                        logger.warning(text)
-                        send_message_tg(message=text, chat_ids=settings.ALARM_IDS)
+                if _auto_bind_and_approve(order, incoming_sms, update_fields):
+                    count_auto_approve('direct')
             if order.is_moshennik():
                 logger.info(f'Обработка мошенника')
                 if len(incomings_with_correct_card_and_order_amount) == 1:
@@ -783,6 +719,12 @@ def send_image_to_gpt_task(self, birpay_id):
                     incoming_sms.save()
 
             order.save(update_fields=update_fields)
+            if gpt_auto_approve and is_waiting_sms(order):
+                # Не хватает только смс - привяжем, когда придет (match_incomings_task).
+                # Смс, пришедшие во время проверки, ставим на сопоставление сразу
+                register_waiting_order(order, gpt_time_aware)
+                notify_new_incomings(find_possible_incomings(order_amount, gpt_time_aware,
+                                                             MATCHER_DELTA_BEFORE, MATCHER_DELTA_AFTER))
 
         except ValueError as e:
             logger.warning(e)
@@ -796,19 +738,25 @@ def send_image_to_gpt_task(self, birpay_id):
 
 
 @shared_task(priority=1, time_limit=5)
+@adaptive_poller('birpay_refill')
 def refresh_birpay_data():
-
+    # Возвращает количество новых и измененных заявок
     birpay_data = get_birpays()
+    if birpay_data is None:
+        raise ConnectionError('birpay не вернул заявки')
+    changed = 0
     if birpay_data:
+        mark_birpay_synced(birpay_data)
         if settings.DEBUG:
             birpay_data = birpay_data[:10]
             logger.info(f'birpay_data: {birpay_data}')
         with Timer(f'Обработка birpay_data'):
             for row in birpay_data:
                 b_id = row.get('id')
-                result = process_birpay_order(row)
+                order, created, updated = process_birpay_order(row)
+                changed += bool(created or updated)
                 # logger.info(f'Обработка birpay_id {b_id}: {result}')
-    return len(birpay_data)
+    return changed
 
 
 @shared_task(priority=2, time_limit=30)
@@ -850,16 +798,10 @@ def check_cards_activity():
         for card_number in all_cards:
             # Проверяем, есть ли поступления на эту карту за последние X минут
             Incoming = apps.get_model('deposit', 'Incoming')
-            recent_incomings = Incoming.objects.filter(
+            # Соответствие маске карты проверяется в SQL по колонкам видимых цифр получателя
+            has_recent_activity = Incoming.objects.filter(
                 response_date__gte=threshold_time
-            ).exclude(recipient__isnull=True).exclude(recipient='')
-            
-            # Проверяем каждое поступление на соответствие маске карты
-            has_recent_activity = False
-            for incoming in recent_incomings:
-                if mask_compare(card_number, incoming.recipient):
-                    has_recent_activity = True
-                    break
+            ).exclude(recipient__isnull=True).exclude(recipient='').filter(mask_compare_q(card_number)).exists()
             
             if not has_recent_activity:
                 inactive_cards.append(card_number)
@@ -947,3 +889,130 @@ def confirm_z_asu_transaction_task(merchant_transaction_id):
     finally:
         # Очищаем контекст после завершения
         clear_contextvars()
+
+
+@shared_task(priority=3, time_limit=120)
+def render_chart_task(chart: str, chart_date: str | None = None, params: dict | None = None):
+    """Построение графика статистики в кэш"""
+    from core.chart_func import render_chart, record_chart_error
+    day = None
+    try:
+        day = datetime.date.fromisoformat(chart_date) if chart_date else None
+        with Timer(f'Построение графика {chart} {chart_date}'):
+            entry = render_chart(chart, day, params)
+        return entry['etag']
+    except Exception as err:
+        logger.error(f'Ошибка построения графика {chart} {chart_date}: {err}', exc_info=True)
+        record_chart_error(chart, day, params, err)
+
+
+@shared_task(priority=3, time_limit=300)
+def refresh_charts_task():
+    """Периодическое обновление графиков текущего дня, чтобы их не рисовали в запросе"""
+    from core.chart_func import CHART_DAY_GRAPH, CHART_OPERATOR_SPEED
+    today = timezone.now().astimezone(TZ).date()
+    render_chart_task.delay(CHART_DAY_GRAPH)
+    render_chart_task.delay(CHART_OPERATOR_SPEED, today.isoformat())
+
+
+@shared_task(priority=3, time_limit=120)
+def refresh_cards_report_task():
+    """Пересчет сводки по картам для страницы статистики"""
+    from core.stat_func import refresh_cards_report
+    with Timer('Пересчет сводки по картам'):
+        return refresh_cards_report()
+
+
+@shared_task(priority=3, time_limit=300)
+def refresh_card_day_volume_task(days: int = 3):
+    """Пересчет объемов по картам за последние дни (правки и удаления поступлений)"""
+    from core.stat_func import refresh_card_day_volume
+    with Timer('Пересчет объемов по картам'):
+        return refresh_card_day_volume(days)
+
+
+@shared_task(priority=1, time_limit=60)
+def process_screen_task(screen_id: str, path: str, name: str | None, worker: str | None, params: dict):
+    """Распознавание скрина, принятого эндпоинтом screen/ в очередь"""
+    from django.core.cache import cache
+    from django.core.files.base import ContentFile
+    from django.core.files.storage import default_storage
+    from deposit.views_api import recognize_screen, screen_ocr_release
+    result_key = f'screen_ocr_result:{screen_id}'
+    try:
+        with default_storage.open(path) as file:
+            image_bytes = file.read()
+        image = ContentFile(image_bytes, name=name or f'{screen_id}.jpg')
+        with Timer(f'Распознавание скрина {screen_id}'):
+            response = recognize_screen(image_bytes, image, name=name, worker=worker, **params)
+        result = {'status': response.status_code, 'reason': response.reason_phrase}
+    except Exception as err:
+        logger.error(f'Ошибка при обработке скрина {screen_id}: {err}', exc_info=True)
+        result = {'status': 400, 'reason': str(err)}
+    finally:
+        default_storage.delete(path)
+        screen_ocr_release()
+    cache.set(result_key, result, timeout=settings.SCREEN_OCR_RESULT_TTL)
+    return result
+
+
+@shared_task(priority=3, time_limit=1800)
+def reparse_trash_task(dry_run: bool = True, since_id: int | None = None):
+    """Повторное распознавание мусора после добавления шаблона смс (в воркере - один процесс)"""
+    from core.reparse_func import reparse_trash
+    with Timer('Повторное распознавание мусора'):
+        return reparse_trash(dry_run=dry_run, processes=1, since_id=since_id)
+
+
+@shared_task(priority=1, time_limit=60)
+def relay_outbox_task():
+    """Отправка задач из outbox в брокер (новые пачки - не дольше OUTBOX_RELAY_SECONDS, меньше time_limit)"""
+    from core.outbox_func import relay_outbox
+    return relay_outbox()
+
+
+@shared_task(priority=3, time_limit=300)
+def cleanup_outbox_task():
+    """Удаление отправленных задач outbox"""
+    from core.outbox_func import cleanup_outbox
+    return cleanup_outbox()
+
+
+@shared_task(priority=1, time_limit=60)
+def check_incomings_batch_task():
+    """Пакетная проверка привязок платежей к заявкам birpay"""
+    from core.incoming_check_func import process_incoming_checks
+    return process_incoming_checks()
+
+
+@shared_task(priority=1, time_limit=10)
+def adaptive_poll_tick():
+    """Запуск опросов birpay/UM с адаптивным интервалом (ADAPTIVE_POLLING)"""
+    if not settings.ADAPTIVE_POLLING:
+        return []
+    from core.poll_func import dispatch_due_pollers
+    return dispatch_due_pollers()
+
+
+@shared_task(priority=1, time_limit=60)
+def match_incomings_task(incoming_ids: list[int]):
+    """Привязка смс, пришедших позже ответа GPT, к ожидающим их заявкам"""
+    from core.matcher_func import late_match_orders, forget_waiting_order
+    Incoming = apps.get_model('deposit', 'Incoming')
+    BirpayOrder = apps.get_model('deposit', 'BirpayOrder')
+    approved = []
+    for incoming in Incoming.objects.filter(id__in=incoming_ids, birpay_id__isnull=True):
+        for order in late_match_orders(incoming):
+            bind_contextvars(birpay_id=order.birpay_id, merchant_transaction_id=order.merchant_transaction_id)
+            logger.info(f'Смс {incoming.id} пришла после ответа GPT по {order.merchant_transaction_id}')
+            # Флаги смс - только вместе с привязкой: без нее заявка остается в ожидании смс
+            gpt_flags = (BirpayOrder.GPTIMHO(order.gpt_flags)
+                         | BirpayOrder.GPTIMHO.sms | BirpayOrder.GPTIMHO.balance_match).value
+            bound = _auto_bind_and_approve(order, incoming, [], bind_fields={'gpt_flags': gpt_flags})
+            clear_contextvars()
+            if bound:
+                forget_waiting_order(order)
+                count_auto_approve('late')
+                approved.append(order.merchant_transaction_id)
+                break
+    return approved
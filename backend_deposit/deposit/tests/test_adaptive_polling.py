@@ -0,0 +1,66 @@
+"""
+Тесты адаптивного интервала опросов birpay/UM
+"""
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from core.poll_func import adaptive_poller, dispatch_due_pollers, poller_stats
+
+POLLERS = {'test': {'task': 'deposit.tasks.refresh_birpay_data', 'min': 2, 'max': 16}}
+
+
+@override_settings(ADAPTIVE_POLLERS=POLLERS)
+class AdaptivePollingTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def interval(self):
+        return poller_stats()['test']['interval']
+
+    def test_interval_follows_changes_and_errors(self):
+        results = iter([0, 0, 0, 0, 0, 0, 3])
+
+        @adaptive_poller('test')
+        def poll():
+            return next(results)
+
+        @adaptive_poller('test')
+        def failing_poll():
+            raise ConnectionError('birpay down')
+
+        # Без изменений интервал растет до max
+        for _ in range(6):
+            poll()
+        self.assertEqual(self.interval(), 16)
+        # Изменения - опрос чаще
+        poll()
+        self.assertEqual(self.interval(), 8)
+        self.assertEqual(poller_stats()['test']['last_changes'], 3)
+        # Ошибки - backoff, не больше max
+        for errors in (1, 2):
+            with self.assertRaises(ConnectionError):
+                failing_poll()
+            self.assertEqual(poller_stats()['test']['errors'], errors)
+        self.assertEqual(self.interval(), 16)
+
+    @patch('core.poll_func.time.perf_counter', side_effect=[0, 10])
+    def test_interval_not_shorter_than_processing(self, perf_counter):
+        adaptive_poller('test')(lambda: 5)()
+        self.assertEqual(self.interval(), 15)
+
+    @patch('core.poll_func.current_app.send_task')
+    def test_dispatch_due_once(self, send_task):
+        self.assertEqual(dispatch_due_pollers(), ['test'])
+        # Пока опрос выполняется, повторно не ставится
+        self.assertEqual(dispatch_due_pollers(), [])
+        send_task.assert_called_once_with('deposit.tasks.refresh_birpay_data')
+
+        adaptive_poller('test')(lambda: 1)()
+        stats = poller_stats()['test']
+        self.assertFalse(stats['running'])
+        # Следующий опрос через интервал с разбросом ±10%
+        self.assertTrue(2 * 0.9 <= stats['next_in'] <= 2 * 1.1)
+        self.assertEqual(dispatch_due_pollers(), [])
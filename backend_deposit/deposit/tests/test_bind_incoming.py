@@ -0,0 +1,98 @@
+"""
+Тесты единой привязки смс к заявке birpay
+"""
+from unittest.mock import patch
+
+import pytest
+from django.contrib.auth import get_user_model
+from django.db import DatabaseError
+from django.test import TestCase
+from django.utils import timezone
+
+from core.bind_func import bind_incoming_to_order
+from deposit.models import BirpayOrder, Incoming, IncomingChange
+
+User = get_user_model()
+
+
+@pytest.mark.django_db
+class BindIncomingTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='operator', email='operator@test.com', password='pass',
+                                             is_staff=True)
+        now = timezone.now()
+        self.orders = [
+            BirpayOrder.objects.create(
+                birpay_id=i, created_at=now, updated_at=now, merchant_transaction_id=f'MTX{i}',
+                merchant_user_id=f'USER{i}', status=0, amount=100.0, raw_data={})
+            for i in (1, 2)
+        ]
+        self.incoming = Incoming.objects.create(recipient='1234****5678', pay=100.0, balance=500.0, type='sms')
+
+    def test_bind_writes_both_sides_and_history(self):
+        result = bind_incoming_to_order(self.incoming.id, ' MTX1 ', self.user, free_only=True,
+                                        order_fields={'status': 1, 'confirmed_operator': self.user})
+        self.assertTrue(result.ok, result.error)
+        self.incoming.refresh_from_db()
+        order = BirpayOrder.objects.get(birpay_id=1)
+        self.assertEqual((self.incoming.birpay_id, self.incoming.merchant_user_id), ('MTX1', 'USER1'))
+        self.assertEqual((order.incoming_id, order.status, order.confirmed_operator), (self.incoming.id, 1, self.user))
+        self.assertEqual(order.confirmed_time, self.incoming.birpay_confirm_time)
+        self.assertEqual(list(IncomingChange.objects.values_list('val_name', 'new_val')), [('birpay_id', 'MTX1')])
+
+        # Свободной смс больше нет
+        self.assertFalse(bind_incoming_to_order(self.incoming.id, 'MTX2', free_only=True).ok)
+
+    def test_repeat_bind_keeps_confirmed_time(self):
+        bind_incoming_to_order(self.incoming.id, 'MTX1')
+        confirmed_time = BirpayOrder.objects.get(birpay_id=1).confirmed_time
+        result = bind_incoming_to_order(self.incoming.id, 'MTX1', order_fields={'status': 1})
+        self.assertTrue(result.ok, result.error)
+        self.assertFalse(result.changed)
+        order = BirpayOrder.objects.get(birpay_id=1)
+        self.assertEqual((order.confirmed_time, order.status), (confirmed_time, 1))
+
+    def test_write_failure_after_confirm_is_reported(self):
+        confirmed = []
+        with patch.object(IncomingChange.objects, 'create', side_effect=DatabaseError('db down')):
+            result = bind_incoming_to_order(self.incoming.id, 'MTX1', self.user,
+                                            confirm=lambda order: confirmed.append(order.pk))
+        self.assertFalse(result.ok)
+        self.assertTrue(result.confirmed)
+        self.assertIn('подтверждена в birpay', result.error)
+        self.assertEqual(len(confirmed), 1)
+        self.incoming.refresh_from_db()
+        self.assertIsNone(self.incoming.birpay_id)
+        self.assertIsNone(BirpayOrder.objects.get(birpay_id=1).incoming_id)
+
+        # Без confirm ошибка записи не скрывается
+        with patch.object(IncomingChange.objects, 'create', side_effect=DatabaseError('db down')):
+            with self.assertRaises(DatabaseError):
+                bind_incoming_to_order(self.incoming.id, 'MTX1', self.user)
+
+    def test_rebind_unbinds_previous_order(self):
+        bind_incoming_to_order(self.incoming.id, 'MTX1')
+        result = bind_incoming_to_order(self.incoming.id, 'MTX2')
+        self.assertTrue(result.ok, result.error)
+        self.assertEqual(result.unbound_order.merchant_transaction_id, 'MTX1')
+        self.assertIsNone(BirpayOrder.objects.get(birpay_id=1).incoming_id)
+        self.assertEqual(BirpayOrder.objects.get(birpay_id=2).incoming_id, self.incoming.id)
+
+        result = bind_incoming_to_order(self.incoming.id, '')
+        self.assertTrue(result.ok)
+        self.incoming.refresh_from_db()
+        self.assertEqual((self.incoming.birpay_id, self.incoming.merchant_user_id), (None, None))
+        self.assertIsNone(BirpayOrder.objects.get(birpay_id=2).incoming_id)
+
+    def test_validation_errors(self):
+        other = Incoming.objects.create(recipient='1234****5678', pay=50.0, type='sms')
+        bind_incoming_to_order(other.id, 'MTX1')
+        self.assertIn('не найден', bind_incoming_to_order(self.incoming.id, 'MTX9').error)
+        self.assertIn(f'Incoming ID {other.id}', bind_incoming_to_order(self.incoming.id, 'MTX1').error)
+        self.assertIn('отличаются', bind_incoming_to_order(other.id, 'MTX2', check_amount=True).error)
+        BirpayOrder.objects.filter(birpay_id=2).update(status=1)
+        self.assertIn('pending', bind_incoming_to_order(self.incoming.id, 'MTX2', require_pending=True).error)
+        self.incoming.refresh_from_db()
+        self.assertIsNone(self.incoming.birpay_id)
+        self.assertFalse(IncomingChange.objects.exists())
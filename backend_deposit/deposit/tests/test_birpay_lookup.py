@@ -0,0 +1,71 @@
+"""
+Тесты поиска заявок birpay сначала в локальной копии
+"""
+import datetime
+from unittest.mock import patch
+
+import pytest
+from django.core.cache import cache
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from core.birpay_lookup_func import (mark_birpay_synced, find_birpay, actual_order_status, birpay_lookup_stats,
+                                     BIRPAY_SYNC_KEY)
+from deposit.models import BirpayOrder
+
+
+@pytest.mark.django_db
+@override_settings(DEBUG=False, BIRPAY_LOCAL_MAX_AGE=30)
+class BirpayLookupTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        now = timezone.now()
+        self.order = BirpayOrder.objects.create(
+            birpay_id=1, created_at=now, updated_at=now, merchant_transaction_id='111', merchant_user_id='u1',
+            status=0, amount=10, operator='oper1', raw_data={})
+        mark_birpay_synced([{'createdAt': (now - datetime.timedelta(minutes=5)).isoformat()}])
+
+    def hits(self, source):
+        return sum(birpay_lookup_stats(hours=1)[source].values())
+
+    @patch('core.birpay_lookup_func.find_birpay_from_id')
+    def test_fresh_mirror_answers_locally(self, find_birpay_from_id):
+        check = find_birpay('111')
+        self.assertEqual((check['status'], check['pay'], check['operator']), (0, 10, {'username': 'oper1'}))
+        self.assertEqual(actual_order_status(self.order), 0)
+        find_birpay_from_id.assert_not_called()
+        self.assertEqual((self.hits('local'), self.hits('remote')), (2, 0))
+
+    @patch('core.birpay_lookup_func.find_birpay_from_id', return_value={'status': 1, 'pay': 10, 'operator': None})
+    def test_stale_mirror_goes_to_api(self, find_birpay_from_id):
+        sync = cache.get(BIRPAY_SYNC_KEY)
+        sync['time'] -= datetime.timedelta(seconds=31)
+        cache.set(BIRPAY_SYNC_KEY, sync)
+
+        self.assertEqual(find_birpay('111')['status'], 1)
+        # Статус из birpay сохраняется в локальную копию
+        self.assertEqual(actual_order_status(self.order), 1)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 1)
+        self.assertEqual(find_birpay_from_id.call_count, 2)
+        self.assertEqual((self.hits('local'), self.hits('remote')), (0, 2))
+
+    def test_sync_mark_parses_z_and_skips_bad_values(self):
+        mark_birpay_synced([{'createdAt': '2024-01-01T10:00:00.000Z'}, {'createdAt': 'вчера'},
+                            {'createdAt': '2024-13-01T10:00:00'}, {'createdAt': None}])
+        self.assertEqual(cache.get(BIRPAY_SYNC_KEY)['oldest'],
+                         datetime.datetime(2024, 1, 1, 10, tzinfo=datetime.timezone.utc))
+
+    def test_stats_views_reject_bad_period(self):
+        user = get_user_model().objects.create_user(username='staff', email='staff@test.com', password='pass',
+                                                    is_staff=True)
+        self.client.force_login(user)
+        for name, param in (('intake_dedup_stats', 'hours'), ('birpay_lookup_stats', 'hours'),
+                            ('queue_lag', 'minutes'), ('auto_approve_stats', 'hours')):
+            url = reverse(f'deposit:{name}')
+            for value in ('abc', '0', '-3'):
+                self.assertEqual(self.client.get(url, {param: value}).status_code, 400, (name, value))
+        self.assertEqual(len(self.client.get(reverse('deposit:birpay_lookup_stats'), {'hours': 100}).json()['local']), 48)
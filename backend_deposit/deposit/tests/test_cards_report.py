@@ -0,0 +1,59 @@
+"""
+Тесты сводки статистики по картам
+"""
+import datetime
+
+import pytest
+from django.db import connection
+from django.test import TestCase
+from django.utils import timezone
+
+from core.stat_func import refresh_cards_report, cards_report, refresh_card_day_volume, card_detail_report
+from deposit.models import Incoming, CreditCard, CardStat, CardDayVolume
+
+
+@pytest.mark.django_db
+class CardsReportTest(TestCase):
+
+    def setUp(self):
+        self.card = CreditCard.objects.create(name='*1111', number='4169 0000 0000 1111', status='active')
+        for recipient, pay in [('*1111', 10), ('*1111', 20), ('*2222', 5), ('*2222', -3), ('no_card', 100)]:
+            Incoming.objects.create(response_date=timezone.now(), recipient=recipient, sender='sender', pay=pay,
+                                    balance=1000, type='sms')
+
+    def test_refresh_joins_cards(self):
+        self.assertEqual(refresh_cards_report(), 2)
+        stat = CardStat.objects.get(recipient='*1111')
+        self.assertEqual((stat.count, stat.sum, stat.card), (2, 30, self.card))
+        self.assertIsNone(CardStat.objects.get(recipient='*2222').card)
+
+    def test_refresh_replaces_stale_rows(self):
+        CardStat.objects.create(recipient='*9999', count=1, sum=1)
+        refresh_cards_report()
+        self.assertEqual(set(cards_report().values_list('recipient', flat=True)), {'*1111', '*2222'})
+
+    def test_day_volume_follows_inserts(self):
+        volumes = {row.recipient: (row.count, row.sum) for row in CardDayVolume.objects.all()}
+        self.assertEqual(volumes, {'*1111': (2, 30), '*2222': (1, 5), 'no_card': (1, 100)})
+
+        CardDayVolume.objects.filter(recipient='*1111').update(count=0, sum=0)
+        refresh_card_day_volume(days=1)
+        volumes_after = {row.recipient: (row.count, row.sum) for row in CardDayVolume.objects.all()}
+        self.assertEqual(volumes_after, volumes)
+
+    def advisory_locks(self) -> set[str]:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT mode FROM pg_locks WHERE locktype = 'advisory' AND pid = pg_backend_pid()")
+            return {mode for mode, in cursor.fetchall()}
+
+    def test_volume_writes_respect_refresh_lock(self):
+        # Добавление объемов держит разделяемую блокировку до конца транзакции смс, пересчет - монопольную
+        self.assertEqual(self.advisory_locks(), {'ShareLock'})
+        refresh_card_day_volume(days=1)
+        self.assertEqual(self.advisory_locks(), {'ShareLock', 'ExclusiveLock'})
+
+    def test_card_detail_groups_by_payment_day(self):
+        paid = timezone.localtime() - datetime.timedelta(days=1)
+        Incoming.objects.create(response_date=paid, recipient='*1111', sender='sender', pay=7, balance=1000, type='sms')
+        by_day = {row['day']: (row['count'], row['sum']) for row in card_detail_report('*1111')['by_day']}
+        self.assertEqual(by_day, {timezone.localdate(): (2, 30), paid.date(): (1, 7)})
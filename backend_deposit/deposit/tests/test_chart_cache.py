@@ -0,0 +1,118 @@
+"""
+Тесты кэша графиков статистики
+"""
+import datetime
+from unittest.mock import patch
+
+import pytest
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase, Client
+from django.urls import reverse
+
+from core.chart_func import CHART_OPERATOR_SPEED, chart_cache_key, render_chart, request_chart
+from core.global_func import TZ
+from core.stat_func import operator_speed_report
+from deposit.models import BirpayOrder
+from deposit.tasks import render_chart_task
+
+User = get_user_model()
+
+
+@pytest.mark.django_db
+class ChartCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='staff', email='staff@test.com', password='testpass123', is_staff=True)
+        self.client = Client()
+        self.client.force_login(self.user)
+        self.day = datetime.date(2025, 1, 1)
+
+    def test_cache_key_depends_on_date_and_params(self):
+        key = chart_cache_key(CHART_OPERATOR_SPEED, self.day)
+        self.assertNotEqual(key, chart_cache_key(CHART_OPERATOR_SPEED, self.day + datetime.timedelta(days=1)))
+        self.assertNotEqual(key, chart_cache_key(CHART_OPERATOR_SPEED, self.day, {'x': 1}))
+        self.assertEqual(chart_cache_key(CHART_OPERATOR_SPEED, self.day, {'a': 1, 'b': 2}),
+                         chart_cache_key(CHART_OPERATOR_SPEED, self.day, {'b': 2, 'a': 1}))
+
+    @patch('deposit.tasks.render_chart_task.delay')
+    def test_request_chart_enqueues_once(self, delay):
+        self.assertIsNone(request_chart(CHART_OPERATOR_SPEED, self.day))
+        self.assertIsNone(request_chart(CHART_OPERATOR_SPEED, self.day))
+        delay.assert_called_once_with(CHART_OPERATOR_SPEED, '2025-01-01', None)
+
+    @patch('deposit.tasks.render_chart_task.delay')
+    def test_view_shows_placeholder_then_cached_result(self, delay):
+        url = reverse('deposit:operator_speed_graph') + '?date=2025-01-01'
+        response = self.client.get(url)
+        self.assertTrue(response.context['rendering'])
+
+        render_chart(CHART_OPERATOR_SPEED, self.day)
+        response = self.client.get(url)
+        self.assertFalse(response.context['rendering'])
+        self.assertTrue(response.context['no_data'])
+        delay.assert_called_once()
+
+    @patch('core.stat_func.operator_speed_report')
+    def test_chart_image_etag(self, report):
+        report.return_value = {'png': b'png-bytes', 'stat_table_data': [], 'stat_table_columns': [], 'no_data': False}
+        entry = render_chart(CHART_OPERATOR_SPEED, self.day)
+        url = reverse('deposit:chart_image', kwargs={'chart': CHART_OPERATOR_SPEED}) + '?date=2025-01-01'
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'png-bytes')
+        self.assertEqual(response['ETag'], f'"{entry["etag"]}"')
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=f'"{entry["etag"]}"')
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=f'"other", W/"{entry["etag"]}"')
+        self.assertEqual(response.status_code, 304)
+        # Часть тега не совпадение
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=f'"{entry["etag"][:-1]}x{entry["etag"]}"')
+        self.assertEqual(response.status_code, 200)
+
+    @patch('core.stat_func.operator_speed_report', side_effect=RuntimeError('нет данных'))
+    def test_render_error_is_shown(self, report):
+        url = reverse('deposit:operator_speed_graph') + '?date=2025-01-01'
+        with patch('deposit.tasks.render_chart_task.delay', side_effect=render_chart_task):
+            response = self.client.get(url)
+        self.assertFalse(response.context['rendering'])
+        self.assertEqual(response.context['render_error'], 'нет данных')
+
+        # Пока ошибка в кэше, задача повторно не ставится
+        with patch('deposit.tasks.render_chart_task.delay') as delay:
+            response = self.client.get(url)
+            delay.assert_not_called()
+        self.assertContains(response, 'Ошибка построения графика')
+
+
+@pytest.mark.django_db
+class OperatorSpeedReportTest(TestCase):
+
+    def setUp(self):
+        self.operator = User.objects.create_user(username='operator', email='op@test.com', password='testpass123')
+        base = TZ.localize(datetime.datetime(2025, 1, 1, 10, 0))
+        # Задержки подтверждения в минутах
+        for num, minutes in enumerate([1, 2, 7, 12, 20, 90]):
+            order = BirpayOrder.objects.create(
+                birpay_id=1000 + num, created_at=base, updated_at=base, merchant_transaction_id=f'MTX{num}',
+                merchant_user_id='USER', merchant_name='Merchant', customer_name='Customer', card_number='1234',
+                status=1, amount=10, raw_data={}, confirmed_operator=self.operator,
+                confirmed_time=base + datetime.timedelta(minutes=minutes),
+            )
+            BirpayOrder.objects.filter(pk=order.pk).update(sended_at=base)
+
+    def test_report_buckets_and_percentiles(self):
+        day = datetime.date(2025, 1, 1)
+        result = operator_speed_report(day)
+        self.assertFalse(result['no_data'])
+        self.assertTrue(result['png'])
+        row = result['stat_table_data'][0]
+        # Заявка с задержкой больше часа не учитывается
+        self.assertEqual(row['Кол-во'], 5)
+        self.assertEqual([row[label] for label in ('0–5', '5–10', '10–15', '15+')], [40.0, 20.0, 20.0, 20.0])
+        self.assertEqual(row['p50, мин'], 7.0)
+        self.assertEqual(operator_speed_report(day, day + datetime.timedelta(days=3))['stat_table_data'][0]['Кол-во'], 5)
+        self.assertTrue(operator_speed_report(day + datetime.timedelta(days=1))['no_data'])
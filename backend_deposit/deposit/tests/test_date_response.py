@@ -0,0 +1,40 @@
+"""
+Тесты разбора даты смс
+"""
+import datetime
+
+from django.test import SimpleTestCase
+
+from ocr.text_response_func import date_response, tz
+
+SAMPLES = {
+    '2023-08-22 15:17:19': datetime.datetime(2023, 8, 22, 14, 17, 19),
+    '03/10/23 19:55:27': datetime.datetime(2023, 10, 3, 18, 55, 27),
+    '03.10.23 20:54': datetime.datetime(2023, 10, 3, 19, 54),
+    '20:08 30.06.24': datetime.datetime(2024, 6, 30, 19, 8),
+    '05 March 2024 12:30': datetime.datetime(2024, 3, 5, 11, 30),
+    '05 March 202412:30': datetime.datetime(2024, 3, 5, 11, 30),
+    '03.10.2023 20:54': datetime.datetime(2023, 10, 3, 19, 54),
+}
+
+
+class DateResponseTest(SimpleTestCase):
+
+    def test_all_formats(self):
+        # Дважды: второй раз формат берется из запомненного для такого вида строки
+        for _ in range(2):
+            for text, expected in SAMPLES.items():
+                self.assertEqual(date_response(f' {text} '), tz.localize(expected), text)
+
+    def test_any_whitespace_between_parts(self):
+        self.assertEqual(date_response('03.10.2023  20:54'), tz.localize(datetime.datetime(2023, 10, 3, 19, 54)))
+        self.assertEqual(date_response('03.10.23\t20:54'), tz.localize(datetime.datetime(2023, 10, 3, 19, 54)))
+
+    def test_iso_offset_is_kept(self):
+        result = date_response('2023-08-22T15:17:19+04:00')
+        self.assertEqual(result, datetime.datetime(2023, 8, 22, 11, 17, 19, tzinfo=datetime.timezone.utc))
+        self.assertEqual(result.tzinfo.zone, tz.zone)
+
+    def test_invalid_date(self):
+        self.assertIsNone(date_response('31.02.23 10:00'))
+        self.assertIsNone(date_response('not a date'))
@@ -0,0 +1,136 @@
+"""
+Тесты пульса макросов
+"""
+import datetime
+import time
+from unittest.mock import patch
+
+import pytest
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from core.heartbeat_func import heartbeat, last_seen, need_seed, serial_from_image_name
+from deposit.models import Incoming
+from deposit.tasks import check_macros
+
+
+@pytest.mark.django_db
+@override_settings(MACROS_HEARTBEAT_TIMEOUT=15, CACHE_SHARED=True)
+class HeartbeatTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_serial_from_image_name(self):
+        self.assertEqual(serial_from_image_name('2024-01-01_from_R58M123.jpg'), 'R58M123')
+        self.assertIsNone(serial_from_image_name('screen.jpg'))
+
+    def test_last_seen_per_device(self):
+        heartbeat('screen', 'phone1', 'R58M123')
+        heartbeat('screen', 'phone2', None)
+        # Тот же телефон без серийного номера - то же устройство
+        heartbeat('screen', 'phone1')
+        self.assertEqual(set(last_seen('screen')), {'phone1 (R58M123)', 'phone2'})
+        self.assertEqual(last_seen('sms'), {})
+
+    @patch('deposit.tasks.do_if_macros_broken')
+    def test_alert_once_per_dead_device(self, broken):
+        need_seed('screen')
+        heartbeat('screen', 'phone1', timestamp=time.time() - 60)
+        heartbeat('screen', 'phone2')
+        self.assertTrue(check_macros())
+        broken.assert_called_once()
+        self.assertEqual(broken.call_args.args[0], 'phone1')
+
+        # Повторно по тому же простою не сообщаем
+        self.assertFalse(check_macros())
+        self.assertEqual(broken.call_count, 1)
+
+        # Устройство ожило и снова замолчало - новая тревога
+        heartbeat('screen', 'phone1', timestamp=time.time() - 30)
+        self.assertTrue(check_macros())
+        self.assertEqual(broken.call_count, 2)
+
+    @patch('deposit.tasks.do_if_macros_broken')
+    def test_seed_restores_devices_once(self, broken):
+        incoming = Incoming.objects.create(worker='phone1', image='screens/2024-01-01_from_R58M123.jpg',
+                                           pay=10.0, recipient='1234', type='screen')
+        Incoming.objects.filter(pk=incoming.pk).update(register_date=timezone.now() - datetime.timedelta(minutes=5))
+        # Телефон алертит один раз - по серийному номеру, а не по worker и серийному номеру отдельно
+        self.assertTrue(check_macros())
+        broken.assert_called_once()
+        self.assertEqual(broken.call_args.args[0], 'phone1 (R58M123)')
+
+        heartbeat('screen', 'phone1', 'R58M123')
+        with self.assertNumQueries(0):
+            self.assertFalse(check_macros())
+        self.assertEqual(set(last_seen('screen')), {'phone1 (R58M123)'})
+
+
+class FakeRedis:
+    """Множества redis для проверки ветки SADD/SREM"""
+
+    def __init__(self):
+        self.sets = {}
+
+    def sadd(self, key, *members):
+        self.sets.setdefault(key, set()).update(member.encode() for member in members)
+
+    def srem(self, key, *members):
+        self.sets.get(key, set()).difference_update(member.encode() for member in members)
+
+    def smembers(self, key):
+        return set(self.sets.get(key, set()))
+
+
+@pytest.mark.django_db
+class HeartbeatRedisTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_devices_in_redis_set(self):
+        redis = FakeRedis()
+        with patch('core.heartbeat_func.cache_redis_client', return_value=redis):
+            heartbeat('screen', 'phone1', 'R58M123')
+            heartbeat('screen', 'phone2')
+            self.assertEqual(redis.smembers(cache.make_key('heartbeat_devices:screen')), {b'R58M123', b'phone2'})
+            cache.delete('heartbeat:screen:phone2')
+            self.assertEqual(set(last_seen('screen')), {'phone1 (R58M123)'})
+            self.assertEqual(redis.smembers(cache.make_key('heartbeat_devices:screen')), {b'R58M123'})
+
+
+@pytest.mark.django_db
+@override_settings(MACROS_HEARTBEAT_TIMEOUT=15, CACHE_SHARED=False)
+class HeartbeatLocalCacheTest(TestCase):
+    """Веб и воркер с разными локальными кэшами: воркер берет пульс из БД"""
+
+    def setUp(self):
+        cache.clear()
+        self.worker_cache = LocMemCache('heartbeat-worker', {})
+
+    def screen(self, seconds_ago: int):
+        incoming = Incoming.objects.create(worker='phone1', image='screens/2024-01-01_from_R58M123.jpg',
+                                           pay=10.0, recipient='1234', type='screen')
+        Incoming.objects.filter(pk=incoming.pk).update(
+            register_date=timezone.now() - datetime.timedelta(seconds=seconds_ago))
+
+    @patch('deposit.tasks.do_if_macros_broken')
+    def test_worker_sees_screens_from_db(self, broken):
+        # Веб-процесс отмечает пульс в своем кэше
+        heartbeat('screen', 'phone1', 'R58M123')
+        self.screen(seconds_ago=60)
+        with patch('core.heartbeat_func.cache', self.worker_cache):
+            self.assertTrue(check_macros())
+            self.assertEqual(broken.call_args.args[0], 'phone1 (R58M123)')
+            self.assertFalse(check_macros())
+
+            # Новый скрин в БД - устройство живо, следующий простой снова сообщается
+            self.screen(seconds_ago=1)
+            self.assertFalse(check_macros())
+            Incoming.objects.filter(register_date__gte=timezone.now() - datetime.timedelta(seconds=10)).update(
+                register_date=timezone.now() - datetime.timedelta(seconds=30))
+            self.assertTrue(check_macros())
+        self.assertEqual(broken.call_count, 2)
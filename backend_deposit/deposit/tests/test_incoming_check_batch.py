@@ -0,0 +1,79 @@
+"""
+Тесты пакетной проверки привязок в birpay
+"""
+import datetime
+from io import StringIO
+from unittest.mock import patch
+
+import pytest
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from core.birpay_lookup_func import mark_birpay_synced
+from core.incoming_check_func import process_incoming_checks
+from deposit.models import BirpayOrder, Incoming, IncomingCheck, TaskOutbox
+
+
+@pytest.mark.django_db
+@patch('core.incoming_check_func.send_message_tg')
+class IncomingCheckBatchTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        now = timezone.now()
+        BirpayOrder.objects.create(
+            birpay_id=1, created_at=now, updated_at=now, merchant_transaction_id='111', merchant_user_id='u1',
+            status=1, amount=10, operator='oper1', raw_data={})
+        self.checks = []
+        for birpay_id, pay in (('111', 10), ('222', 20), ('333', 30)):
+            incoming = Incoming.objects.create(recipient='4127***6869', pay=pay)
+            incoming.birpay_id = birpay_id
+            incoming.save()
+            self.checks.append(incoming.checks.get())
+        IncomingCheck.objects.update(create_at=now - datetime.timedelta(minutes=2))
+
+    def test_binding_only_creates_check(self, send_message_tg):
+        self.assertEqual(len(self.checks), 3)
+        self.assertFalse(TaskOutbox.objects.exists())
+
+    @patch('core.birpay_lookup_func.find_birpay_from_id', return_value=None)
+    @patch('core.birpay_lookup_func.get_birpays')
+    def test_local_then_one_remote_query(self, get_birpays, find_birpay_from_id, send_message_tg):
+        mark_birpay_synced([{'createdAt': (timezone.now() - datetime.timedelta(hours=1)).isoformat()}])
+        get_birpays.return_value = [
+            {'merchantTransactionId': '222', 'status': 0, 'amount': '25', 'operator': None},
+        ]
+        result = process_incoming_checks()
+        self.assertEqual((result['checked'], result['found']), (3, 2))
+        get_birpays.assert_called_once()
+        find_birpay_from_id.assert_called_once_with(birpay_id='333')
+
+        local, remote, missing = IncomingCheck.objects.filter(id__in=[c.id for c in self.checks]).order_by('id')
+        self.assertEqual((local.status, local.operator, local.pay_birpay), ('1', 'oper1', 10))
+        self.assertEqual((remote.status, remote.pay_birpay), ('0', 25))
+        self.assertIsNone(missing.status)
+        self.assertFalse(IncomingCheck.objects.filter(checked_at__isnull=True).exists())
+
+        # Одно сообщение на проход: расхождение по 222 и не найденный 333
+        send_message_tg.assert_called_once()
+        self.assertIn('333', send_message_tg.call_args.args[0])
+        self.assertEqual(process_incoming_checks(), {'checked': 0})
+
+    @patch('core.birpay_lookup_func.get_birpays', side_effect=ConnectionError('birpay down'))
+    def test_stale_sync_and_error_keeps_checks(self, get_birpays, send_message_tg):
+        result = process_incoming_checks()
+        self.assertIn('error', result)
+        self.assertEqual(set(IncomingCheck.objects.values_list('attempts', flat=True)), {1})
+        self.assertFalse(IncomingCheck.objects.filter(checked_at__isnull=False).exists())
+
+    @patch('core.incoming_check_func.find_birpays', return_value=({}, set()))
+    def test_newest_first_and_old_checks_closed(self, find_birpays, send_message_tg):
+        process_incoming_checks(limit=1)
+        self.assertEqual(find_birpays.call_args.args[0], {'333'})
+
+        IncomingCheck.objects.filter(id=self.checks[0].id).update(create_at=timezone.now() - datetime.timedelta(days=2))
+        call_command('close_incoming_checks', hours=24, stdout=StringIO())
+        self.assertEqual(set(IncomingCheck.objects.filter(checked_at__isnull=True).values_list('birpay_id', flat=True)),
+                         {'222'})
@@ -0,0 +1,58 @@
+"""
+Тесты поиска платежей
+"""
+from unittest.mock import patch
+
+import pytest
+from django.contrib.auth import get_user_model
+from django.test import TestCase, Client
+from django.urls import reverse
+
+from core.db_func import EstimatedCountPaginator
+from deposit.models import Incoming
+
+User = get_user_model()
+
+
+@pytest.mark.django_db
+class IncomingSearchTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='staff', email='staff@test.com', password='pass',
+                                             is_staff=True, is_superuser=True)
+        self.client = Client()
+        self.client.force_login(self.user)
+        self.empty = Incoming.objects.create(recipient='4127***6869', pay=10, birpay_id='')
+        self.confirmed = Incoming.objects.create(recipient='4127***6869', pay=10, birpay_id='123456789')
+
+    def test_empty_birpay_id_stored_as_null(self):
+        self.empty.refresh_from_db()
+        self.assertIsNone(self.empty.birpay_id)
+
+    def test_only_empty_and_part_of_birpay_id(self):
+        response = self.client.get(reverse('deposit:incomings_search'), {'only_empty': 1, 'pay': 10})
+        self.assertEqual([obj.id for obj in response.context['page_obj']], [self.empty.id])
+
+        response = self.client.get(reverse('deposit:incomings_search'), {'pk': '4567'})
+        self.assertEqual([obj.id for obj in response.context['page_obj']], [self.confirmed.id])
+
+    def test_estimated_count(self):
+        queryset = Incoming.objects.order_by('-response_date')
+        with patch('core.db_func.ESTIMATE_COUNT_THRESHOLD', -1):
+            paginator = EstimatedCountPaginator(queryset, 50)
+            self.assertGreaterEqual(paginator.count, 1)
+            self.assertTrue(paginator.estimated)
+        paginator = EstimatedCountPaginator(queryset, 50)
+        self.assertEqual(paginator.count, 2)
+        self.assertFalse(paginator.estimated)
+
+    def test_overestimated_count_clamps_to_last_page(self):
+        queryset = Incoming.objects.order_by('-response_date')
+        with patch('core.db_func.estimate_count', return_value=500), \
+                patch('core.db_func.ESTIMATE_COUNT_THRESHOLD', 1):
+            paginator = EstimatedCountPaginator(queryset, 1)
+            self.assertEqual(paginator.num_pages, 500)
+            page = paginator.page(7)
+            self.assertEqual((page.number, paginator.count, paginator.num_pages), (2, 2, 2))
+            self.assertFalse(paginator.estimated)
+            self.assertEqual(len(page), 1)
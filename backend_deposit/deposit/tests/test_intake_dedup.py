@@ -0,0 +1,59 @@
+"""
+Тесты отсечения повторов смс по кэшу
+"""
+import datetime
+from unittest.mock import patch
+
+import pytest
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from core.intake_func import intake_dedup_stats, intake_seen, remember_intake
+from deposit.models import Incoming
+from deposit.views_api import analyse_sms_text_and_save, no_time_dedup_timeout
+
+SMS = ('Imtina:Bloklanmish kart\nKart:4127***6869\nTarix:2023-08-22 15:17:19\n'
+       'Mercant:P2P SEND- LEO APP\nMebleg:29.00 AZN\nBalans:569.51 AZN')
+
+
+@pytest.mark.django_db
+class IntakeDedupTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    @override_settings(CACHE_SHARED=True)
+    def test_seen_counts_hits(self):
+        self.assertIsNone(intake_seen('screen', 'tx1'))
+        remember_intake('screen', 'tx1', value='incoming')
+        self.assertEqual(intake_seen('screen', 'tx1'), 'incoming')
+        self.assertEqual(intake_seen('screen', 'tx1'), 'incoming')
+        self.assertEqual(sum(intake_dedup_stats(hours=1)['screen'].values()), 2)
+
+    def test_hits_not_counted_without_shared_cache(self):
+        remember_intake('screen', 'tx1', value='incoming')
+        self.assertEqual(intake_seen('screen', 'tx1'), 'incoming')
+        stats = intake_dedup_stats(hours=1)
+        self.assertFalse(stats['shared_cache'])
+        self.assertEqual(sum(stats['screen'].values()), 0)
+
+    def test_first_only_keeps_first_window(self):
+        remember_intake('sms', 'no_time', 'Bank', 10.0, 100.0, value='first', timeout=100, first_only=True)
+        remember_intake('sms', 'no_time', 'Bank', 10.0, 100.0, value='repeat', timeout=1000, first_only=True)
+        self.assertEqual(intake_seen('sms', 'no_time', 'Bank', 10.0, 100.0), 'first')
+        first_seen = timezone.now() - datetime.timedelta(hours=11)
+        self.assertAlmostEqual(no_time_dedup_timeout(first_seen), 3600, delta=5)
+        self.assertEqual(no_time_dedup_timeout(first_seen - datetime.timedelta(hours=2)), 1)
+
+    @override_settings(CACHE_SHARED=True)
+    @patch('deposit.views_api.send_message_tg')
+    def test_repeated_sms_skips_db_check(self, send_message_tg):
+        analyse_sms_text_and_save(SMS, 'imei1', 1, 'phone1')
+        self.assertEqual(Incoming.objects.count(), 1)
+
+        with patch.object(Incoming.objects, 'filter', side_effect=AssertionError('запрос в БД')):
+            analyse_sms_text_and_save(SMS, 'imei1', 2, 'phone1')
+        self.assertEqual(Incoming.objects.count(), 1)
+        send_message_tg.assert_called_once()
+        self.assertEqual(sum(intake_dedup_stats(hours=1)['sms'].values()), 1)
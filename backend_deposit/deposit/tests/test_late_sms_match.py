@@ -0,0 +1,128 @@
+"""
+Тесты привязки смс, пришедшей после ответа GPT
+"""
+import datetime
+import json
+from unittest.mock import patch, Mock
+
+import pytest
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from core.global_func import TZ
+from core.bind_func import BindResult
+from core.matcher_func import (auto_approve_stats, is_waiting_sms, register_waiting_order, forget_waiting_order,
+                               waiting_orders, MATCHER_DELTA_AFTER)
+from deposit.models import BirpayOrder, Incoming, TaskOutbox
+from deposit.tasks import send_image_to_gpt_task, match_incomings_task
+from users.models import Options
+
+
+@pytest.mark.django_db
+@override_settings(CACHE_SHARED=True)
+class LateSmsMatchTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        options = Options.load()
+        options.gpt_auto_approve = True
+        options.birpay_moshennik_list = []
+        options.birpay_painter_list = []
+        options.save()
+        now = timezone.now()
+        self.sms_time = now.astimezone(TZ)
+        self.order = BirpayOrder.objects.create(
+            birpay_id=12345, created_at=now, updated_at=now, merchant_transaction_id='MTX1',
+            merchant_user_id='USER1', card_number='1234****5678', status=0, amount=100.0, raw_data={},
+            check_file=SimpleUploadedFile('check.jpg', b'image', content_type='image/jpeg'), gpt_processing=True)
+        for i in range(5):
+            BirpayOrder.objects.create(
+                birpay_id=10000 + i, created_at=now, updated_at=now, merchant_transaction_id=f'MTX0{i}',
+                merchant_user_id='USER1', status=1, amount=50.0, raw_data={})
+        Incoming.objects.create(register_date=self.sms_time - datetime.timedelta(minutes=10),
+                                response_date=self.sms_time - datetime.timedelta(minutes=10),
+                                recipient='1234****5678', pay=50.0, balance=900.0, type='sms')
+
+    def gpt_response(self):
+        gpt_time = (self.sms_time + datetime.timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%S')
+        gpt_data = {'amount': 100.0, 'recipient': '1234****5678', 'gpt_sender': 'Bank', 'create_at': gpt_time,
+                    'status': 1}
+        return Mock(ok=True, status_code=200, json=Mock(return_value={'result': json.dumps(gpt_data)}))
+
+    def create_sms(self, pay, balance):
+        return Incoming.objects.create(register_date=self.sms_time, response_date=self.sms_time,
+                                       recipient='1234****5678', pay=pay, balance=balance, type='sms')
+
+    @patch('deposit.tasks.approve_birpay_refill', return_value=Mock(status_code=200))
+    @patch('deposit.tasks.requests.post')
+    def test_sms_after_gpt_is_bound(self, post, approve):
+        post.return_value = self.gpt_response()
+        send_image_to_gpt_task(self.order.birpay_id)
+        self.order.refresh_from_db()
+        self.assertIsNone(self.order.incoming)
+        self.assertNotIn(BirpayOrder.GPTIMHO.sms, BirpayOrder.GPTIMHO(self.order.gpt_flags))
+        approve.assert_not_called()
+
+        # Смс с другой суммой заявку не будит
+        self.create_sms(pay=70.0, balance=970.0)
+        self.assertFalse(TaskOutbox.objects.filter(task='deposit.tasks.match_incomings_task').exists())
+
+        sms = self.create_sms(pay=100.0, balance=1070.0)
+        outbox = TaskOutbox.objects.get(task='deposit.tasks.match_incomings_task')
+        self.assertEqual(outbox.args, [[sms.id]])
+
+        self.assertEqual(match_incomings_task(*outbox.args), ['MTX1'])
+        approve.assert_called_once_with(pk=self.order.birpay_id)
+        self.order.refresh_from_db()
+        sms.refresh_from_db()
+        self.assertEqual((self.order.incoming_id, self.order.gpt_flags), (sms.id, 255))
+        self.assertEqual(sms.birpay_id, 'MTX1')
+        self.assertEqual(auto_approve_stats(hours=1)['total'], {'direct': 0, 'late': 1, 'late_share': 1.0})
+
+        # Заявка больше не ждет смс
+        self.assertEqual(match_incomings_task([sms.id]), [])
+        approve.assert_called_once()
+
+    @patch('deposit.tasks.approve_birpay_refill', return_value=Mock(status_code=200))
+    @patch('deposit.tasks.requests.post')
+    def test_failed_bind_keeps_order_waiting(self, post, approve):
+        post.return_value = self.gpt_response()
+        send_image_to_gpt_task(self.order.birpay_id)
+        flags = BirpayOrder.objects.get(pk=self.order.pk).gpt_flags
+
+        # Смс пришла через 6 минут после чека - в окне поздней смс
+        self.sms_time += datetime.timedelta(minutes=6)
+        sms = self.create_sms(pay=100.0, balance=1000.0)
+        with patch('deposit.tasks.bind_incoming_to_order', return_value=BindResult(False, 'занято')):
+            self.assertEqual(match_incomings_task([sms.id]), [])
+        approve.assert_not_called()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.gpt_flags, flags)
+        self.assertTrue(is_waiting_sms(self.order))
+
+        self.assertEqual(match_incomings_task([sms.id]), ['MTX1'])
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.incoming_id, self.order.gpt_flags), (sms.id, 255))
+
+    def test_index_expires_after_late_window(self):
+        gpt_time = timezone.now() - datetime.timedelta(minutes=MATCHER_DELTA_AFTER + 10)
+        register_waiting_order(self.order, gpt_time)
+        self.assertEqual(waiting_orders([Incoming(id=1, pay=100.0, register_date=gpt_time)]), {})
+
+        gpt_time = timezone.now()
+        register_waiting_order(self.order, gpt_time)
+        sms = Incoming(id=1, pay=100.0, register_date=gpt_time + datetime.timedelta(minutes=MATCHER_DELTA_AFTER))
+        self.assertEqual(waiting_orders([sms]), {1: {self.order.birpay_id}})
+        forget_waiting_order(self.order, gpt_time)
+        self.assertEqual(waiting_orders([sms]), {})
+
+    @override_settings(CACHE_SHARED=False)
+    @patch('deposit.tasks.requests.post')
+    def test_no_index_without_shared_cache(self, post):
+        post.return_value = self.gpt_response()
+        send_image_to_gpt_task(self.order.birpay_id)
+        self.create_sms(pay=100.0, balance=1070.0)
+        self.assertFalse(TaskOutbox.objects.filter(task='deposit.tasks.match_incomings_task').exists())
+        self.assertFalse(auto_approve_stats(hours=1)['shared_cache'])
@@ -0,0 +1,42 @@
+"""
+Тесты индекса логов по заявкам
+"""
+import logging
+import tempfile
+from pathlib import Path
+
+from core.log_index import OrderLogIndexHandler, search_order_log
+
+
+def make_record(event: dict) -> logging.LogRecord:
+    return logging.LogRecord('deposit', logging.INFO, __file__, 1, event, None, None)
+
+
+def test_index_and_search_by_order_ids():
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = str(Path(tmp) / 'order_log.sqlite3')
+        handler = OrderLogIndexHandler(filename)
+        handler.emit(make_record({'event': 'Создан заказ', 'birpay_id': 111, 'merchant_transaction_id': 'MTX1'}))
+        handler.emit(make_record({'event': 'Без контекста'}))
+        handler.emit(make_record({'event': 'Подтвержден', 'birpay_id': 111, 'birpay_order_id': 5}))
+        handler.emit(make_record({'event': 'Чужой', 'birpay_id': 222}))
+        handler.close()
+
+        lines = search_order_log(filename, '111')
+        assert len(lines) == 2
+        assert 'Создан заказ' in lines[0] and 'Подтвержден' in lines[1]
+        assert len(search_order_log(filename, 'MTX1')) == 1
+        assert len(search_order_log(filename, '5')) == 1
+        assert search_order_log(filename, "111' OR 1=1 --") == []
+        assert search_order_log(str(Path(tmp) / 'missing.sqlite3'), '111') == []
+
+
+def test_full_queue_drops_without_blocking(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmp:
+        handler = OrderLogIndexHandler(str(Path(tmp) / 'order_log.sqlite3'), queue_size=1)
+        # Писатель завис - emit все равно не ждет
+        monkeypatch.setattr(handler, '_writer', lambda rows: None)
+        for num in range(3):
+            handler.emit(make_record({'event': 'Строка', 'birpay_id': num}))
+        assert handler.dropped == 2
+        handler.close()
@@ -0,0 +1,36 @@
+"""
+Тесты фильтра поступлений по маскам карт в SQL
+"""
+import pytest
+from django.test import TestCase
+
+from core.global_func import mask_compare, mask_compare_q
+from deposit.models import Incoming
+
+RECIPIENTS = ['5315992157686244', '5315*244', '531599****9459', '*9459', '4127***6869', '1234****567',
+              '1234****5678', '****5678', '+994 50 123 45 67', 'Bloklanmish', '5315 99** **** 7741']
+MASKS = ['531599****9459', '5315992157686244', '1234****5678', '****5678', '531599*****7741', '4127', '9994501234567']
+
+
+@pytest.mark.django_db
+class MaskCompareQTest(TestCase):
+
+    def test_same_as_mask_compare(self):
+        for recipient in RECIPIENTS:
+            Incoming.objects.create(recipient=recipient, pay=1)
+        for mask in MASKS:
+            expected = {recipient for recipient in RECIPIENTS if mask_compare(mask, recipient)}
+            found = set(Incoming.objects.filter(mask_compare_q(mask)).values_list('recipient', flat=True))
+            self.assertEqual(found, expected, mask)
+
+    def test_parts_follow_recipient_update(self):
+        incoming = Incoming.objects.create(recipient='4127***6869', pay=1)
+        incoming.recipient = '1234****5678'
+        incoming.save(update_fields=['recipient'])
+        incoming.refresh_from_db()
+        self.assertEqual((incoming.recipient_prefix, incoming.recipient_suffix_rev), ('1234', '8765'))
+
+    def test_suffix_filter_has_no_leading_wildcard(self):
+        sql = str(Incoming.objects.filter(mask_compare_q('****5678')).query)
+        self.assertNotIn('LIKE %', sql)
+        self.assertIn('LIKE 8765%', sql)
@@ -0,0 +1,73 @@
+"""
+Тесты локального подбора порогов распознавания
+"""
+import multiprocessing
+import tempfile
+from unittest.mock import patch
+
+import cv2
+import numpy as np
+import pytest
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+
+from ocr.calibration import binarize, calibrate_screen, decode_for_calibration, rank_pairs, sweep_texts
+from ocr.models import ScreenResponse, ScreenResponsePart
+
+SCREEN = settings.BASE_DIR / 'test' / 'ocr_test' / 'atb1.jpg'
+
+
+def test_binarize_matches_cv2_threshold():
+    gray = decode_for_calibration(SCREEN.read_bytes())
+    for black, white in [(0, 255), (127, 255), (200, 40)]:
+        _, expected = cv2.threshold(gray, black, white, cv2.THRESH_BINARY)
+        assert np.array_equal(binarize(gray, black, white), expected)
+
+
+@pytest.mark.django_db
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class CalibrateScreenTest(TestCase):
+
+    def setUp(self):
+        self.screen = ScreenResponse.objects.create(
+            name='atb1.jpg', image=SimpleUploadedFile('atb1.jpg', SCREEN.read_bytes()),
+            sample_recipient='*1234', sample_pay=50.0, sample_transaction=777,
+        )
+
+    def tearDown(self):
+        self.screen.image.delete(save=False)
+
+    @patch('ocr.screen_response.screen_text_to_pay')
+    @patch('ocr.calibration._ocr_pair', side_effect=lambda gray, pair, lang: (pair[0], pair[1], f'text {pair[0]}'))
+    def test_sweep_saves_new_pairs_and_ranks(self, ocr_pair, text_to_pay):
+        text_to_pay.side_effect = lambda text: {
+            'recipient': '*1234', 'pay': 50.0 if text == 'text 100' else 1.0, 'transaction': 777, 'sender': '',
+        }
+        ScreenResponsePart.objects.create(screen=self.screen, black=10, white=255)
+        created = calibrate_screen(self.screen.id, [(10, 255), (100, 255), (120, 255)], threads=1)
+        self.assertEqual(created, 2)
+        self.assertEqual(ocr_pair.call_count, 2)
+        ranked = rank_pairs(self.screen)
+        self.assertEqual((ranked[0]['black'], ranked[0]['score']), (100, 3))
+        self.assertEqual(calibrate_screen(self.screen.id, [(100, 255)], threads=1), 0)
+
+    @patch('ocr.calibration._ocr_pair',
+           side_effect=lambda gray, pair, lang: (pair[0], pair[1], '' if pair[0] == 120 else ' \n'))
+    def test_empty_text_is_not_saved(self, ocr_pair):
+        self.assertEqual(calibrate_screen(self.screen.id, [(100, 255), (120, 255)], threads=4), 0)
+        self.assertEqual(ocr_pair.call_count, 2)
+        self.assertFalse(self.screen.parts.exists())
+
+
+def test_thread_pool_works_in_daemon_process():
+    """Пул потоков - и в демоническом процессе (воркер celery prefork), порядок пар сохраняется"""
+    def sweep(queue):
+        with patch('ocr.calibration.pytesseract.image_to_string', side_effect=lambda image, **kwargs: str(image.max())):
+            queue.put(sweep_texts(SCREEN.read_bytes(), [(0, 200), (0, 100), (255, 50)], threads=3))
+
+    queue = multiprocessing.get_context('fork').Queue()
+    process = multiprocessing.get_context('fork').Process(target=sweep, args=(queue,), daemon=True)
+    process.start()
+    process.join(30)
+    assert queue.get(timeout=5) == [(0, 200, '200'), (0, 100, '100'), (255, 50, '0')]
@@ -0,0 +1,57 @@
+"""
+Тесты конвейера распознавания скрина
+"""
+from unittest.mock import Mock, patch
+
+import cv2
+import numpy as np
+import pytest
+from django.conf import settings
+
+from ocr.ocr_func import ScreenOcrPipeline
+
+SCREEN = settings.BASE_DIR / 'test' / 'ocr_test' / 'atb1.jpg'
+
+
+def old_crop(source, y_start, y_end, x_start=None, x_end=None, black=182, white=255):
+    """Обрезка и бинаризация как в прежнем response_text_from_image"""
+    img = cv2.imdecode(np.fromfile(source, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    height, width = img.shape
+    img = img[int(y_start / 100 * height):int(y_end / 100 * height), :]
+    if x_start and x_end:
+        img = img[:, int(x_start / 100 * width):int(x_end / 100 * width)]
+    _, binary = cv2.threshold(img, black, white, cv2.THRESH_BINARY)
+    return binary
+
+
+def test_regions_match_separate_decoding():
+    pipeline = ScreenOcrPipeline(SCREEN, black=182, white=255)
+    assert np.array_equal(pipeline.crop(5, 10, 10, 100), old_crop(SCREEN, 5, 10, 10, 100))
+    assert np.array_equal(pipeline.crop(28, 70), old_crop(SCREEN, 28, 70))
+    # Области - срезы без копирования
+    assert np.shares_memory(pipeline.crop(12, 28), pipeline.binary)
+
+
+def test_read_passes_region_psm_and_times_stages():
+    pipeline = ScreenOcrPipeline(SCREEN, black=182, white=255)
+    with patch.object(ScreenOcrPipeline, 'ocr', side_effect=lambda img, **kw: f'{img.shape[0]}:{kw["psm"]}') as ocr:
+        texts = pipeline.read({
+            'amount': {'y_start': 12, 'y_end': 28},
+            'info': {'y_start': 28, 'y_end': 70, 'psm': 4},
+        }, psm=6)
+    assert ocr.call_count == 2
+    assert texts['amount'].endswith(':6') and texts['info'].endswith(':4')
+    assert {'decode', 'threshold', 'ocr_amount', 'ocr_info'} <= set(pipeline.timings)
+
+
+def test_tesserocr_recognize_is_time_limited():
+    pipeline = ScreenOcrPipeline(SCREEN, black=182, white=255)
+    api = Mock(**{'GetUTF8Text.return_value': ' 100 ', 'Recognize.return_value': True})
+    with patch('ocr.ocr_func.tesserocr', Mock()), patch('ocr.ocr_func.Image', Mock(), create=True), \
+            patch('ocr.ocr_func._get_tess_api', return_value=api):
+        assert pipeline.ocr(pipeline.crop(12, 28)) == '100'
+        api.Recognize.assert_called_once_with(timeout=10000)
+        # Recognize прерван по времени - ошибка, как у pytesseract по timeout
+        api.Recognize.return_value = False
+        with pytest.raises(RuntimeError):
+            pipeline.ocr(pipeline.crop(12, 28))
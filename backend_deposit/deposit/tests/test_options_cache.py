@@ -0,0 +1,64 @@
+"""
+Тесты кэша Options.load()
+"""
+import pytest
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from deposit.models import BirpayOrder
+from users.models import Options, SingletonModel
+
+
+@pytest.mark.django_db
+class OptionsCacheTest(TestCase):
+
+    def setUp(self):
+        options = Options.load()
+        options.birpay_moshennik_list = ['bad_user']
+        options.save()
+
+    def test_load_is_cached_and_invalidated_on_save(self):
+        Options.load()
+        with self.assertNumQueries(0):
+            options = Options.load()
+            self.assertIn('bad_user', options.moshennik_set)
+            self.assertTrue(BirpayOrder(merchant_user_id='bad_user').is_moshennik())
+            self.assertFalse(BirpayOrder(merchant_user_id='good_user').is_painter())
+
+        options.birpay_painter_list = ['good_user']
+        options.save(update_fields=['birpay_painter_list'])
+        self.assertIn('good_user', Options.load().painter_set)
+
+    def test_load_returns_copy(self):
+        options = Options.load()
+        options.gpt_auto_approve = not options.gpt_auto_approve
+        options.birpay_moshennik_list.append('other_user')
+        self.assertNotEqual(Options.load().gpt_auto_approve, options.gpt_auto_approve)
+        self.assertEqual(Options.load().birpay_moshennik_list, ['bad_user'])
+
+    def test_other_processes_invalidated_after_commit(self):
+        version = cache.get(Options._version_key())
+        options = Options.load()
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            options.save()
+        self.assertEqual(cache.get(Options._version_key()), version)
+        for callback in callbacks:
+            callback()
+        self.assertNotEqual(cache.get(Options._version_key()), version)
+
+    @override_settings(CACHE_SHARED=False)
+    def test_local_cache_rereads_after_ttl(self):
+        Options.load()
+        loaded = SingletonModel._loaded[Options]
+        SingletonModel._loaded[Options] = (loaded[0], loaded[1] - Options.cache_ttl, loaded[2], loaded[3])
+        with self.assertNumQueries(1):
+            Options.load()
+
+    def test_fraud_sets_shared_without_copy(self):
+        Options.load()
+        with self.assertNumQueries(0):
+            moshennik_set, painter_set = Options.fraud_sets()
+            self.assertIs(Options.fraud_sets()[0], moshennik_set)
+            # Копия из load() делит неизменяемые множества с общим экземпляром
+            self.assertIs(Options.load().moshennik_set, moshennik_set)
+        self.assertIn('bad_user', moshennik_set)
@@ -0,0 +1,72 @@
+"""
+Тесты outbox задач celery
+"""
+from unittest.mock import patch
+
+import pytest
+from django.test import TestCase
+from django.utils import timezone
+
+from core.outbox_func import (enqueue_task, relay_outbox, OUTBOX_RETRY_DELAY, OUTBOX_MAX_ATTEMPTS,
+                               OUTBOX_BROKER_ERRORS)
+from deposit.models import TaskOutbox
+from deposit.tasks import send_screen_to_payment
+
+
+@pytest.mark.django_db
+class OutboxTest(TestCase):
+
+    def test_dedup_while_pending(self):
+        enqueue_task(send_screen_to_payment, args=[1], dedup_key='send_screen_to_payment:1')
+        enqueue_task(send_screen_to_payment, args=[1], dedup_key='send_screen_to_payment:1')
+        self.assertEqual(TaskOutbox.objects.count(), 1)
+
+        with patch.object(send_screen_to_payment, 'apply_async') as apply_async:
+            self.assertEqual(relay_outbox(), {'sent': 1, 'failed': 0, 'dead': 0})
+        apply_async.assert_called_once_with(args=[1], kwargs={}, eta=None)
+
+        # После отправки такую же задачу можно поставить снова
+        enqueue_task(send_screen_to_payment, args=[1], dedup_key='send_screen_to_payment:1')
+        self.assertEqual(TaskOutbox.objects.filter(sent_at__isnull=True).count(), 1)
+
+    def test_broker_error_keeps_task(self):
+        enqueue_task(send_screen_to_payment, args=[2])
+        with patch.object(send_screen_to_payment, 'apply_async', side_effect=ConnectionError('broker down')):
+            self.assertEqual(relay_outbox(), {'sent': 0, 'failed': 1, 'dead': 0})
+        row = TaskOutbox.objects.get()
+        self.assertIsNone(row.sent_at)
+        self.assertEqual(row.attempts, 1)
+        self.assertAlmostEqual((row.retry_at - timezone.now()).total_seconds(), OUTBOX_RETRY_DELAY, delta=2)
+
+        with patch.object(send_screen_to_payment, 'apply_async'):
+            # До retry_at задача не отправляется
+            self.assertEqual(relay_outbox()['sent'], 0)
+            TaskOutbox.objects.update(retry_at=timezone.now())
+            self.assertEqual(relay_outbox()['sent'], 1)
+
+    def test_failed_task_does_not_block_others(self):
+        enqueue_task('deposit.tasks.unknown_task', args=[1], dedup_key='unknown:1')
+        enqueue_task(send_screen_to_payment, args=[3])
+
+        def send_task(name, *args, **kwargs):
+            raise ValueError('bad task')
+
+        with patch('core.outbox_func.current_app.send_task', side_effect=send_task), \
+                patch.object(send_screen_to_payment, 'apply_async') as apply_async:
+            self.assertEqual(relay_outbox(), {'sent': 1, 'failed': 1, 'dead': 0})
+            apply_async.assert_called_once()
+
+            # После OUTBOX_MAX_ATTEMPTS ошибок отправка прекращается и dedup_key освобождается
+            TaskOutbox.objects.filter(dedup_key='unknown:1').update(attempts=OUTBOX_MAX_ATTEMPTS - 1,
+                                                                   retry_at=timezone.now())
+            self.assertEqual(relay_outbox(), {'sent': 0, 'failed': 1, 'dead': 1})
+        self.assertIsNotNone(TaskOutbox.objects.get(dedup_key='unknown:1').failed_at)
+        enqueue_task('deposit.tasks.unknown_task', args=[1], dedup_key='unknown:1')
+        self.assertEqual(TaskOutbox.objects.filter(dedup_key='unknown:1').count(), 2)
+
+    def test_broker_down_stops_relay(self):
+        for i in range(5):
+            enqueue_task(send_screen_to_payment, args=[i])
+        with patch.object(send_screen_to_payment, 'apply_async', side_effect=ConnectionError('broker down')):
+            self.assertEqual(relay_outbox()['failed'], OUTBOX_BROKER_ERRORS)
+        self.assertEqual(TaskOutbox.objects.filter(attempts=0).count(), 5 - OUTBOX_BROKER_ERRORS)
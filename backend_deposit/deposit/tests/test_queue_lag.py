@@ -0,0 +1,41 @@
+"""
+Тесты замера задержки очередей celery
+"""
+import time
+from types import SimpleNamespace
+
+from celery.app.task import Context
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+from core.queue_func import mark_enqueued_at, measure_queue_lag, queue_lag_stats
+
+
+class QueueLagTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def run_task(self, queue, lag_seconds):
+        request = Context(enqueued_at=time.time() - lag_seconds, delivery_info={'routing_key': queue},
+                          is_eager=False)
+        measure_queue_lag(task=SimpleNamespace(request=request))
+
+    def test_lag_by_queue(self):
+        headers = {}
+        mark_enqueued_at(headers=headers)
+        self.assertIn('enqueued_at', headers)
+
+        self.run_task('ingest', 0.2)
+        self.run_task('ingest', 1)
+        self.run_task('downloads', 5)
+        stats = queue_lag_stats(minutes=2, backlog=False)
+        self.assertEqual(stats['ingest']['count'], 2)
+        self.assertGreaterEqual(stats['ingest']['max_ms'], 1000)
+        self.assertLess(stats['ingest']['avg_ms'], stats['downloads']['avg_ms'])
+        self.assertEqual(stats['gpt']['count'], 0)
+
+    def test_eager_and_unmarked_tasks_ignored(self):
+        measure_queue_lag(task=SimpleNamespace(request=Context(delivery_info={'routing_key': 'ingest'})))
+        measure_queue_lag(task=SimpleNamespace(request=Context(enqueued_at=time.time(), is_eager=True)))
+        self.assertEqual(queue_lag_stats(minutes=1, backlog=False)['ingest']['count'], 0)
@@ -0,0 +1,89 @@
+"""
+Тесты повторного распознавания мусора
+"""
+import datetime
+
+import pytest
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from core.global_func import TZ
+from core.reparse_func import reparse_trash, rechain_balances
+from deposit.models import Incoming, TrashIncoming
+
+
+def sms1(date: str, pay: str, balance: str) -> str:
+    return (f'Imtina:Bloklanmish kart\nKart:4127***6869\nTarix:{date}\n'
+            f'Mercant:P2P SEND- LEO APP\nMebleg:{pay} AZN\nBalans:{balance} AZN')
+
+
+@pytest.mark.django_db
+class ReparseTrashTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.later = Incoming.objects.create(
+            recipient='4127***6869', pay=100, balance=700,
+            response_date=TZ.localize(datetime.datetime(2023, 8, 22, 15, 30)))
+        TrashIncoming.objects.bulk_create([
+            TrashIncoming(text=sms1('2023-08-22 15:17:19', '29.00', '569.51'), worker='phone1'),
+            TrashIncoming(text=sms1('2023-08-22 15:20:00', '10.00', '600.00'), worker='phone1'),
+            TrashIncoming(text=sms1('2023-08-22 15:17:19', '29.00', '569.51'), worker='phone2'),
+            TrashIncoming(text='unknown text', worker='phone1'),
+        ])
+
+    def test_dry_run_only_reports(self):
+        report = reparse_trash(dry_run=True)
+        self.assertEqual(report['scanned'], 4)
+        self.assertEqual(report['by_type'], {'sms1': 3})
+        self.assertEqual(TrashIncoming.objects.count(), 4)
+        self.assertEqual(Incoming.objects.count(), 1)
+
+    def test_apply_moves_recognized_and_chains_balance(self):
+        report = reparse_trash(dry_run=False, chunk_size=2)
+        self.assertEqual((report['created'], report['duplicates']), (2, 1))
+        self.assertEqual(list(TrashIncoming.objects.values_list('text', flat=True)), ['unknown text'])
+
+        first, second, later = Incoming.objects.order_by('response_date')
+        self.assertEqual(later.id, self.later.id)
+        self.assertIsNone(first.prev_balance)
+        self.assertEqual(second.prev_balance, 569.51)
+        self.assertEqual(later.prev_balance, 600)
+        self.assertEqual(later.check_balance, 700)
+
+    def test_apply_keeps_trash_register_date(self):
+        trash_date = TZ.localize(datetime.datetime(2023, 8, 22, 15, 40))
+        TrashIncoming.objects.update(register_date=trash_date)
+        reparse_trash(dry_run=False)
+        self.assertEqual(set(Incoming.objects.exclude(id=self.later.id).values_list('register_date', flat=True)),
+                         {trash_date})
+
+    def test_no_time_sms_dedup_against_all_history(self):
+        text = 'Mebleg: 5.00 AZN Merchant: M10 ACCOUNT TO CARD Balans: 15.00 AZN'
+        old = Incoming.objects.create(recipient='phone1', sender='M10 ACCOUNT TO CARD', pay=5, balance=15, type='sms8')
+        Incoming.objects.filter(id=old.id).update(register_date=timezone.now() - datetime.timedelta(days=30))
+        TrashIncoming.objects.create(text=text, worker='phone1')
+        report = reparse_trash(dry_run=False)
+        self.assertEqual((report['created'], report['duplicates']), (2, 2))
+        self.assertEqual(Incoming.objects.filter(sender='M10 ACCOUNT TO CARD').count(), 1)
+
+    def test_rechain_reads_recipient_history_once(self):
+        history = {}
+        first = Incoming.objects.create(recipient='4127***6869', pay=10, balance=600,
+                                        response_date=TZ.localize(datetime.datetime(2023, 8, 22, 15, 20)))
+        rechain_balances([first], history)
+        self.assertEqual(Incoming.objects.get(id=self.later.id).prev_balance, 600)
+
+        second = Incoming.objects.create(recipient='4127***6869', pay=20, balance=650,
+                                         response_date=TZ.localize(datetime.datetime(2023, 8, 22, 15, 25)))
+        with CaptureQueriesContext(connection) as queries:
+            rechain_balances([second], history)
+        select = next(query['sql'] for query in queries if query['sql'].startswith('SELECT'))
+        self.assertIn('"deposit_incoming"."id" >', select)
+        second.refresh_from_db()
+        self.later.refresh_from_db()
+        self.assertEqual((second.prev_balance, second.check_balance), (600, 620))
+        self.assertEqual((self.later.prev_balance, self.later.check_balance), (650, 750))
@@ -0,0 +1,72 @@
+"""
+Тесты приема скринов в очередь распознавания
+"""
+import tempfile
+from unittest.mock import patch
+
+import pytest
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import HttpResponse
+from django.test import TestCase, Client, override_settings
+from django.urls import reverse
+
+from deposit.tasks import process_screen_task
+from deposit.views_api import SCREEN_OCR_IN_FLIGHT_KEY
+
+
+@pytest.mark.django_db
+@override_settings(SCREEN_OCR_ASYNC=True, CACHE_SHARED=True, SCREEN_OCR_QUEUE_LIMIT=1, MEDIA_ROOT=tempfile.mkdtemp())
+class ScreenQueueTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+
+    def post_screen(self):
+        image = SimpleUploadedFile('screen.jpg', b'jpeg-bytes', content_type='image/jpeg')
+        return self.client.post(reverse('deposit:screen'), {'image': image, 'name': 'screen.jpg', 'worker': 'phone1'},
+                                HTTP_HOST='testserver')
+
+    @patch('deposit.tasks.process_screen_task.delay')
+    def test_accepts_and_applies_backpressure(self, delay):
+        response = self.post_screen()
+        self.assertEqual(response.status_code, 202)
+        screen_id = response.json()['id']
+        delay.assert_called_once()
+        self.assertEqual(delay.call_args.args[0], screen_id)
+
+        self.assertEqual(self.post_screen().status_code, 429)
+        self.assertEqual(delay.call_count, 1)
+
+        response = self.client.get(reverse('deposit:screen_result', kwargs={'screen_id': screen_id}))
+        self.assertEqual(response.json()['reason'], 'queued')
+
+    @patch('deposit.views_api.recognize_screen', return_value=HttpResponse(status=201, reason='created'))
+    @patch('deposit.tasks.process_screen_task.delay')
+    def test_task_stores_result_and_frees_slot(self, delay, recognize):
+        screen_id = self.post_screen().json()['id']
+        process_screen_task(*delay.call_args.args)
+        self.assertEqual(recognize.call_args.args[0], b'jpeg-bytes')
+
+        response = self.client.get(reverse('deposit:screen_result', kwargs={'screen_id': screen_id}))
+        self.assertEqual(response.json()['status'], 201)
+        self.assertEqual(self.post_screen().status_code, 202)
+
+    @patch('deposit.views_api.recognize_screen', return_value=HttpResponse(status=201, reason='created'))
+    @patch('deposit.tasks.process_screen_task.delay', side_effect=ConnectionError('broker is down'))
+    def test_enqueue_failure_frees_slot_and_file(self, delay, recognize):
+        response = self.post_screen()
+        self.assertEqual((response.status_code, recognize.call_count), (201, 1))
+        path = delay.call_args.args[1]
+        self.assertFalse(default_storage.exists(path))
+        self.assertIsNone(cache.get(f'screen_ocr_result:{delay.call_args.args[0]}'))
+        self.assertEqual(cache.get(SCREEN_OCR_IN_FLIGHT_KEY), 0)
+
+    @override_settings(CACHE_SHARED=False)
+    @patch('deposit.views_api.recognize_screen', return_value=HttpResponse(status=201, reason='created'))
+    @patch('deposit.tasks.process_screen_task.delay')
+    def test_sync_without_shared_cache(self, delay, recognize):
+        self.assertEqual(self.post_screen().status_code, 201)
+        delay.assert_not_called()
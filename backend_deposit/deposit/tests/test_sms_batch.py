@@ -0,0 +1,61 @@
+"""
+Тесты пакетного приема смс
+"""
+import json
+from unittest.mock import patch
+
+import pytest
+from django.core.cache import cache
+from django.test import TestCase, Client
+from django.urls import reverse
+
+from deposit.models import Incoming, TrashIncoming, CardDayVolume
+
+
+def sms1(date: str, pay: str, balance: str) -> str:
+    return (f'Imtina:Bloklanmish kart\nKart:4127***6869\nTarix:{date}\n'
+            f'Mercant:P2P SEND- LEO APP\nMebleg:{pay} AZN\nBalans:{balance} AZN')
+
+
+@pytest.mark.django_db
+@patch('deposit.views_api.send_message_tg')
+class SmsBatchTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+
+    def post_batch(self, messages):
+        return self.client.post(reverse('deposit:sms_batch'), data=json.dumps(messages),
+                                content_type='application/json')
+
+    def test_batch_results_and_balance_chain(self, send_message_tg):
+        first = sms1('2023-08-22 15:17:19', '29.00', '569.51')
+        second = sms1('2023-08-22 15:20:00', '10.00', '600.00')
+        messages = [
+            {'id': '1', 'message': first, 'imei': 'imei1', 'worker': 'phone1'},
+            {'id': '2', 'message': first, 'imei': 'imei1', 'worker': 'phone1'},
+            {'id': '3', 'message': second, 'imei': 'imei1', 'worker': 'phone1'},
+            {'id': '4', 'message': 'unknown text', 'imei': 'imei1', 'worker': 'phone1'},
+        ]
+        response = self.post_batch(messages)
+        self.assertEqual(response.status_code, 200)
+        statuses = [result['status'] for result in response.json()['results']]
+        self.assertEqual(statuses, ['created', 'duplicate', 'created', 'trash'])
+        self.assertEqual(TrashIncoming.objects.count(), 1)
+
+        older, newer = Incoming.objects.order_by('response_date')
+        self.assertIsNone(older.prev_balance)
+        self.assertEqual(newer.prev_balance, 569.51)
+        self.assertEqual(newer.recipient_prefix, '4127')
+        # sms1 - неуспешный платеж с pay=0, в объемы не попадает
+        self.assertFalse(CardDayVolume.objects.exists())
+
+        # Повтор пакета после очистки кэша отсекается одним запросом в БД
+        cache.clear()
+        response = self.post_batch({'messages': messages[:1]})
+        self.assertEqual(response.json()['results'][0]['status'], 'duplicate')
+        self.assertEqual(Incoming.objects.count(), 2)
+
+    def test_rejects_bad_payload(self, send_message_tg):
+        self.assertEqual(self.post_batch({'id': 1}).status_code, 400)
@@ -2,12 +2,13 @@
 Простой тест для проверки привязки SMS к заказу
 """
 import pytest
+from django.db import DatabaseError
 from django.test import TestCase, Client
 from django.contrib.auth import get_user_model
 from django.urls import reverse
 from unittest.mock import patch, Mock
 
-from deposit.models import BirpayOrder, Incoming
+from deposit.models import BirpayOrder, Incoming, IncomingChange
 
 User = get_user_model()
 
@@ -252,3 +253,62 @@ class SMSBindingTest(TestCase):
         
         # Проверяем, что привязанный SMS отображается в столбце
         self.assertContains(response, str(separate_incoming.id))
+
+    def approve_post(self):
+        return self.client.post(reverse('deposit:birpay_panel'), data={
+            'orderamount_{}'.format(self.birpay_order.id): '100.0',
+            'orderconfirm_{}'.format(self.birpay_order.id): str(self.incoming.id),
+            'order_action_approve': 'approve',
+        }, follow=True)
+
+    @patch('deposit.views.actual_order_status', return_value=0)
+    @patch('deposit.views.approve_birpay_refill')
+    def test_birpay_error_leaves_sms_free(self, mock_approve, mock_status):
+        """Ошибка подтверждения в birpay - смс не привязывается, заявка остается в pending"""
+        mock_approve.return_value = Mock(status_code=500, text='error')
+        self.approve_post()
+        mock_approve.assert_called_once_with(pk=self.birpay_order.birpay_id)
+        self.birpay_order.refresh_from_db()
+        self.incoming.refresh_from_db()
+        self.assertEqual((self.birpay_order.status, self.birpay_order.incoming_id), (0, None))
+        self.assertIsNone(self.incoming.birpay_id)
+
+    @patch('deposit.views.actual_order_status', return_value=0)
+    @patch('deposit.views.approve_birpay_refill')
+    def test_busy_order_not_approved_in_birpay(self, mock_approve, mock_status):
+        """Заявка уже привязана к другой смс - в birpay не подтверждается"""
+        other = Incoming.objects.create(recipient='Test Recipient', pay=100.0, type='sms')
+        BirpayOrder.objects.filter(pk=self.birpay_order.pk).update(incoming=other)
+        self.approve_post()
+        mock_approve.assert_not_called()
+        self.incoming.refresh_from_db()
+        self.assertIsNone(self.incoming.birpay_id)
+
+    @patch('deposit.views.actual_order_status', return_value=0)
+    @patch('deposit.views.approve_birpay_refill', return_value=Mock(status_code=200, text='OK'))
+    def test_status_saved_when_bind_fails_after_approve(self, mock_approve, mock_status):
+        """Заявка подтверждена в birpay, запись привязки упала - статус сохраняется"""
+        def failing_bind(incoming_id, merchant_transaction_id, user=None, *, confirm=None, **kwargs):
+            confirm(BirpayOrder.objects.get(merchant_transaction_id=merchant_transaction_id))
+            raise DatabaseError('db down')
+
+        with patch('deposit.views.bind_incoming_to_order', side_effect=failing_bind):
+            self.approve_post()
+        mock_approve.assert_called_once()
+        self.birpay_order.refresh_from_db()
+        self.assertEqual((self.birpay_order.status, self.birpay_order.status_internal), (1, 1))
+        self.assertEqual(self.birpay_order.confirmed_operator, self.user)
+        self.assertIsNone(self.birpay_order.incoming_id)
+
+    @patch('deposit.views.actual_order_status', return_value=0)
+    @patch('deposit.views.approve_birpay_refill', return_value=Mock(status_code=200, text='OK'))
+    def test_write_failure_after_approve_reported(self, mock_approve, mock_status):
+        """Запись привязки упала после подтверждения - ошибка confirmed из привязки, статус сохраняется"""
+        with patch.object(IncomingChange.objects, 'create', side_effect=DatabaseError('db down')):
+            response = self.approve_post()
+        mock_approve.assert_called_once()
+        self.birpay_order.refresh_from_db()
+        self.incoming.refresh_from_db()
+        self.assertEqual((self.birpay_order.status, self.birpay_order.incoming_id), (1, None))
+        self.assertIsNone(self.incoming.birpay_id)
+        self.assertTrue(any('не записана' in str(message) for message in response.context['messages']))
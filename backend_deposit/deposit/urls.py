@@ -23,8 +23,10 @@ urlpatterns = [
     # path('deposits/<int:pk>/', views.deposit_edit, name='deposit_edit'),
 
     path('screen/', views_api.screen_new, name='screen'),
+    path('screen/<str:screen_id>/', views_api.screen_result, name='screen_result'),
     # path('screen_new/', views_api.screen_new, name='screen_new'),
     path('sms/', views_api.sms, name='sms'),
+    path('sms/batch/', views_api.sms_batch, name='sms_batch'),
     path('sms_forwarder/', views_api.sms_forwarder, name='sms_forwarder'),
 
     path('incomings/', views.incoming_list, name='incomings'),
@@ -44,11 +46,13 @@ urlpatterns = [
 
     path('stats/', views.get_stats, name='stats'),
     path('stats_card/', views.get_stats, name='stats_card'),
+    path('stats_card/<str:recipient>/', views.card_stat_detail, name='stats_card_detail'),
     path('stats_day/', views.get_stats, name='stats_day'),
     path('stats_day2/', views.get_stats2, name='stats_day2'),
     path('trash/', views.IncomingTrashList.as_view(), name='trash'),
     path('graph/', views.day_graph, name='graph'),
     path('operator_speed_graph/', views.operator_speed_graph, name='operator_speed_graph'),
+    path('chart/<str:chart>.png', views.chart_image, name='chart_image'),
 
     path('messages/<int:pk>/', views.MessageView.as_view(), name='message_view'),
     path('messages/', views.MessageListView.as_view(), name='messages'),
@@ -76,6 +80,12 @@ urlpatterns = [
     # path('test/', views.test, name='test'),
     path('users_stat/', views.BirpayUserStatView.as_view(), name='users_stat'),
     path('incomings/mark_as_jail/<int:pk>/', views.mark_as_jail, name='mark_as_jail'),
+    path('api/heartbeats/', views.heartbeats_view, name='heartbeats'),
+    path('api/intake_dedup_stats/', views.intake_dedup_stats_view, name='intake_dedup_stats'),
+    path('api/birpay_lookup_stats/', views.birpay_lookup_stats_view, name='birpay_lookup_stats'),
+    path('api/queue_lag/', views.queue_lag_view, name='queue_lag'),
+    path('api/poller_stats/', views.poller_stats_view, name='poller_stats'),
+    path('api/auto_approve_stats/', views.auto_approve_stats_view, name='auto_approve_stats'),
     path('api/incoming_balance_info/<int:incoming_id>/', views.get_incoming_balance_info, name='get_incoming_balance_info'),
     path('api/birpay-orders/', views_api.BirpayOrderListAPIView.as_view(), name='birpay_orders_api'),
     path('requisite-zajon/', views.RequsiteZajonListView.as_view(), name='requisite_zajon_list'),
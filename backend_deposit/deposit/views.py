@@ -26,21 +26,31 @@ from django.core.exceptions import PermissionDenied, ValidationError
 from django.core.paginator import Paginator
 from django.db.models import F, Q, OuterRef, Window, Exists, Value, Sum, Count, Subquery, ExpressionWrapper, FloatField, \
     Max, DurationField, Case, When, BooleanField
-from django.http import HttpResponseForbidden, JsonResponse, HttpResponseBadRequest, HttpResponse, HttpResponseRedirect
+from django.http import HttpResponseForbidden, JsonResponse, HttpResponseBadRequest, HttpResponse, HttpResponseRedirect, \
+    HttpResponseNotModified
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse_lazy, reverse
 from django.utils import timezone
+from django.utils.http import parse_etags
 from django.views import View
 from django.views.generic import CreateView, DetailView, ListView, UpdateView, TemplateView
-from matplotlib import pyplot as plt
 from rest_framework.views import APIView
 from structlog.contextvars import bind_contextvars, clear_contextvars
 
 from core.asu_pay_func import create_asu_withdraw, should_send_to_z_asu, send_birpay_order_to_z_asu, confirm_z_asu_transaction
+from core.birpay_lookup_func import actual_order_status, birpay_lookup_stats
 from core.birpay_new_func import get_um_transactions, send_transaction_action
-from core.global_func import TZ, mask_compare, send_message_tg
-from core.stat_func import cards_report, bad_incomings, get_img_for_day_graph, day_reports_birpay_confirm, \
-    day_reports_orm
+from core.db_func import EstimatedCountPaginator
+from core.chart_func import CHART_DAY_GRAPH, CHART_OPERATOR_SPEED, CHARTS, request_chart, get_chart_error
+from core.global_func import TZ, mask_compare_q, send_message_tg
+from core.heartbeat_func import last_seen
+from core.intake_func import intake_dedup_stats
+from core.queue_func import queue_lag_stats
+from core.poll_func import poller_stats
+from core.matcher_func import auto_approve_stats
+from core.bind_func import bind_incoming_to_order, BindResult
+from core.outbox_func import enqueue_task
+from core.stat_func import cards_report, bad_incomings, day_reports_birpay_confirm, day_reports_orm, card_detail_report
 from deposit import tasks
 from deposit.filters import IncomingCheckFilter, IncomingStatSearch, BirpayOrderFilter, BirpayPanelFilter
 from deposit.forms import (
@@ -493,62 +503,22 @@ def incoming_list(request):
         value = request.POST.get(input_name) or ''
         incoming = Incoming.objects.get(pk=pk)
         if isinstance(incoming.birpay_id, NoneType):
-            # Валидация: если значение не пустое, проверяем существование BirpayOrder
-            if value and value.strip():
-                value = value.strip()
-                order_exists = BirpayOrder.objects.filter(merchant_transaction_id=value).exists()
-                if not order_exists:
-                    error_msg = f'BirpayOrder с MerchTxID "{value}" не найден. Проверьте правильность номера.'
-                    logger.warning(f'Попытка привязать несуществующий MerchTxID {value} к Incoming {incoming.id}')
-                    messages.add_message(request, messages.ERROR, error_msg)
-                    if 'filter' in options:
-                        return redirect('deposit:incomings_filter')
-                    else:
-                        return redirect('deposit:incomings')
-                
-                # Проверяем, что этот merchant_transaction_id не привязан к другому Incoming
-                existing_incoming = Incoming.objects.filter(birpay_id=value).exclude(pk=incoming.pk).first()
-                if existing_incoming:
-                    error_msg = f'MerchTxID "{value}" уже привязан к Incoming ID {existing_incoming.id}. Нельзя привязывать один номер к нескольким записям.'
-                    logger.warning(f'Попытка привязать уже используемый MerchTxID {value} к Incoming {incoming.id} (уже привязан к {existing_incoming.id})')
-                    messages.add_message(request, messages.ERROR, error_msg)
-                    if 'filter' in options:
-                        return redirect('deposit:incomings_filter')
-                    else:
-                        return redirect('deposit:incomings')
-                
-                # Проверяем, что BirpayOrder не привязан к другому Incoming
-                order = BirpayOrder.objects.filter(merchant_transaction_id=value).first()
-                if order and order.incoming and order.incoming.pk != incoming.pk:
-                    error_msg = f'BirpayOrder с MerchTxID "{value}" уже привязан к Incoming ID {order.incoming.id}. Нельзя привязывать один заказ к нескольким записям.'
-                    logger.warning(f'Попытка привязать BirpayOrder {value} к Incoming {incoming.id} (уже привязан к {order.incoming.id})')
-                    messages.add_message(request, messages.ERROR, error_msg)
-                    if 'filter' in options:
-                        return redirect('deposit:incomings_filter')
-                    else:
-                        return redirect('deposit:incomings')
-            
+            value = value.strip()
             # Проверяем несовпадение баланса перед привязкой
             # Если check_balance не вычислен, вычисляем его (на случай, если запись была создана до добавления этой логики)
             if incoming.check_balance is None and incoming.recipient:
                 incoming.calculate_balance_fields()
                 incoming.save(update_fields=['prev_balance', 'check_balance'])
                 logger.info(f'Вычислен check_balance для Incoming {incoming.id}: check_balance={incoming.check_balance}')
-            
+
             # Проверяем баланс только если введено непустое значение
             # Пустое значение используется для удаления привязки (убрать SMS из поиска)
-            if value and value.strip():
+            balance_mismatch = False
+            if value:
                 add_balance_mismatch_flag(incoming)
                 logger.info(f'Проверка баланса для Incoming {incoming.id}: check_balance={incoming.check_balance}, balance={incoming.balance}, balance_mismatch={incoming.balance_mismatch}')
-                
-                # Проверяем несовпадение баланса
-                balance_mismatch = False
-                if incoming.check_balance is not None and incoming.balance is not None:
-                    check_rounded = round(float(incoming.check_balance) * 10) / 10
-                    balance_rounded = round(float(incoming.balance) * 10) / 10
-                    balance_mismatch = check_rounded != balance_rounded
-                    logger.info(f'Проверка баланса для Incoming {incoming.id}: check_rounded={check_rounded}, balance_rounded={balance_rounded}, не совпадают={balance_mismatch}')
-                
+                balance_mismatch = incoming.balance_mismatch
+
                 # Если баланс не совпадает и нет подтверждения оператора - блокируем привязку
                 # Подтверждение устанавливается через JavaScript confirm dialog
                 confirm_balance_mismatch = request.POST.get(f'confirm_balance_mismatch_{pk}', '') == '1'
@@ -565,60 +535,38 @@ def incoming_list(request):
                         return redirect('deposit:incomings_filter')
                     else:
                         return redirect('deposit:incomings')
-                
-                # Если баланс не совпадает, но есть подтверждение - отправляем уведомление в Telegram
-                if balance_mismatch and confirm_balance_mismatch:
-                    msg = (
-                        f'⚠️ ВНИМАНИЕ: Привязка BirpayOrder к Incoming с несовпадающим балансом (подтверждено оператором)!\n'
-                        f'Incoming ID: {incoming.id}\n'
-                        f'MerchTxID: {value}\n'
-                        f'Баланс из SMS: {incoming.balance}\n'
-                        f'Расчетный баланс: {incoming.check_balance}\n'
-                        f'Получатель: {incoming.recipient}\n'
-                        f'Платеж: {incoming.pay}\n'
-                        f'Пользователь: {request.user.username}'
-                    )
-                    logger.warning(f'Привязка BirpayOrder {value} к Incoming {incoming.id} с несовпадающим балансом (подтверждено оператором)')
-                    try:
-                        if settings.ALARM_IDS:
-                            send_message_tg(message=msg, chat_ids=settings.ALARM_IDS)
-                            logger.info(f'Alarm-сообщение отправлено успешно в чаты: {settings.ALARM_IDS}')
-                        else:
-                            logger.error(f'ALARM_IDS не настроен! Уведомление не может быть отправлено.')
-                    except Exception as e:
-                        logger.error(f'Ошибка при отправке alarm-сообщения: {e}', exc_info=True)
-            
-            # Сохраняем привязку
-            incoming.birpay_id = value.strip() if value else ''
-            # Используем одно и то же время для синхронизации
-            confirm_time = timezone.now()
-            incoming.birpay_confirm_time = confirm_time
-            if value and value.strip():
-                order = BirpayOrder.objects.filter(merchant_transaction_id=value.strip()).first()
-                if order:
-                    # Автоматически заполняем merchant_user_id из BirpayOrder
-                    incoming.merchant_user_id = order.merchant_user_id
-                    # Устанавливаем контекст со всеми идентификаторами BirpayOrder при связывании
-                    bind_contextvars(
-                        birpay_id=order.birpay_id,
-                        merchant_transaction_id=order.merchant_transaction_id,
-                        birpay_order_id=order.id
-                    )
-                    order.incoming = incoming
-                    order.confirmed_time = confirm_time  # Используем то же время
-                    order.save(update_fields=['incoming', 'confirmed_time'])
-                    logger.info(f'Привязан BirpayOrder {order.merchant_transaction_id} к Incoming {incoming.id} в incoming_list')
-                    # Очищаем контекст после связывания
-                    clear_contextvars()
-            incoming.save()
-            #Сохраняем историю
-            new_history = IncomingChange(
-                incoming=incoming,
-                user=request.user,
-                val_name='birpay_id',
-                new_val=value
-            )
-            new_history.save()
+
+            # Привязка с проверкой заявки и истории изменений
+            result = bind_incoming_to_order(incoming.id, value, request.user, free_only=True, empty_value='')
+            if not result.ok:
+                logger.warning(f'Не удалось привязать MerchTxID {value} к Incoming {incoming.id}: {result.error}')
+                messages.add_message(request, messages.ERROR, result.error)
+                if 'filter' in options:
+                    return redirect('deposit:incomings_filter')
+                else:
+                    return redirect('deposit:incomings')
+
+            # Если баланс не совпадает, но есть подтверждение - отправляем уведомление в Telegram
+            if balance_mismatch:
+                msg = (
+                    f'⚠️ ВНИМАНИЕ: Привязка BirpayOrder к Incoming с несовпадающим балансом (подтверждено оператором)!\n'
+                    f'Incoming ID: {incoming.id}\n'
+                    f'MerchTxID: {value}\n'
+                    f'Баланс из SMS: {incoming.balance}\n'
+                    f'Расчетный баланс: {incoming.check_balance}\n'
+                    f'Получатель: {incoming.recipient}\n'
+                    f'Платеж: {incoming.pay}\n'
+                    f'Пользователь: {request.user.username}'
+                )
+                logger.warning(f'Привязка BirpayOrder {value} к Incoming {incoming.id} с несовпадающим балансом (подтверждено оператором)')
+                try:
+                    if settings.ALARM_IDS:
+                        send_message_tg(message=msg, chat_ids=settings.ALARM_IDS)
+                        logger.info(f'Alarm-сообщение отправлено успешно в чаты: {settings.ALARM_IDS}')
+                    else:
+                        logger.error(f'ALARM_IDS не настроен! Уведомление не может быть отправлено.')
+                except Exception as e:
+                    logger.error(f'Ошибка при отправке alarm-сообщения: {e}', exc_info=True)
         else:
             return HttpResponseBadRequest('Уже отработана')
 
@@ -847,17 +795,11 @@ class IncomingMyCardsView(StaffOnlyPerm, ListView):
         if not cards:
             return qs.none()
 
-        # Нельзя SQL-ом по маскам, фильтруем в Python из последней 1000 записей по времени
-        limited_qs = qs.exclude(recipient__isnull=True).exclude(recipient='')[:1000]
-        matched_ids = []
-        for inc in limited_qs:
-            recipient = inc.recipient or ''
-            for card_mask in cards:
-                if mask_compare(card_mask, recipient):
-                    matched_ids.append(inc.id)
-                    break
-
-        return Incoming.objects.filter(id__in=matched_ids).order_by('-response_date')
+        # Маски карт сравниваются по индексированным колонкам видимых цифр получателя
+        cards_q = Q()
+        for card_mask in cards:
+            cards_q |= mask_compare_q(card_mask)
+        return qs.exclude(recipient__isnull=True).exclude(recipient='').filter(cards_q)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -883,7 +825,7 @@ class IncomingMyCardsView(StaffOnlyPerm, ListView):
         last_bad = Message.objects.filter(type='macros').order_by('-id').first()
         context['last_bad_id'] = last_bad.id if last_bad else None
         # Для AJAX уведомлений в шаблоне - передаем список уникальных получателей из отфильтрованных записей
-        filtered_recipients = list(set(self.object_list.values_list('recipient', flat=True).distinct()))
+        filtered_recipients = list(self.object_list.order_by().values_list('recipient', flat=True).distinct())
         context['filter'] = json.dumps(filtered_recipients)
         return context
 
@@ -893,6 +835,7 @@ class IncomingSearch(ListView):
     model = Incoming
     template_name = 'deposit/incomings_list.html'
     paginate_by = 50
+    paginator_class = EstimatedCountPaginator
     search_date = None
 
     def get(self, request, *args, **kwargs):
@@ -923,7 +866,7 @@ class IncomingSearch(ListView):
         start_time = ''
 
         if pk:
-            return Incoming.objects.filter(birpay_id__contains=pk)
+            return Incoming.objects.filter(birpay_id__contains=pk).order_by('-response_date')
         
         if merchant_user_id:
             all_incoming = Incoming.objects.filter(merchant_user_id=merchant_user_id)
@@ -962,7 +905,7 @@ class IncomingSearch(ListView):
             if end_time:
                 all_incoming = all_incoming.filter(register_date__lte=end_time).all()
         if only_empty:
-            all_incoming = all_incoming.filter(Q(birpay_id='') | Q(birpay_id=None))
+            all_incoming = all_incoming.filter(birpay_id__isnull=True)
         if pay:
             all_incoming = all_incoming.filter(pay=pay)
 
@@ -1107,87 +1050,28 @@ class IncomingEdit(UpdateView, ):
             new_birpay_id_raw = form.cleaned_data.get('birpay_id')
             new_birpay_id = str(new_birpay_id_raw).strip() if new_birpay_id_raw is not None and new_birpay_id_raw != '' else ''
             
-            # Валидация нового birpay_id (если не пустой)
-            if new_birpay_id:
-                # Проверяем существование BirpayOrder
-                order_exists = BirpayOrder.objects.filter(merchant_transaction_id=new_birpay_id).exists()
-                if not order_exists:
-                    form.add_error('birpay_id', f'BirpayOrder с MerchTxID "{new_birpay_id}" не найден. Проверьте правильность номера.')
-                    return super(IncomingEdit, self).form_invalid(form)
-                
-                # Проверяем, что этот merchant_transaction_id не привязан к другому Incoming
-                existing_incoming = Incoming.objects.filter(birpay_id=new_birpay_id).exclude(pk=incoming.pk).first()
-                if existing_incoming:
-                    form.add_error('birpay_id', f'MerchTxID "{new_birpay_id}" уже привязан к Incoming ID {existing_incoming.id}. Нельзя привязывать один номер к нескольким записям.')
-                    return super(IncomingEdit, self).form_invalid(form)
-                
-                # Проверяем, что BirpayOrder не привязан к другому Incoming
-                new_order = BirpayOrder.objects.filter(merchant_transaction_id=new_birpay_id).first()
-                if new_order and new_order.incoming and new_order.incoming.pk != incoming.pk:
-                    form.add_error('birpay_id', f'BirpayOrder с MerchTxID "{new_birpay_id}" уже привязан к Incoming ID {new_order.incoming.id}. Нельзя привязывать один заказ к нескольким записям.')
-                    return super(IncomingEdit, self).form_invalid(form)
-            
             # Обновление временных меток
             incoming.birpay_edit_time = datetime.datetime.now(tz=pytz.timezone(settings.TIME_ZONE))
-            
-            # Сохраняем birpay_id (может быть пустой строкой или None)
-            incoming.birpay_id = new_birpay_id if new_birpay_id else None
-            
-            # Обновление связи с BirpayOrder для консистентности
-            if old_birpay_id != new_birpay_id:
-                # Используем одно и то же время для синхронизации birpay_confirm_time и order.confirmed_time
-                # Обновляем время только если birpay_id изменился
-                confirm_time = timezone.now()
-                incoming.birpay_confirm_time = confirm_time
-                
-                # Отвязываем старый BirpayOrder (если был привязан)
-                if old_birpay_id:
-                    old_order = BirpayOrder.objects.filter(merchant_transaction_id=old_birpay_id).first()
-                    if old_order and old_order.incoming and old_order.incoming.pk == incoming.pk:
-                        # Устанавливаем контекст со всеми идентификаторами BirpayOrder при отвязывании
-                        bind_contextvars(
-                            birpay_id=old_order.birpay_id,
-                            merchant_transaction_id=old_order.merchant_transaction_id,
-                            birpay_order_id=old_order.id
-                        )
-                        old_order.incoming = None
-                        old_order.save(update_fields=['incoming'])
-                        # При отвязывании очищаем merchant_user_id
-                        incoming.merchant_user_id = None
-                        logger.info(f'Отвязан старый BirpayOrder {old_birpay_id} от Incoming {incoming.id}')
-                        # Очищаем контекст после отвязывания
-                        clear_contextvars()
-                
-                # Привязываем новый BirpayOrder (если существует и не пустой)
-                if new_birpay_id:
-                    new_order = BirpayOrder.objects.filter(merchant_transaction_id=new_birpay_id).first()
-                    if new_order:
-                        # Автоматически заполняем merchant_user_id из BirpayOrder
-                        incoming.merchant_user_id = new_order.merchant_user_id
-                        # Устанавливаем контекст со всеми идентификаторами BirpayOrder при связывании
-                        bind_contextvars(
-                            birpay_id=new_order.birpay_id,
-                            merchant_transaction_id=new_order.merchant_transaction_id,
-                            birpay_order_id=new_order.id
-                        )
-                        new_order.incoming = incoming
-                        new_order.confirmed_time = confirm_time  # Используем то же время
-                        new_order.save(update_fields=['incoming', 'confirmed_time'])
-                        logger.info(f'Привязан новый BirpayOrder {new_birpay_id} к Incoming {incoming.id}')
-                        # Очищаем контекст после связывания
-                        clear_contextvars()
+
+            with transaction.atomic():
+                if old_birpay_id != new_birpay_id:
+                    # Смена привязки: проверка новой заявки, отвязка старой, привязка новой и сохранение смс
+                    result = bind_incoming_to_order(incoming.id, new_birpay_id, incoming=incoming, history=False)
+                    if not result.ok:
+                        form.add_error('birpay_id', result.error)
+                        return super(IncomingEdit, self).form_invalid(form)
+                    if not new_birpay_id:
+                        logger.info(f'BirpayOrder отвязан от Incoming {incoming.id} (birpay_id очищен)')
                 else:
-                    # При отвязывании очищаем merchant_user_id
-                    incoming.merchant_user_id = None
-                    logger.info(f'BirpayOrder отвязан от Incoming {incoming.id} (birpay_id очищен)')
-            elif not incoming.birpay_confirm_time:
-                # Если birpay_id не изменился, но birpay_confirm_time не установлен, устанавливаем его
-                incoming.birpay_confirm_time = timezone.now()
-            
-            incoming.save()
+                    # Сохраняем birpay_id (может быть пустой строкой или None)
+                    incoming.birpay_id = new_birpay_id if new_birpay_id else None
+                    if not incoming.birpay_confirm_time:
+                        # Если birpay_id не изменился, но birpay_confirm_time не установлен, устанавливаем его
+                        incoming.birpay_confirm_time = timezone.now()
+                    incoming.save()
 
-            # Сохраняем историю
-            IncomingChange().save_incoming_history(old_incoming, incoming, self.request.user)
+                # Сохраняем историю
+                IncomingChange().save_incoming_history(old_incoming, incoming, self.request.user)
 
             return super(IncomingEdit, self).form_valid(form)
 
@@ -1261,150 +1145,166 @@ def get_stats2(request):
     return render(request, template, context)
 
 
+def _period_param(request, name: str, default: int, maximum: int) -> int | None:
+    """Период статистики из GET (целое от 1, не больше maximum). None - неверное значение"""
+    try:
+        value = int(request.GET.get(name, default))
+    except (TypeError, ValueError):
+        return None
+    return min(value, maximum) if value >= 1 else None
+
+
+@staff_member_required(login_url='users:login')
+def intake_dedup_stats_view(request):
+    # Повторы скринов и смс, отсеченные кэшем, по часам
+    hours = _period_param(request, 'hours', 24, 48)
+    if hours is None:
+        return HttpResponseBadRequest('Неверное количество часов')
+    return JsonResponse(intake_dedup_stats(hours=hours))
+
+
+@staff_member_required(login_url='users:login')
+def birpay_lookup_stats_view(request):
+    # Ответы о заявках birpay из локальной копии и запросы в birpay по часам
+    hours = _period_param(request, 'hours', 24, 48)
+    if hours is None:
+        return HttpResponseBadRequest('Неверное количество часов')
+    return JsonResponse(birpay_lookup_stats(hours=hours))
+
+
+@staff_member_required(login_url='users:login')
+def queue_lag_view(request):
+    # Задержка от постановки задачи до старта и длина очередей celery
+    minutes = _period_param(request, 'minutes', 15, 120)
+    if minutes is None:
+        return HttpResponseBadRequest('Неверное количество минут')
+    return JsonResponse(queue_lag_stats(minutes=minutes))
+
+
+@staff_member_required(login_url='users:login')
+def poller_stats_view(request):
+    # Текущие интервалы и частота изменений опросов birpay/UM
+    return JsonResponse({'enabled': settings.ADAPTIVE_POLLING, 'pollers': poller_stats()})
+
+
+@staff_member_required(login_url='users:login')
+def auto_approve_stats_view(request):
+    # Автоподтверждения по часам: сразу после GPT и по смс, пришедшей позже, и доля поздних
+    hours = _period_param(request, 'hours', 24, 48)
+    if hours is None:
+        return HttpResponseBadRequest('Неверное количество часов')
+    return JsonResponse(auto_approve_stats(hours=hours))
+
+
+@staff_member_required(login_url='users:login')
+def heartbeats_view(request):
+    # Время последнего скрина/смс по устройствам
+    now = datetime.datetime.now()
+    result = {}
+    for kind in ('screen', 'sms'):
+        result[kind] = {device: {'last_seen': last_time.isoformat(), 'seconds': int((now - last_time).total_seconds())}
+                        for device, last_time in last_seen(kind).items()}
+    return JsonResponse(result)
+
+
+@staff_member_required(login_url='users:login')
+def card_stat_detail(request, recipient):
+    # Детализация статистики по карте
+    if request.user.has_perm('users.stats') or request.user.is_superuser:
+        template = 'deposit/stats_card_detail.html'
+        context = {'recipient': recipient, **card_detail_report(recipient)}
+        return render(request, template, context)
+    raise PermissionDenied('Недостаточно прав')
+
+
+def _can_view_chart(user, chart: str) -> bool:
+    if chart == CHART_DAY_GRAPH:
+        return user.has_perm('users.graph') or user.is_superuser
+    return user.is_staff
+
+
 def day_graph(request):
     if request.user.has_perm('users.graph') or request.user.is_superuser:
 
         template = 'deposit/test.html'
-        encoded_file = get_img_for_day_graph()
-        context = {'fig1': encoded_file}
+        entry = request_chart(CHART_DAY_GRAPH)
+        render_error = get_chart_error(CHART_DAY_GRAPH) if entry is None else None
+        context = {
+            'chart_url': reverse('deposit:chart_image', kwargs={'chart': CHART_DAY_GRAPH}) + f'?v={entry["etag"]}'
+            if entry else None,
+            'rendering': entry is None and render_error is None,
+            'render_error': render_error,
+        }
         return render(request, template, context)
     raise PermissionDenied('Недостаточно прав')
 
+
+@login_required()
+def chart_image(request, chart):
+    """Отдача построенного графика из кэша с ETag"""
+    if chart not in CHARTS or not _can_view_chart(request.user, chart):
+        raise PermissionDenied('Недостаточно прав')
+    chart_date = None
+    params = None
+    try:
+        if request.GET.get('date'):
+            chart_date = datetime.date.fromisoformat(request.GET['date'])
+        if request.GET.get('date_to'):
+            params = {'date_to': datetime.date.fromisoformat(request.GET['date_to']).isoformat()}
+    except ValueError:
+        return HttpResponseBadRequest('Неверная дата')
+    entry = request_chart(chart, chart_date, params)
+    if entry is None or not entry['png']:
+        # График еще строится
+        return HttpResponse(status=HTTPStatus.ACCEPTED)
+    etag = f'"{entry["etag"]}"'
+    # Слабое сравнение (RFC 9110): W/"x" совпадает с "x"
+    if_none_match = {tag.removeprefix('W/') for tag in parse_etags(request.headers.get('If-None-Match', ''))}
+    if etag in if_none_match or '*' in if_none_match:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(entry['png'], content_type='image/png')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, max-age=60'
+    return response
+
+
 @staff_member_required()
 def operator_speed_graph(request):
     form = OperatorStatsDayForm(request.GET or None)
-    graph_url = None
-    stat_table_data = None
-    stat_table_columns = None
-    no_data = False
+    context = {
+        'form': form,
+        'graph_url': None,
+        'stat_table_data': None,
+        'stat_table_columns': None,
+        'no_data': False,
+        'rendering': False,
+        'render_error': None,
+    }
 
     if form.is_valid():
         chosen_date = form.cleaned_data['date']
-        try:
-
-            qs = BirpayOrder.objects.annotate(
-                delta=ExpressionWrapper(
-                    F('confirmed_time') - F('sended_at'),
-                    output_field=DurationField()
-                )
-            ).filter(
-                sended_at__date=chosen_date,
-                confirmed_operator__isnull=False,
-                confirmed_time__isnull=False,
-                delta__lte=datetime.timedelta(hours=1)
-            )
-
-            logger.info(f"Queryset count: {qs.count()} на {chosen_date}")
-
-            df = pd.DataFrame(
-                list(qs.values(
-                    'sended_at', 'confirmed_time', 'id',
-                    'confirmed_operator__username'
-                ))
+        date_to = form.cleaned_data.get('date_to')
+        params = {'date_to': date_to.isoformat()} if date_to else None
+        entry = request_chart(CHART_OPERATOR_SPEED, chosen_date, params)
+        if entry is None:
+            context['render_error'] = get_chart_error(CHART_OPERATOR_SPEED, chosen_date, params)
+            context['rendering'] = context['render_error'] is None
+        else:
+            data = entry['data']
+            context.update(
+                stat_table_data=data.get('stat_table_data'),
+                stat_table_columns=data.get('stat_table_columns'),
+                no_data=data.get('no_data', False),
             )
-            logger.info(f"DataFrame shape: {df.shape}")
-            logger.info(f"DataFrame columns: {df.columns.tolist()}")
+            if entry['png']:
+                context['graph_url'] = reverse(
+                    'deposit:chart_image', kwargs={'chart': CHART_OPERATOR_SPEED}
+                ) + f'?date={chosen_date.isoformat()}&v={entry["etag"]}'
+                if date_to:
+                    context['graph_url'] += f'&date_to={date_to.isoformat()}'
 
-            if df.empty:
-                no_data = True
-            else:
-                df['sended_at'] = pd.to_datetime(df['sended_at'], utc=True).dt.tz_convert(TZ)
-                df['confirmed_time'] = pd.to_datetime(df['confirmed_time'], utc=True).dt.tz_convert(TZ)
-                df['hour'] = df['sended_at'].dt.hour
-                df['delta_minutes'] = (df['confirmed_time'] - df['sended_at']).dt.total_seconds() / 60
-
-                # Категории для графика (по скорости)
-                conditions = [
-                    df['delta_minutes'] < 5,
-                    (df['delta_minutes'] >= 5) & (df['delta_minutes'] < 10),
-                    (df['delta_minutes'] >= 10) & (df['delta_minutes'] < 15),
-                    (df['delta_minutes'] >= 15),
-                ]
-                choices = ['<5 минут', '<10 минут', '<15 минут', '≥15 минут']
-                df['speed_cat'] = np.select(conditions, choices, default='≥15 минут')
-
-                all_hours = np.arange(0, 24)
-                speed_order = ['<5 минут', '<10 минут', '<15 минут', '≥15 минут']
-                speed_colors = ['mediumseagreen', 'gold', 'tomato', 'lightgray']
-
-                # --- График ---
-                hourly = df.groupby(['hour', 'speed_cat'])['id'].count().unstack(fill_value=0)
-                hourly = hourly.reindex(index=all_hours, fill_value=0)
-                hourly = hourly.reindex(columns=speed_order, fill_value=0)
-
-                fig, ax = plt.subplots(figsize=(14, 5))
-                hourly.plot(
-                    kind='bar',
-                    stacked=True,
-                    color=speed_colors,
-                    ax=ax
-                )
-                ax.set_xlabel('Час (МСК)')
-                ax.set_ylabel('Количество подтверждений')
-                ax.set_title(f'Подтверждения по часам (МСК) за {chosen_date}')
-                ax.set_xticks(range(24))
-                ax.set_xticklabels([str(h) for h in range(24)], rotation=0)
-                ax.legend(title='Время подтверждения')
-                plt.tight_layout()
-
-                # Подписи
-                for i, (idx, row) in enumerate(hourly.iterrows()):
-                    vals = [int(row[c]) for c in speed_order]
-                    total_height = np.sum(vals)
-                    ax.text(
-                        i, total_height + 0.5,
-                        f"{vals[0]}/{vals[1]}/{vals[2]}",
-                        ha='center', va='bottom', fontsize=11, fontweight='bold'
-                    )
-
-                buf = io.BytesIO()
-                plt.savefig(buf, format='png')
-                buf.seek(0)
-                graph_url = "data:image/png;base64," + base64.b64encode(buf.getvalue()).decode("utf-8")
-                plt.close(fig)
-
-                # --- Таблица по юзерам (операторам) ---
-                bins = [0, 5, 10, 15, np.inf]
-                labels = [
-                    '0–5', '5–10', '10–15', '15+'
-                ]
-                df['bucket'] = pd.cut(df['delta_minutes'], bins=bins, labels=labels, right=False)
-                op_field = 'confirmed_operator__username'
-
-                user_stats = []
-                for op, group in df.groupby(op_field):
-                    total = group.shape[0]
-                    bucket_counts = group['bucket'].value_counts().reindex(labels, fill_value=0)
-                    bucket_perc = (bucket_counts / total * 100).round(1)
-                    # Только проценты (без "Доля", без %)
-                    user_stats.append(
-                        [op, total] + [bucket_perc[l] for l in labels]
-                    )
-                stat_cols = ['Оператор', 'Кол-во'] + labels
-                stat_table = pd.DataFrame(user_stats, columns=stat_cols)
-                # Сортировка по первому периоду (0–5)
-                stat_table = stat_table.sort_values('0–5', ascending=False).reset_index(drop=True)
-                stat_table_data = stat_table.to_dict('records')
-                stat_table_columns = list(stat_table.columns)
-
-        except Exception as e:
-            logger.exception("Error in operator_speed_graph view")
-            return render(request, 'deposit/operator_speed_graph.html', {
-                'form': form,
-                'graph_url': None,
-                'stat_table_data': None,
-                'stat_table_columns': None,
-                'no_data': True,
-                'error': str(e),
-            })
-
-    return render(request, 'deposit/operator_speed_graph.html', {
-        'form': form,
-        'graph_url': graph_url,
-        'stat_table_data': stat_table_data,
-        'stat_table_columns': stat_table_columns,
-        'no_data': no_data,
-    })
+    return render(request, 'deposit/operator_speed_graph.html', context)
 
 
 class MessageView(DetailView):
@@ -1763,8 +1663,8 @@ class BirpayOrderView(StaffOnlyPerm, ListView):
         context['gpt_auto_approve'] = options.gpt_auto_approve
         
         # Кэшируем списки для проверки is_moshennik/is_painter без запросов к БД
-        birpay_moshennik_list = set(options.birpay_moshennik_list)
-        birpay_painter_list = set(options.birpay_painter_list)
+        birpay_moshennik_list = options.moshennik_set
+        birpay_painter_list = options.painter_set
 
         show_stat = self.filterset.form.cleaned_data.get('show_stat')
         if show_stat:
@@ -2061,7 +1961,7 @@ class BirpayPanelView(StaffOnlyPerm, ListView):
 
             # смена суммы
             if order.amount != new_amount:
-                if order.status != 0:
+                if actual_order_status(order) != 0:
                     text = f'Не удалось сменить сумму {order} mtx_id {order.merchant_transaction_id}: Статус не pending'
                     logger.warning(text)
                     messages.add_message(request, messages.WARNING, text)
@@ -2105,7 +2005,12 @@ class BirpayPanelView(StaffOnlyPerm, ListView):
                         return HttpResponseRedirect(f"{request.path}?{query_string}")
                     else:
                         #Апрувнем заявку
-                        # Но сначала проверим суммы
+                        # Но сначала проверим статус и суммы
+                        if actual_order_status(order) != 0:
+                            text = f'Заявка {order} mtx_id {order.merchant_transaction_id} уже не в статусе pending ({order.status}). Подтверждение не возможно'
+                            messages.add_message(request, messages.ERROR, text)
+                            logger.warning(text)
+                            raise ValidationError(text)
                         if incoming_to_approve.pay != order.amount:
                             text = f'Сумма в смс {incoming_to_approve.id} {incoming_to_approve.pay} и заказе {order.amount} отличаются. Подтверждение и привязка не возможна'
                             messages.add_message(request, messages.ERROR, text)
@@ -2150,41 +2055,55 @@ class BirpayPanelView(StaffOnlyPerm, ListView):
                                 logger.warning(f'Привязка BirpayOrder {order.merchant_transaction_id} к Incoming {incoming_to_approve.id} с несовпадающим балансом (подтверждено оператором)')
                         
                         logger.info('Апрувнем заявку')
-                        
-                        # Логика Z-ASU: если DEBUG=True, не отправляем запрос, считаем успешным
-                        if settings.DEBUG:
-                            logger.info(f'DEBUG=True: пропускаем отправку approve_birpay_refill для {order.birpay_id}, считаем успешным')
-                            response = type('MockResponse', (), {'status_code': 200, 'text': 'OK (DEBUG mode)'})()
-                        else:
-                            response = approve_birpay_refill(pk=order.birpay_id)
-                        
-                        if response.status_code != 200:
-                            text = f"ОШИБКА пдтверждения {order} mtx_id {order.merchant_transaction_id}: {response.text}"
+                        approved = []
+
+                        def approve_in_birpay(locked_order):
+                            # Подтверждение в birpay после проверок привязки, пока смс и заявка заблокированы
+                            # Логика Z-ASU: если DEBUG=True, не отправляем запрос, считаем успешным
+                            if settings.DEBUG:
+                                logger.info(f'DEBUG=True: пропускаем отправку approve_birpay_refill для {locked_order.birpay_id}, считаем успешным')
+                                response = type('MockResponse', (), {'status_code': 200, 'text': 'OK (DEBUG mode)'})()
+                            else:
+                                response = approve_birpay_refill(pk=locked_order.birpay_id)
+                            if response.status_code != 200:
+                                return f"ОШИБКА пдтверждения {order} mtx_id {order.merchant_transaction_id}: {response.text}"
+                            approved.append(True)
+                            return None
+
+                        # Привязка смс и статусы заявки одной транзакцией с подтверждением в birpay
+                        order_fields = {field: getattr(order, field) for field in update_fields}
+                        order_fields.update(status=1, status_internal=1, incomingsms_id=incoming_to_approve.id,
+                                            confirmed_operator=self.request.user)
+                        try:
+                            result = bind_incoming_to_order(
+                                incoming_to_approve.id, order.merchant_transaction_id, self.request.user,
+                                free_only=True, require_pending=True, check_amount=True, order_fields=order_fields,
+                                confirm=approve_in_birpay)
+                        except Exception as err:
+                            logger.error(f'Ошибка привязки смс {incoming_to_approve.id} к {order.merchant_transaction_id}: {err}',
+                                         exc_info=True)
+                            result = BindResult(False, str(err))
+
+                        if not result.ok:
+                            # Сумма уже изменена в birpay, после подтверждения - и статус: сохраняем без привязки
+                            local_fields = {field: getattr(order, field) for field in update_fields}
+                            if approved or result.confirmed:
+                                local_fields.update(status=1, status_internal=1, confirmed_operator=self.request.user)
+                                text = result.error if result.confirmed else (
+                                    f'Заявка {order.merchant_transaction_id} подтверждена в birpay, но смс не привязана: {result.error}')
+                            else:
+                                text = result.error
+                            if local_fields:
+                                BirpayOrder.objects.filter(pk=order.pk).update(**local_fields)
                             messages.add_message(request, messages.ERROR, text)
-                            logger.warning(text)
+                            logger.error(text)
                         else:
-                            # Апрувнем заявку
+                            order = result.order
                             text = f"Заявка {order} mtx_id {order.merchant_transaction_id} подтверждена в birpay с суммой {order.amount}"
                             logger.info(text)
-                            
                             messages.add_message(request, messages.INFO, text)
-                            order.status = 1
-                            order.status_internal = 1
-
-
-                            with transaction.atomic():
-                                operator = self.request.user
-                                order.incomingsms_id = incoming_id
-                                order.confirmed_operator = operator
-                                order.confirmed_time = timezone.now()
-                                order.incoming = incoming_to_approve
-                                order.save()
-                                incoming_to_approve.birpay_id = order.merchant_transaction_id
-                                # Автоматически заполняем merchant_user_id из BirpayOrder
-                                incoming_to_approve.merchant_user_id = order.merchant_user_id
-                                incoming_to_approve.save()
-                                logger.info(f'"Заявка {order} mtx_id {order.merchant_transaction_id} успешно подтверждена')
-                            
+                            logger.info(f'"Заявка {order} mtx_id {order.merchant_transaction_id} успешно подтверждена')
+
                             # Логика Z-ASU: после успешного подтверждения в birpay и сохранения заявки апрувим на ASU
                             # Выполняем в конце, чтобы не блокировать основную транзакцию при недоступности сервера ASU
                             asu_approve_message = ''
@@ -2508,28 +2427,18 @@ def painter_list(request):
 
 @staff_member_required()
 def show_birpay_order_log(request, query_string):
-    from subprocess import PIPE, STDOUT, Popen
+    from django.utils.html import escape
+    from core.log_index import search_order_log
     if not request.user.is_superuser:
         return HttpResponseBadRequest()
 
     if request.method == 'GET':
-        output_text = ''
-        with open('bash_request.sh', 'w', encoding='UTF-8') as file:
-            file.write(
-                f'#!/bin/sh\n'
-                f'cat logs/deposit.log | grep {str(query_string)}'
-            )
-        command = ["bash", "bash_request.sh"]
-        process = Popen(command, stdout=PIPE, stderr=STDOUT)
-        output = process.stdout.read()
-        exitstatus = process.poll()
-        txt = output.decode()
-        txt = txt.replace('\n', '<br>')
-        output_text += txt
+        # Поиск по индексу логов (birpay_id / merchant_transaction_id / birpay_order_id)
+        lines = search_order_log(settings.ORDER_LOG_INDEX_FILE, query_string.strip())
+        output_text = '<br>'.join(escape(line).replace('\n', '<br>') for line in lines)
         output_text += '<br><br>'
 
         import ansiconv
-        plain = ansiconv.to_plain(output_text)
         html = ansiconv.to_html(output_text)
         css = ansiconv.base_css()
         html_log = f'<html><head><style>{css}</style></head><body style="background: black"><pre class="ansi_fore ansi_back">{html}</pre></body></html>'
@@ -2550,10 +2459,11 @@ class BirpayOrderCreateView(SuperuserOnlyPerm, CreateView):
         
         # Если указан URL чека и файл еще не скачан, запускаем задачу скачивания
         if order.check_file_url and not order.check_file and not order.check_file_failed:
-            # Обновляем флаг перед запуском задачи
-            BirpayOrder.objects.filter(id=order.id).update(check_file_failed=True)
-            # Запускаем задачу скачивания чека
-            download_birpay_check_file.delay(order.id, order.check_file_url)
+            # Обновляем флаг и ставим задачу скачивания чека в одной транзакции
+            with transaction.atomic():
+                BirpayOrder.objects.filter(id=order.id).update(check_file_failed=True)
+                enqueue_task(download_birpay_check_file, args=[order.id, order.check_file_url],
+                             dedup_key=f'download_check:{order.id}')
             logger.info(f'Задача на скачивание файла для заказа {order.birpay_id} отправлена в celery.')
         
         # Логика Z-ASU: проверка условия и отправка на ASU
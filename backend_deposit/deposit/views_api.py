@@ -1,11 +1,18 @@
 import datetime
 import logging
 import re
+import uuid
 
 import pytz
 import structlog
 from django.conf import settings
-from django.http import HttpResponse
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.functions import Upper
+from django.http import HttpResponse, JsonResponse
 from django.utils import timezone
 from rest_framework import status
 from rest_framework.decorators import api_view
@@ -18,9 +25,13 @@ from django_filters.rest_framework import DjangoFilterBackend
 
 from backend_deposit.settings import TIME_ZONE
 from core.global_func import send_message_tg
+from core.heartbeat_func import heartbeat, serial_from_image_name
+from core.intake_func import intake_seen, remember_intake, INTAKE_SEEN_TIMEOUT
+from core.matcher_func import notify_new_incomings
+from core.outbox_func import enqueue_task
 from deposit import tasks
-from ocr.ocr_func import bytes_to_str, make_after_incoming_save, response_text_from_image
-from deposit.models import BadScreen, Incoming, TrashIncoming, Setting, BirpayOrder
+from ocr.ocr_func import bytes_to_str, make_after_incoming_save, response_text_from_image, ScreenOcrPipeline
+from deposit.models import BadScreen, Incoming, TrashIncoming, BirpayOrder, CardDayVolume
 from ocr.screen_response import screen_text_to_pay
 from deposit.serializers import IncomingSerializer, BirpayOrderSerializer
 from deposit.filters import BirpayOrderAPIFilter
@@ -34,6 +45,74 @@ logger = structlog.get_logger('deposit')
 TZ = pytz.timezone(TIME_ZONE)
 
 
+SCREEN_OCR_IN_FLIGHT_KEY = 'screen_ocr_in_flight'
+
+
+def screen_ocr_release():
+    """Уменьшение счетчика скринов в очереди распознавания"""
+    try:
+        cache.decr(SCREEN_OCR_IN_FLIGHT_KEY)
+        # Счетчик живет, пока задачи завершаются. Если воркеры встали - сбросится сам
+        cache.touch(SCREEN_OCR_IN_FLIGHT_KEY, settings.SCREEN_OCR_IN_FLIGHT_TTL)
+    except ValueError:
+        pass
+
+
+def screen_ocr_async() -> bool:
+    """
+    Распознавание в очереди включено (SCREEN_OCR_ASYNC) и возможно: счетчик очереди и результаты
+    хранятся в кэше, который должен быть общим для web и celery (CACHE_SHARED).
+    """
+    if not settings.SCREEN_OCR_ASYNC:
+        return False
+    if not settings.CACHE_SHARED:
+        logger.warning('SCREEN_OCR_ASYNC без общего кэша (redis_host) - скрины распознаются сразу')
+        return False
+    return True
+
+
+def enqueue_screen(image_bytes: bytes, name, worker, params: dict) -> HttpResponse | None:
+    """
+    Ставит скрин в очередь распознавания и сразу отвечает 202 с id.
+    При переполнении очереди - 429. Если задачу поставить не удалось - освобождает место
+    в очереди, удаляет файл и возвращает None (скрин распознается сразу).
+    """
+    cache.add(SCREEN_OCR_IN_FLIGHT_KEY, 0, timeout=settings.SCREEN_OCR_IN_FLIGHT_TTL)
+    in_flight = cache.incr(SCREEN_OCR_IN_FLIGHT_KEY)
+    if in_flight > settings.SCREEN_OCR_QUEUE_LIMIT:
+        screen_ocr_release()
+        logger.warning(f'Очередь распознавания скринов заполнена: {in_flight - 1}')
+        response = HttpResponse(status=status.HTTP_429_TOO_MANY_REQUESTS,
+                                reason='ocr queue is full',
+                                charset='utf-8')
+        response['Retry-After'] = '5'
+        return response
+    screen_id = uuid.uuid4().hex
+    path = default_storage.save(f'screen_queue/{screen_id}.jpg', ContentFile(image_bytes))
+    cache.set(f'screen_ocr_result:{screen_id}', {'status': status.HTTP_202_ACCEPTED, 'reason': 'queued'},
+              timeout=settings.SCREEN_OCR_RESULT_TTL)
+    try:
+        tasks.process_screen_task.delay(screen_id, path, name, worker, params)
+    except Exception as err:
+        logger.error(f'Не удалось поставить скрин {name} в очередь: {err}')
+        cache.delete(f'screen_ocr_result:{screen_id}')
+        default_storage.delete(path)
+        screen_ocr_release()
+        return None
+    logger.info(f'Скрин {name} от {worker} поставлен в очередь: {screen_id}')
+    return JsonResponse({'id': screen_id}, status=status.HTTP_202_ACCEPTED, reason='accepted')
+
+
+@api_view(['GET'])
+def screen_result(request: Request, screen_id: str):
+    """Результат распознавания скрина, поставленного в очередь"""
+    result = cache.get(f'screen_ocr_result:{screen_id}')
+    if result is None:
+        return JsonResponse({'id': screen_id, 'status': status.HTTP_404_NOT_FOUND, 'reason': 'unknown id'},
+                            status=status.HTTP_404_NOT_FOUND)
+    return JsonResponse({'id': screen_id, **result})
+
+
 @api_view(['POST'])
 def screen_new(request: Request):
     """
@@ -67,133 +146,158 @@ def screen_new(request: Request):
                                 reason='no screen',
                                 charset='utf-8')
         logger.info(f'Параметры response_screen_m10: {black}-{white} {lang} {oem} {psm} {len(image_bytes)}b')
-        char_whitelist = '+- :;*•0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz,.АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯабвгдеёжзийклмнопрстуфхцчшщъыьэюя'
-        first_stoke = response_text_from_image(image_bytes, y_start=5, y_end=10, x_start=10, x_end=100,
-                                               black=black, white=white,
-                                               oem=oem, psm=psm, lang=lang, strip=False,
-                                               char_whitelist=char_whitelist).strip()
-        amount = response_text_from_image(image_bytes, y_start=12, y_end=28,
-                                          black=black, white=white,
-                                          oem=oem, psm=psm, lang=lang, strip=False,
-                                          char_whitelist=char_whitelist).strip()
-        info = response_text_from_image(image_bytes, y_start=28, y_end=70,
-                                        black=black, white=white,
-                                        oem=oem, psm=4, lang=lang, strip=False,
-                                        char_whitelist=char_whitelist).strip()
-        logger.debug(f'convert_atb_value: {convert_atb_value(amount)}')
-        text = f'first: {first_stoke}\namount: {amount}\n{info}'
-        logger.debug(f'Распознан текст: {text}')
-        pay = screen_text_to_pay(text)
-        logger.debug(f'Распознан pay: {pay}')
-        pay_status = pay.pop('status')
-        errors = pay.pop('errors')
+        if screen_ocr_async():
+            response = enqueue_screen(image_bytes, name=name, worker=worker,
+                                      params={'black': black, 'white': white, 'lang': lang, 'oem': oem, 'psm': psm})
+            if response is not None:
+                return response
+        return recognize_screen(image_bytes, image, name=name, worker=worker,
+                                black=black, white=white, lang=lang, oem=oem, psm=psm)
 
-        if errors:
-            logger.warning(f'errors: {errors}')
-        sms_type = pay.get('type')
+    # Ошибка при обработке
+    except Exception as err:
+        logger.info(f'Ошибка при обработке скрина: {err}')
+        logger.error(err, exc_info=True)
+        logger.debug(f'{request.data}')
+        return HttpResponse(status=status.HTTP_400_BAD_REQUEST,
+                            reason=f'{err}',
+                            charset='utf-8')
 
-        if not sms_type:
-            # Действие если скрин не по известному шаблону
-            logger.info('скрин не по известному шаблону')
-            new_screen = BadScreen.objects.create(name=name, worker=worker, image=image)
-            logger.debug(f'BadScreen сохранен')
-            logger.debug(f'Возвращаем статус 200: not recognize')
-            # path = f'{host}{MEDIA_ROOT}{new_screen.image.url}'
-            path = f'{host}{new_screen.image.url}'
-            # msg = f'Пришел хреновый скрин с {worker}: {name}\n{path}'
-            # send_message_tg(message=msg, chat_ids=settings.ALARM_IDS)
+
+def recognize_screen(image_bytes: bytes, image, name, worker, black=182, white=255, lang='eng', oem=0, psm=6) -> HttpResponse:
+    """
+    Распознавание скрина и сохранение Incoming/BadScreen.
+    image - загруженный файл (сохраняется в Incoming/BadScreen).
+    """
+    char_whitelist = '+- :;*•0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz,.АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯабвгдеёжзийклмнопрстуфхцчшщъыьэюя'
+    pipeline = ScreenOcrPipeline(image_bytes, black=black, white=white)
+    texts = pipeline.read({
+        'first': {'y_start': 5, 'y_end': 10, 'x_start': 10, 'x_end': 100},
+        'amount': {'y_start': 12, 'y_end': 28},
+        'info': {'y_start': 28, 'y_end': 70, 'psm': 4},
+    }, lang=lang, oem=oem, psm=psm, char_whitelist=char_whitelist)
+    first_stoke, amount, info = texts['first'], texts['amount'], texts['info']
+    logger.info(f'Время распознавания скрина: {pipeline.timings_text()}')
+    logger.debug(f'convert_atb_value: {convert_atb_value(amount)}')
+    text = f'first: {first_stoke}\namount: {amount}\n{info}'
+    logger.debug(f'Распознан текст: {text}')
+    pay = screen_text_to_pay(text)
+    logger.debug(f'Распознан pay: {pay}')
+    pay_status = pay.pop('status')
+    errors = pay.pop('errors')
+
+    if errors:
+        logger.warning(f'errors: {errors}')
+    sms_type = pay.get('type')
+
+    if not sms_type:
+        # Действие если скрин не по известному шаблону
+        logger.info('скрин не по известному шаблону')
+        BadScreen.objects.create(name=name, worker=worker, image=image)
+        logger.debug(f'BadScreen сохранен')
+        logger.debug(f'Возвращаем статус 200: not recognize')
+        # msg = f'Пришел хреновый скрин с {worker}: {name}\n{path}'
+        # send_message_tg(message=msg, chat_ids=settings.ALARM_IDS)
+        return HttpResponse(status=status.HTTP_200_OK,
+                            reason='not recognize',
+                            charset='utf-8')
+
+    # Если шаблон найден:
+    if sms_type:
+        heartbeat('screen', worker, serial_from_image_name(name))
+
+        transaction_m10 = pay.get('transaction')
+        is_bad_status = pay_status.lower().replace(' ', '') not in ['успешно', 'success']
+        # Повтор уже принятого скрина отсекаем по кэшу без запросов в БД
+        seen = intake_seen('screen', transaction_m10) if transaction_m10 else None
+        if seen == 'incoming':
+            logger.info(f'Повтор скрина {transaction_m10}')
             return HttpResponse(status=status.HTTP_200_OK,
-                                reason='not recognize',
+                                reason='Incoming duplicate',
+                                charset='utf-8')
+        if seen == 'bad' and is_bad_status:
+            logger.info(f'Повтор плохого скрина {transaction_m10}')
+            return HttpResponse(status=status.HTTP_200_OK,
+                                reason='duplicate in BadScreen',
                                 charset='utf-8')
 
-        # Если шаблон найден:
-        if sms_type:
-            last_good_screen_time, _ = Setting.objects.get_or_create(name='last_good_screen_time')
-            last_good_screen_time.value = datetime.datetime.now().isoformat()
-            last_good_screen_time.save()
-
-            transaction_m10 = pay.get('transaction')
-            incoming_duplicate = Incoming.objects.filter(transaction=transaction_m10).all()
-            # Если дубликат:
-            if incoming_duplicate:
-                logger.info(f'Найден дубликат {incoming_duplicate}')
+        incoming_duplicate = Incoming.objects.filter(transaction=transaction_m10).all()
+        # Если дубликат:
+        if incoming_duplicate:
+            logger.info(f'Найден дубликат {incoming_duplicate}')
+            remember_intake('screen', transaction_m10, value='incoming')
+            return HttpResponse(status=status.HTTP_200_OK,
+                                reason='Incoming duplicate',
+                                charset='utf-8')
+        # Если статус отличается от 'успешно'
+        if is_bad_status:
+            logger.warning(f'Плохой статус: {pay}.')
+            # Проверяем на дубликат в BadScreen
+            is_duplicate = BadScreen.objects.filter(transaction=transaction_m10).exists()
+            remember_intake('screen', transaction_m10, value='bad')
+            if not is_duplicate:
+                logger.info('Сохраняем в BadScreen')
+                BadScreen.objects.create(name=name, worker=worker, image=image,
+                                         transaction=transaction_m10, type=sms_type)
                 return HttpResponse(status=status.HTTP_200_OK,
-                                    reason='Incoming duplicate',
+                                    reason='New BadScreen',
+                                    charset='utf-8')
+            else:
+                logger.info('Дубликат в BadScreen')
+                return HttpResponse(status=status.HTTP_200_OK,
+                                    reason='duplicate in BadScreen',
                                     charset='utf-8')
-            # Если статус отличается от 'успешно'
-            if pay_status.lower().replace(' ', '') not in ['успешно', 'success']:
-                logger.warning(f'Плохой статус: {pay}.')
-                # Проверяем на дубликат в BadScreen
-                is_duplicate = BadScreen.objects.filter(transaction=transaction_m10).exists()
-                if not is_duplicate:
-                    logger.info('Сохраняем в BadScreen')
-                    BadScreen.objects.create(name=name, worker=worker, image=image,
-                                             transaction=transaction_m10, type=sms_type)
-                    return HttpResponse(status=status.HTTP_200_OK,
-                                        reason='New BadScreen',
-                                        charset='utf-8')
-                else:
-                    logger.info('Дубликат в BadScreen')
-                    return HttpResponse(status=status.HTTP_200_OK,
-                                        reason='duplicate in BadScreen',
-                                        charset='utf-8')
-
-            # Действия со статусом Успешно
-            serializer = IncomingSerializer(data=pay)
-            if serializer.is_valid():
-                # Сохраянем Incoming
-                logger.info(f'Incoming serializer valid. Сохраняем транзакцию {transaction_m10}')
-                new_incoming = serializer.save(worker=worker, image=image)
 
-                # Логика после сохранения
-                make_after_incoming_save(new_incoming)
+        # Действия со статусом Успешно
+        serializer = IncomingSerializer(data=pay)
+        if serializer.is_valid():
+            # Сохраянем Incoming
+            logger.info(f'Incoming serializer valid. Сохраняем транзакцию {transaction_m10}')
+            new_incoming = serializer.save(worker=worker, image=image)
+            remember_intake('screen', transaction_m10, value='incoming')
 
-                # ОТправляем копию в Payment
-                logger.debug(f'Задача копию в Payment: {new_incoming.id}')
-                tasks.send_screen_to_payment.delay(new_incoming.id)
+            # Логика после сохранения
+            make_after_incoming_save(new_incoming)
 
-                # Сохраняем в базу-бота телеграм:
-                # logger.debug(f'Пробуем сохранить в базу бота: {new_incoming}')
-                # add_incoming_from_asu_to_bot_db(new_incoming)
+            # ОТправляем копию в Payment
+            logger.debug(f'Задача копию в Payment: {new_incoming.id}')
+            enqueue_task(tasks.send_screen_to_payment, args=[new_incoming.id],
+                         dedup_key=f'send_screen_to_payment:{new_incoming.id}')
 
+            # Сохраняем в базу-бота телеграм:
+            # logger.debug(f'Пробуем сохранить в базу бота: {new_incoming}')
+            # add_incoming_from_asu_to_bot_db(new_incoming)
 
-                return HttpResponse(status=status.HTTP_201_CREATED,
-                                    reason='created',
-                                    charset='utf-8')
-            else:
-                # Если не сохранилось в Incoming
-                logger.error('Incoming serializer invalid')
-                logger.error(f'serializer errors: {serializer.errors}')
-                transaction_error = serializer.errors.get('transaction')
-
-                # Если просто дубликат:
-                if transaction_error:
-                    transaction_error_code = transaction_error[0].code
-                    if transaction_error_code == 'unique':
-                        logger.info('Такая транзакция уже есть. Дупликат.')
-                        return HttpResponse(status=status.HTTP_201_CREATED,
-                                            reason='Incoming duplicate',
-                                            charset='utf-8')
 
-                # Обработа неизвестных ошибок при сохранении
-                logger.warning('Неизестная ошибка')
-                if not BadScreen.objects.filter(transaction=transaction_m10).exists():
-                    BadScreen.objects.create(name=name, worker=worker, transaction=transaction_m10, type=sms_type)
-                    return HttpResponse(status=status.HTTP_200_OK,
-                                        reason='invalid serializer. Add to trash',
+            return HttpResponse(status=status.HTTP_201_CREATED,
+                                reason='created',
+                                charset='utf-8')
+        else:
+            # Если не сохранилось в Incoming
+            logger.error('Incoming serializer invalid')
+            logger.error(f'serializer errors: {serializer.errors}')
+            transaction_error = serializer.errors.get('transaction')
+
+            # Если просто дубликат:
+            if transaction_error:
+                transaction_error_code = transaction_error[0].code
+                if transaction_error_code == 'unique':
+                    logger.info('Такая транзакция уже есть. Дупликат.')
+                    remember_intake('screen', transaction_m10, value='incoming')
+                    return HttpResponse(status=status.HTTP_201_CREATED,
+                                        reason='Incoming duplicate',
                                         charset='utf-8')
+
+            # Обработа неизвестных ошибок при сохранении
+            logger.warning('Неизестная ошибка')
+            if not BadScreen.objects.filter(transaction=transaction_m10).exists():
+                BadScreen.objects.create(name=name, worker=worker, transaction=transaction_m10, type=sms_type)
                 return HttpResponse(status=status.HTTP_200_OK,
-                                    reason='invalid serializer. Duplicate in trash',
+                                    reason='invalid serializer. Add to trash',
                                     charset='utf-8')
-
-    # Ошибка при обработке
-    except Exception as err:
-        logger.info(f'Ошибка при обработке скрина: {err}')
-        logger.error(err, exc_info=True)
-        logger.debug(f'{request.data}')
-        return HttpResponse(status=status.HTTP_400_BAD_REQUEST,
-                            reason=f'{err}',
-                            charset='utf-8')
+            return HttpResponse(status=status.HTTP_200_OK,
+                                reason='invalid serializer. Duplicate in trash',
+                                charset='utf-8')
 
 
 @api_view(['POST'])
@@ -253,9 +357,7 @@ def screen(request: Request):
 
         # Если шаблон найден:
         if sms_type:
-            last_good_screen_time, _ = Setting.objects.get_or_create(name='last_good_screen_time')
-            last_good_screen_time.value = datetime.datetime.now().isoformat()
-            last_good_screen_time.save()
+            heartbeat('screen', worker, serial_from_image_name(name))
 
             transaction_m10 = pay.get('transaction')
             incoming_duplicate = Incoming.objects.filter(transaction=transaction_m10).all()
@@ -405,7 +507,11 @@ def response_sms_template(text):
     return responsed_pay
 
 
-def analyse_sms_text_and_save(text, imei, sms_id, worker, *args, **kwargs):
+def parse_sms(text: str, imei, received=None) -> tuple[str, dict, list]:
+    """
+    Распознавание смс по шаблонам: (тип шаблона или '', поля Incoming, ошибки)
+    received - время получения смс для шаблонов без времени (по умолчанию - сейчас)
+    """
     errors = []
     fields = ['response_date', 'recipient', 'sender', 'pay', 'balance',
               'transaction', 'type']
@@ -426,19 +532,51 @@ def analyse_sms_text_and_save(text, imei, sms_id, worker, *args, **kwargs):
         responsed_pay['recipient'] = imei
     # Добавим время если нет
     if not responsed_pay.get('response_date'):
-        responsed_pay['response_date'] = timezone.now()
+        responsed_pay['response_date'] = received or timezone.now()
+    return text_sms_type, responsed_pay, errors
+
+
+# Шаблоны без времени: повтором считаем такую же смс за 12 часов
+NO_TIME_SMS_TYPES = ('sms8', 'sms7')
+NO_TIME_SMS_DEDUP_TIMEOUT = 60 * 60 * 12
+
+
+def sms_dedup_parts(text_sms_type: str, responsed_pay: dict) -> tuple[tuple, int]:
+    """Ключ повтора смс и сколько его помнить"""
+    if text_sms_type in NO_TIME_SMS_TYPES:
+        return ('no_time', responsed_pay.get('sender'), responsed_pay.get('pay'),
+                responsed_pay.get('balance')), NO_TIME_SMS_DEDUP_TIMEOUT
+    return (responsed_pay.get('response_date'), responsed_pay.get('sender'),
+            responsed_pay.get('pay'), responsed_pay.get('balance')), INTAKE_SEEN_TIMEOUT
+
+
+def no_time_dedup_timeout(first_register_date: datetime.datetime) -> int:
+    """Сколько еще помнить смс без времени: окно повтора отсчитывается от первой такой смс в БД"""
+    window_end = first_register_date + datetime.timedelta(seconds=NO_TIME_SMS_DEDUP_TIMEOUT)
+    return max(int((window_end - datetime.datetime.now(tz=TZ)).total_seconds()), 1)
+
+
+def analyse_sms_text_and_save(text, imei, sms_id, worker, *args, **kwargs):
+    text_sms_type, responsed_pay, errors = parse_sms(text, imei)
+    heartbeat('sms', worker or imei)
     if text_sms_type:
         logger.info(f'Сохраняем в базу{responsed_pay}')
-        if text_sms_type in ['sms8', 'sms7']:
-            # Шаблоны без времени
+        no_time = text_sms_type in NO_TIME_SMS_TYPES
+        dedup_parts, dedup_timeout = sms_dedup_parts(text_sms_type, responsed_pay)
+        # Повтор уже принятой смс отсекаем по кэшу без запроса в БД
+        is_duplicate = intake_seen('sms', *dedup_parts) is not None
+        if not is_duplicate and no_time:
             threshold = datetime.datetime.now(tz=TZ) - datetime.timedelta(hours=12)
-            is_duplicate = Incoming.objects.filter(
+            first_register_date = Incoming.objects.filter(
                 sender=responsed_pay.get('sender'),
                 pay=responsed_pay.get('pay'),
                 balance=responsed_pay.get('balance'),
                 register_date__gte=threshold
-            ).exists()
-        else:
+            ).order_by('register_date').values_list('register_date', flat=True).first()
+            is_duplicate = first_register_date is not None
+            if is_duplicate:
+                dedup_timeout = no_time_dedup_timeout(first_register_date)
+        elif not is_duplicate:
             is_duplicate = Incoming.objects.filter(
                 response_date=responsed_pay.get('response_date'),
                 sender=responsed_pay.get('sender'),
@@ -448,10 +586,12 @@ def analyse_sms_text_and_save(text, imei, sms_id, worker, *args, **kwargs):
 
         if is_duplicate:
             logger.info(f'Дубликат sms:\n\n{text}')
+            remember_intake('sms', *dedup_parts, timeout=dedup_timeout, first_only=True)
             msg = f'Дубликат sms:\n\n{text}'
             send_message_tg(message=msg, chat_ids=settings.ALARM_IDS)
         else:
             created = Incoming.objects.create(**responsed_pay, worker=worker or imei)
+            remember_intake('sms', *dedup_parts, timeout=dedup_timeout, first_only=True)
             logger.info(f'Создан: {created}')
 
     else:
@@ -461,6 +601,185 @@ def analyse_sms_text_and_save(text, imei, sms_id, worker, *args, **kwargs):
     return {'response': HttpResponse(sms_id), 'errors': errors}
 
 
+def _balance_order_key(response_date, balance, order):
+    # Порядок как в Incoming.calculate_balance_fields: response_date DESC (NULL первыми), balance DESC, id DESC
+    return response_date is None, response_date or datetime.datetime.min.replace(tzinfo=datetime.timezone.utc), \
+        balance, order
+
+
+def _last_balances(recipients: set[str]) -> dict[str, tuple]:
+    """Последняя запись с балансом по каждому получателю (без учета регистра) - один запрос"""
+    if not recipients:
+        return {}
+    rows = Incoming.objects.exclude(balance__isnull=True).annotate(
+        recipient_upper=Upper('recipient')
+    ).filter(recipient_upper__in=recipients).order_by(
+        'recipient_upper', F('response_date').desc(nulls_first=True), '-balance', '-id'
+    ).distinct('recipient_upper').values_list('recipient_upper', 'response_date', 'balance', 'id')
+    return {recipient: (_balance_order_key(response_date, balance, (0, pk)), balance)
+            for recipient, response_date, balance, pk in rows}
+
+
+def mark_sms_duplicates(parsed: list[dict], no_time_window: datetime.timedelta | None = datetime.timedelta(hours=12)):
+    """
+    Отмечает item['duplicate'] у распознанных смс (результат parse_sms + sms_dedup_parts):
+    повторы внутри пакета, по кэшу и одним запросом в БД.
+    no_time_window - за какое время искать в БД повторы смс без времени (None - вся история)
+    """
+    # Повторы: внутри пакета и по кэшу
+    batch_keys = set()
+    candidates = []
+    for item in parsed:
+        if item['dedup_parts'] in batch_keys or intake_seen('sms', *item['dedup_parts']) is not None:
+            item['duplicate'] = True
+        else:
+            batch_keys.add(item['dedup_parts'])
+            candidates.append(item)
+
+    # Повторы в БД - один запрос
+    if candidates:
+        threshold = datetime.datetime.now(tz=TZ) - no_time_window if no_time_window is not None else None
+        query = Q()
+        for item in candidates:
+            pay = item['pay']
+            if item['type'] in NO_TIME_SMS_TYPES:
+                no_time_query = Q(sender=pay.get('sender'), pay=pay.get('pay'), balance=pay.get('balance'))
+                if threshold is not None:
+                    no_time_query &= Q(register_date__gte=threshold)
+                query |= no_time_query
+            else:
+                query |= Q(response_date=pay.get('response_date'), sender=pay.get('sender'), pay=pay.get('pay'),
+                           balance=pay.get('balance'))
+        existing_keys = set()
+        # Первая смс без времени по ключу - от нее считается окно повтора
+        no_time_first = {}
+        for response_date, sender, pay_sum, balance, register_date in Incoming.objects.filter(query).values_list(
+                'response_date', 'sender', 'pay', 'balance', 'register_date'):
+            existing_keys.add((response_date, sender, pay_sum, balance))
+            no_time_key = ('no_time', sender, pay_sum, balance)
+            if (threshold is None or register_date >= threshold) and (
+                    no_time_key not in no_time_first or register_date < no_time_first[no_time_key]):
+                no_time_first[no_time_key] = register_date
+        for item in candidates:
+            if item['dedup_parts'] in existing_keys:
+                item['duplicate'] = True
+            elif item['dedup_parts'] in no_time_first:
+                item['duplicate'] = True
+                item['dedup_timeout'] = no_time_dedup_timeout(no_time_first[item['dedup_parts']])
+
+
+def build_sms_incomings(items: list[dict], chain_balances=True) -> list[Incoming]:
+    """
+    Несохраненные Incoming по распознанным смс.
+    chain_balances - prev_balance/check_balance по последней записи получателя в БД и порядку items
+    """
+    incomings = []
+    for item in items:
+        incoming = Incoming(**item['pay'], worker=item['worker'])
+        incoming.normalize_fields()
+        incomings.append(incoming)
+    if not chain_balances:
+        return incomings
+    last_balances = _last_balances({incoming.recipient.upper() for incoming in incomings if incoming.recipient})
+    for order, incoming in enumerate(incomings):
+        if not incoming.recipient:
+            continue
+        recipient = incoming.recipient.upper()
+        last = last_balances.get(recipient)
+        if last is not None:
+            incoming.prev_balance = last[1]
+            incoming.check_balance = incoming.prev_balance + incoming.pay
+        if incoming.balance is not None:
+            key = _balance_order_key(incoming.response_date, incoming.balance, (1, order))
+            if last is None or key > last[0]:
+                last_balances[recipient] = (key, incoming.balance)
+    return incomings
+
+
+def save_sms_batch(messages: list[dict]) -> list[dict]:
+    """
+    Пакетный прием смс: {id, message, imei, worker}.
+    Распознавание за один проход, повторы - внутри пакета, по кэшу и одним запросом в БД,
+    запись - bulk_create, prev_balance/check_balance считаются по получателю в порядке пакета.
+    Возвращает результат по каждой смс.
+    """
+    results = []
+    parsed = []
+    trash = []
+    all_errors = []
+    for num, item in enumerate(messages):
+        text = (item.get('message') or '').replace('\r\n', '\n').replace('\\n', '\n')
+        imei = item.get('imei')
+        worker = item.get('worker') or imei
+        result = {'id': item.get('id')}
+        results.append(result)
+        heartbeat('sms', worker)
+        try:
+            text_sms_type, responsed_pay, errors = parse_sms(text, imei)
+        except Exception as err:
+            logger.error(f'Ошибка распознавания смс {item.get("id")}: {err}', exc_info=True)
+            result.update(status='error', errors=[str(err)])
+            continue
+        if errors:
+            result['errors'] = errors
+            all_errors.append(f'{errors}\n{text}')
+        if not text_sms_type:
+            result['status'] = 'trash'
+            trash.append(TrashIncoming(text=text, worker=worker))
+            continue
+        dedup_parts, dedup_timeout = sms_dedup_parts(text_sms_type, responsed_pay)
+        parsed.append({'num': num, 'text': text, 'type': text_sms_type, 'pay': responsed_pay, 'worker': worker,
+                       'dedup_parts': dedup_parts, 'dedup_timeout': dedup_timeout})
+
+    mark_sms_duplicates(parsed)
+    new_items = [item for item in parsed if not item.get('duplicate')]
+    incomings = build_sms_incomings(new_items)
+
+    with transaction.atomic():
+        Incoming.objects.bulk_create(incomings)
+        TrashIncoming.objects.bulk_create(trash)
+        CardDayVolume.add_incomings(incomings)
+        # bulk_create не вызывает post_save - смс, которых ждут заявки, ставим на сопоставление здесь
+        notify_new_incomings(incomings)
+
+    for item, incoming in zip(new_items, incomings):
+        results[item['num']].update(status='created', incoming_id=incoming.id)
+        remember_intake('sms', *item['dedup_parts'], timeout=item['dedup_timeout'], first_only=True)
+    duplicates = [item for item in parsed if item.get('duplicate')]
+    for item in duplicates:
+        results[item['num']]['status'] = 'duplicate'
+        remember_intake('sms', *item['dedup_parts'], timeout=item['dedup_timeout'], first_only=True)
+    logger.info(f'Пакет смс: {len(messages)} шт, создано {len(incomings)}, повторов {len(duplicates)}, '
+                f'в мусор {len(trash)}')
+
+    # Одно сообщение на пакет вместо сообщения на каждую смс
+    if duplicates:
+        texts = '\n\n'.join(item['text'] for item in duplicates)
+        send_message_tg(message=f'Дубликаты sms ({len(duplicates)} шт):\n\n{texts}', chat_ids=settings.ALARM_IDS)
+    if all_errors:
+        send_message_tg(message=f'Ошибки при распознавании sms:\n' + '\n\n'.join(all_errors),
+                        chat_ids=settings.ALARM_IDS)
+    return results
+
+
+@api_view(['POST'])
+def sms_batch(request: Request):
+    """
+    Пакетный прием sms от шлюзов
+    [{"id": "...", "message": "...", "imei": "...", "worker": "..."}, ...] или {"messages": [...]}
+    """
+    messages = request.data
+    if isinstance(messages, dict):
+        messages = messages.get('messages')
+    if not isinstance(messages, list) or not all(isinstance(item, dict) for item in messages):
+        return JsonResponse({'error': 'expected list of messages'}, status=status.HTTP_400_BAD_REQUEST)
+    if len(messages) > settings.SMS_BATCH_LIMIT:
+        return JsonResponse({'error': f'too many messages, limit {settings.SMS_BATCH_LIMIT}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+    logger.info(f'Пакет sms: {len(messages)} шт')
+    return JsonResponse({'results': save_sms_batch(messages)})
+
+
 @api_view(['POST'])
 def sms(request: Request):
     """
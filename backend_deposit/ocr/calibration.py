@@ -0,0 +1,98 @@
+"""
+Локальный подбор порогов бинаризации (black, white) для скрина ScreenResponse.
+
+Скрин декодируется один раз, бинаризация по паре - одна векторная операция numpy над уже
+декодированной картинкой. Пары распознаются на пуле потоков: pytesseract запускает отдельный
+процесс tesseract на каждый вызов, поток только ждет его, поэтому пул работает и в воркере
+celery prefork (дочерние процессы из демонического процесса создавать нельзя).
+Распознанный текст разбирается в вызывающем потоке и сохраняется в ScreenResponsePart одним bulk_create.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import pytesseract
+import structlog
+
+logger = structlog.get_logger('deposit')
+
+RESPONSE_FIELDS = ('response_date', 'recipient', 'sender', 'pay', 'transaction')
+
+
+def decode_for_calibration(image_bytes: bytes) -> np.ndarray:
+    """Серое изображение без верхних 100 строк (как в bytes_to_str)"""
+    img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    return img[100:, :]
+
+
+def binarize(gray: np.ndarray, black: int, white: int) -> np.ndarray:
+    """То же, что cv2.threshold(gray, black, white, THRESH_BINARY)"""
+    return np.where(gray > black, np.uint8(white), np.uint8(0))
+
+
+def _ocr_pair(gray: np.ndarray, pair: tuple[int, int], lang='rus') -> tuple[int, int, str]:
+    black, white = pair
+    try:
+        text = pytesseract.image_to_string(binarize(gray, black, white), lang=lang, config='--oem 1', timeout=10)
+        return black, white, text.replace('\n', ' ')
+    except Exception as err:
+        logger.error(f'Ошибка распознавания пары {pair}: {err}')
+        return black, white, ''
+
+
+def sweep_texts(image_bytes: bytes, pairs: list[tuple[int, int]], threads: int = 1,
+                lang: str = 'rus') -> list[tuple[int, int, str]]:
+    """Распознает текст для всех пар в порядке pairs: threads=1 - в текущем потоке, иначе на пуле потоков"""
+    gray = decode_for_calibration(image_bytes)
+    if threads <= 1:
+        return [_ocr_pair(gray, pair, lang) for pair in pairs]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(lambda pair: _ocr_pair(gray, pair, lang), pairs))
+
+
+def calibrate_screen(screen_id: int, pairs: list[tuple[int, int]], threads: int = 1) -> int:
+    """
+    Подбор порогов для скрина: распознает еще не распознанные пары и сохраняет ScreenResponsePart
+    для пар, по которым распознан текст. Возвращает количество созданных частей.
+    """
+    from ocr.models import ScreenResponse, ScreenResponsePart
+    from ocr.screen_response import screen_text_to_pay
+
+    start = time.perf_counter()
+    screen = ScreenResponse.objects.get(id=screen_id)
+    ready_pairs = set(screen.parts.values_list('black', 'white'))
+    pairs = [tuple(pair) for pair in pairs if tuple(pair) not in ready_pairs]
+    if not pairs:
+        return 0
+    with screen.image.open('rb') as file:
+        image_bytes = file.read()
+    texts = sweep_texts(image_bytes, pairs, threads=threads)
+    logger.info(f'Скрин {screen_id}: распознано {len(texts)} пар за {time.perf_counter() - start:.1f} c')
+
+    parts = []
+    for black, white, text in texts:
+        if not text.strip():
+            continue
+        part = ScreenResponsePart(screen=screen, black=black, white=white)
+        pay = screen_text_to_pay(text)
+        for field in RESPONSE_FIELDS:
+            setattr(part, field, pay.get(field))
+        parts.append(part)
+    ScreenResponsePart.objects.bulk_create(parts, batch_size=500)
+    logger.info(f'Скрин {screen_id}: сохранено {len(parts)} частей за {time.perf_counter() - start:.1f} c')
+    return len(parts)
+
+
+def rank_pairs(screen) -> list[dict]:
+    """
+    Пары скрина по числу полей, совпавших с образцом (sample_*), лучшие первыми.
+    Пары с полным совпадением - это screen.good_pairs().
+    """
+    samples = {field: getattr(screen, f'sample_{field}') for field in RESPONSE_FIELDS}
+    ranked = []
+    for part in screen.parts.all():
+        score = sum(1 for field, sample in samples.items() if sample is not None and getattr(part, field) == sample)
+        ranked.append({'black': part.black, 'white': part.white, 'score': score})
+    ranked.sort(key=lambda x: (-x['score'], x['black'], x['white']))
+    return ranked
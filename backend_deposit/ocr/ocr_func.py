@@ -1,5 +1,7 @@
 import datetime
 import logging
+import threading
+import time
 from pathlib import Path
 from sys import platform
 
@@ -265,6 +267,111 @@ def make_after_save_deposit(instance):
         logger.error(err, exc_info=True)
 
 
+try:
+    # Если установлен tesserocr - распознаем через долгоживущий TessBaseAPI без запуска процесса на каждую область
+    import tesserocr
+    from PIL import Image
+except ImportError:
+    tesserocr = None
+
+_tess_local = threading.local()
+# Предел распознавания одной области, сек: pytesseract снимает процесс, tesserocr прерывает Recognize
+OCR_TIMEOUT = 10
+
+
+def _set_tesseract_cmd():
+    if platform == 'win32':
+        tespatch = Path('C:/') / 'Program Files' / 'Tesseract-OCR' / 'tesseract.exe'
+        pytesseract.pytesseract.tesseract_cmd = tespatch.as_posix()
+
+
+def _tesseract_config(oem, psm, char_whitelist=None) -> str:
+    config = f'--psm {psm} --oem {oem}'
+    if char_whitelist:
+        config += f'-c tessedit_char_whitelist="{char_whitelist}"'
+    return config
+
+
+def _get_tess_api(lang: str, oem: int):
+    """TessBaseAPI на поток, переиспользуется между запросами"""
+    apis = getattr(_tess_local, 'apis', None)
+    if apis is None:
+        apis = _tess_local.apis = {}
+    api = apis.get((lang, oem))
+    if api is None:
+        api = tesserocr.PyTessBaseAPI(lang=lang, oem=tesserocr.OEM(oem))
+        apis[(lang, oem)] = api
+    return api
+
+
+class ScreenOcrPipeline:
+    """
+    Распознавание нескольких областей одного скрина.
+    Картинка декодируется и бинаризуется один раз, области - срезы numpy без копирования.
+    timings - время этапов в секундах.
+    """
+
+    def __init__(self, source: Path | bytes, black=90, white=250):
+        self.timings = {}
+        start = time.perf_counter()
+        if isinstance(source, Path):
+            img = cv2.imdecode(np.fromfile(source, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        else:
+            img = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        self.timings['decode'] = time.perf_counter() - start
+        start = time.perf_counter()
+        # Порог попиксельный, поэтому бинаризация всей картинки равна бинаризации каждой области
+        _, self.binary = cv2.threshold(img, black, white, cv2.THRESH_BINARY)
+        self.timings['threshold'] = time.perf_counter() - start
+        self.height, self.width = self.binary.shape
+
+    def crop(self, y_start=None, y_end=None, x_start=None, x_end=None, strip=False) -> np.ndarray:
+        """Область в % от размеров картинки (как в response_text_from_image)"""
+        img = self.binary
+        height, width = self.height, self.width
+        if y_start and y_end:
+            if strip:
+                img = img[int(y_start / 100 * height):int(y_end / 100 * height), int(20 / 100 * width):int(80 / 100 * width)]
+            else:
+                img = img[int(y_start / 100 * height):int(y_end / 100 * height), :]
+        if x_start and x_end:
+            img = img[:, int(x_start / 100 * width):int(x_end / 100 * width)]
+        return img
+
+    def ocr(self, img: np.ndarray, lang='eng', oem=0, psm=6, char_whitelist=None) -> str:
+        if tesserocr is not None:
+            # Белый список символов не передаем: в конфиге pytesseract он склеен с --oem без пробела
+            # и tesseract его не применяет, результаты должны совпадать
+            api = _get_tess_api(lang, oem)
+            api.SetPageSegMode(tesserocr.PSM(psm))
+            api.SetImage(Image.fromarray(np.ascontiguousarray(img)))
+            if not api.Recognize(timeout=OCR_TIMEOUT * 1000):
+                # Как pytesseract по timeout: области без текста, а не зависший воркер
+                raise RuntimeError('Tesseract process timeout')
+            return api.GetUTF8Text().strip()
+        _set_tesseract_cmd()
+        config = _tesseract_config(oem, psm, char_whitelist)
+        return pytesseract.image_to_string(img, lang=lang, config=config, timeout=OCR_TIMEOUT).strip()
+
+    def read(self, regions: dict[str, dict], lang='eng', oem=0, psm=6, char_whitelist=None) -> dict[str, str]:
+        """
+        Распознает области.
+        regions: {'имя': {'y_start': .., 'y_end': .., 'x_start': .., 'x_end': .., 'strip': .., 'psm': ..}}
+        """
+        result = {}
+        for name, region in regions.items():
+            region = dict(region)
+            region_psm = region.pop('psm', psm)
+            start = time.perf_counter()
+            result[name] = self.ocr(self.crop(**region), lang=lang, oem=oem, psm=region_psm,
+                                    char_whitelist=char_whitelist)
+            self.timings[f'ocr_{name}'] = time.perf_counter() - start
+        return result
+
+    def timings_text(self) -> str:
+        return ', '.join(f'{name}: {round(value * 1000)} мс' for name, value in self.timings.items())
+
+
 def response_text_from_image(source: Path | bytes, y_start=None, y_end=None, x_start=None, x_end=None, strip=False, black=90, white=250, lang='eng',
                              oem=0, psm=6, char_whitelist=None) -> str:
     """
@@ -285,28 +392,8 @@ def response_text_from_image(source: Path | bytes, y_start=None, y_end=None, x_s
     -------
 
     """
-    if platform == 'win32':
-        tespatch = Path('C:/') / 'Program Files' / 'Tesseract-OCR' / 'tesseract.exe'
-        pytesseract.pytesseract.tesseract_cmd = tespatch.as_posix()
-    if isinstance(source, Path):
-        img = cv2.imdecode(np.fromfile(source, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
-    else:
-        img = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
-    height, width = img.shape
-    if y_start and y_end:
-        if strip:
-            img = img[int(y_start / 100 * height):int(y_end / 100 * height), int(20 / 100 * width):int(80 / 100 * width)]
-        else:
-            img = img[int(y_start / 100 * height):int(y_end / 100 * height), :]
-    if x_start and x_end:
-        img = img[:, int(x_start / 100 * width):int(x_end / 100 * width)]
-    _, binary = cv2.threshold(img, black, white, cv2.THRESH_BINARY)
-    # cv2.imwrite('preview.jpg', binary)
-    # cv2.imshow('imname', img)
-    # cv2.waitKey(0)
-    config = f'--psm {psm} --oem {oem}'
-    if char_whitelist:
-        config += f'-c tessedit_char_whitelist="{char_whitelist}"'
-    response_text = (pytesseract.image_to_string(binary, lang=lang, config=config, timeout=10)).strip()
+    pipeline = ScreenOcrPipeline(source, black=black, white=white)
+    img = pipeline.crop(y_start=y_start, y_end=y_end, x_start=x_start, x_end=x_end, strip=strip)
+    response_text = pipeline.ocr(img, lang=lang, oem=oem, psm=psm, char_whitelist=char_whitelist)
     logger.info(response_text)
     return response_text
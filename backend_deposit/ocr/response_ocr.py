@@ -24,7 +24,9 @@ django.setup()
 
 from ocr.models import ScreenResponsePart, ScreenResponse
 
+from backend_deposit import settings
 from backend_deposit.settings import BASE_DIR
+from ocr.calibration import sweep_texts
 from ocr.screen_response import screen_text_to_pay
 
 
@@ -78,63 +80,34 @@ async def create_atb_from_part(bytes, black, white, oem='0', psm='6') -> str:
     # return text
 
 
-async def main():
+def main():
+    """Подбор порогов для тестового скрина: пары распознаются локально тем же пулом, что и в celery"""
     path = BASE_DIR / 'test' / 'ocr_test' / 'atb6.jpg'
     print(path)
     ready_pairs = []
     if Path(f'{path.name}.txt').exists():
         with open(f'{path.name}.txt', 'r', encoding='utf-8') as file:
             for line in file.readlines():
-                print(line)
                 finded_pair = re.findall(r'(\d{1,3})-(\d{1,3})', line)
-                print(finded_pair)
                 if finded_pair:
                     ready_pairs.append((int(finded_pair[0][0]), int(finded_pair[0][1])))
         print(ready_pairs)
-    # screen, _ = ScreenResponse.objects.get_or_create(name=path.name)
-    # if not screen.image:
-    #     screen.image.save(content=file, name=f'{path.name}', save=False)
-    #     screen.save()
-
-    # blacks = screen.parts.values('black', 'white')
-    # ready_pairs = set((x['black'], x['white']) for x in blacks)
-    # all_values = range(0, 256)
-    # comb = list(itertools.permutations(all_values, 2))
-    comb = []
-    for i in range(0, 256):
-        comb.append((i, 255))
-    print(len(comb))
-    # for x in comb:
-    #     print(x)
-    # print(f'Распознанных частей для {screen}: {len(ready_pairs)} из {len(comb)}')
-    unready_pairs = []
-    for num, pair in enumerate(comb):
-        if pair in ready_pairs:
-            continue
-        unready_pairs.append(pair)
+    comb = [(i, 255) for i in range(0, 256)]
+    unready_pairs = [pair for pair in comb if pair not in ready_pairs]
     print(len(unready_pairs))
-        # break
+    with open(path, "rb") as binary:
+        image_bytes = binary.read()
     chank = 10
     for i in range(0, len(unready_pairs), chank):
-        pairs = unready_pairs[i:i+chank]
-        tasks = []
-        with open(path, "rb") as binary:
-            binary = binary.read()
-            for i in range(0, chank):
-                # task = create_response_part(binary, black=pairs[i][0], white=pairs[i][1])
-                task = create_atb_from_part(binary, black=pairs[i][0], white=pairs[i][1])
-                # create_atb_from_part
-                tasks.append(task)
-            result = await asyncio.gather(*tasks)
-            print(result)
-            try:
-                with open(f'{path.name}.txt', 'a', encoding='utf-8') as file:
-                    for i in range(chank):
-                        file.write(f'({pairs[i][0]}-{pairs[i][1]}) {str(result[i])}\n')
-            except Exception as err:
-                print(err)
-
-    # create_response_part(screen.id, black=251, white=4)
+        result = sweep_texts(image_bytes, unready_pairs[i:i + chank], threads=settings.OCR_CALIBRATION_THREADS,
+                             lang='eng')
+        print(result)
+        try:
+            with open(f'{path.name}.txt', 'a', encoding='utf-8') as file:
+                for black, white, text in result:
+                    file.write(f'({black}-{white}) {text}\n')
+        except Exception as err:
+            print(err)
 
 
 async def main2():
@@ -154,7 +127,7 @@ async def main2():
 
 
 if __name__ == '__main__':
-    # asyncio.run(main())
+    # main()
     asyncio.run(main2())
     pass
 
@@ -1,14 +1,14 @@
 import logging
 import time
 
-import requests
 import structlog
 from celery import shared_task, group, chunks
 from celery.utils.log import get_task_logger
 from django.contrib.auth import get_user_model
 
-from backend_deposit.settings import REMOTE_SERVER
-from ocr.models import ScreenResponse, ScreenResponsePart
+from django.conf import settings
+
+from ocr.calibration import calibrate_screen
 
 
 User = get_user_model()
@@ -16,69 +16,19 @@ User = get_user_model()
 logger = structlog.get_logger('deposit')
 
 
-@shared_task(priority=2)
+@shared_task(priority=2, time_limit=1800)
 def response_parts(screen_id: int, pairs: list):
-    """Задача для отправки пар в очередь на распознавание"""
+    """Подбор порогов для скрина: локальное распознавание пар на пуле потоков"""
     try:
-        logger.info(f'Для добавления в очередь передано {len(pairs)} пар для скрина {screen_id}')
+        logger.info(f'Для распознавания передано {len(pairs)} пар для скрина {screen_id}')
         start = time.perf_counter()
-        # Передадим имя, изображение и создадим его на удаленном сервере если его нет. Получим id ScreenResponse
-
-        # Создание или получение скрина распознавания на удаленном сервере
-        screen = ScreenResponse.objects.get(id=screen_id)
-        image = screen.image.read()
-        files = {'image': image}
-        logger.info(f'Отправляем запрос Имя {screen.name}, источник {screen.source} картинка {screen.image}')
-        response = requests.post(REMOTE_SERVER + '/ocr/create_screen/',
-                                 data={'name': screen.name, 'source': screen.source},
-                                 files=files,
-                                 timeout=10)
-        logger.info(response.status_code)
-        data = response.json()
-        logger.info(f'response data: {data}')
-        remote_screen_id = data.get('id')
-        logger.info(f'Удаленный screen_id: {remote_screen_id}')
-
-        # Создадим задачи для распознавания
-        for i, pair in enumerate(pairs):
-            remote_response_pair.delay(screen_id, remote_screen_id, pair)
-            time.sleep(0.01)
-
-            # if i > 1000:
-            #     break
-        logger.info(f'Отправлено {i} пар в очередь за {time.perf_counter() - start}')
+        created = calibrate_screen(screen_id, pairs, threads=settings.OCR_CALIBRATION_THREADS)
+        logger.info(f'Распознано {created} пар для скрина {screen_id} за {time.perf_counter() - start:.1f} c')
+        return created
     except Exception as err:
-        logger.error(err)
+        logger.error(err, exc_info=True)
 
 
-@shared_task(priority=3)
-def remote_response_pair(screen_id: int, remote_screen_id: int, pair):
-    try:
-        black = pair[0]
-        white = pair[1]
-        screen = ScreenResponse.objects.get(id=screen_id)
-        part = ScreenResponsePart.objects.filter(screen=screen, black=black, white=white).exists()
-        if part:
-            return f'pair {pair} is present'
-        ENDPOINT = REMOTE_SERVER + '/ocr/reponse_screen/'
-        logger.info(f'Отправляем на {ENDPOINT} {screen_id} {pair}')
-        response = requests.post(ENDPOINT, data={'id': remote_screen_id, 'black': black, 'white': white}, timeout=10)
-        logger.info(f'response: {response}')
-        data = response.json()
-        if data:
-
-            part, _ = ScreenResponsePart.objects.get_or_create(screen=screen, black=black, white=white)
-            for name, values in data.items():
-                try:
-                    setattr(part, name, values)
-                except KeyError:
-                    pass
-            part.save()
-            print(part)
-            return f'pair  {pair}  or screen {screen_id} created'
-    except Exception as err:
-        logger.error(err)
-
 # @shared_task(priority=3)
 # def create_response_part(screen_id, black, white) -> str:
 #     """Создает новое распознавание скрина с заданными параметрами"""
@@ -1,5 +1,6 @@
 import datetime
 import logging
+import re
 
 import pytz
 import structlog
@@ -23,30 +24,72 @@ def get_unrecognized_field_error_text(response_fields, result):
     return errors
 
 
+DATE_FORMATS = (
+    'iso',
+    '%d/%m/%y %H:%M:%S',
+    '%d.%m.%y %H:%M',
+    '%H:%M %d.%m.%y',
+    '%d %B %Y %H:%M',
+    '%d %B %Y%H:%M',
+    '%d.%m.%Y %H:%M',
+)
+# Числовые директивы разбираются готовой регуляркой вместо strptime
+_DIRECTIVES = {'%d': 'day', '%m': 'month', '%y': 'year2', '%Y': 'year', '%H': 'hour', '%M': 'minute', '%S': 'second'}
+
+
+def _compile_date_format(date_format: str):
+    """Регулярка для формата из числовых директив или None (тогда strptime)"""
+    if date_format == 'iso' or '%B' in date_format:
+        return None
+    # Пробел в формате, как в strptime, - любое количество пробельных символов
+    pattern = re.sub(r'(\\ )+', r'\\s+', re.escape(date_format))
+    for directive, name in _DIRECTIVES.items():
+        width = r'\d{4}' if directive == '%Y' else r'\d{2}' if directive == '%y' else r'\d{1,2}'
+        pattern = pattern.replace(re.escape(directive), f'(?P<{name}>{width})')
+    return re.compile(pattern)
+
+
+_COMPILED_FORMATS = {date_format: _compile_date_format(date_format) for date_format in DATE_FORMATS}
+# Формат, подошедший для строки такого же вида (цифры -> 9): у шаблона смс вид даты постоянный
+_format_by_shape: dict[str, str] = {}
+_SHAPE_TRANS = str.maketrans('0123456789', '9999999999')
+
+
+def _parse_date_format(text: str, date_format: str) -> datetime.datetime:
+    """Разбор строки в naive datetime по формату. ValueError если не подходит"""
+    if date_format == 'iso':
+        return datetime.datetime.fromisoformat(text)
+    compiled = _COMPILED_FORMATS.get(date_format)
+    if compiled is None:
+        return datetime.datetime.strptime(text, date_format)
+    match = compiled.fullmatch(text)
+    if not match:
+        raise ValueError(f'{text} не соответствует формату {date_format}')
+    parts = match.groupdict()
+    if 'year2' in parts:
+        # Как strptime %y: 69-99 -> 19xx, 00-68 -> 20xx
+        year2 = int(parts.pop('year2'))
+        parts['year'] = year2 + (1900 if year2 >= 69 else 2000)
+    return datetime.datetime(**{name: int(value) for name, value in parts.items()})
+
+
 def date_response(data_text: str) -> datetime.datetime:
     """Преобразование строки в datetime"""
     # logger.debug(f'Распознавание даты из текста: {data_text}')
-    try:
-        native_datetime = datetime.datetime.fromisoformat(data_text.strip()) - datetime.timedelta(hours=1)
-        response_data = tz.localize(native_datetime)
-        return response_data
-    except ValueError:
-        pass
-    formats = [
-        '%d/%m/%y %H:%M:%S',
-        '%d.%m.%y %H:%M',
-        '%H:%M %d.%m.%y',
-        '%d %B %Y %H:%M',
-        '%d %B %Y%H:%M',
-        '%d.%m.%Y %H:%M'
-    ]
+    text = data_text.strip()
+    shape = text.translate(_SHAPE_TRANS)
+    known_format = _format_by_shape.get(shape)
+    formats = (known_format,) + DATE_FORMATS if known_format else DATE_FORMATS
     for date_format in formats:
         try:
-            native_datetime = datetime.datetime.strptime(data_text.strip(), date_format) - datetime.timedelta(hours=1)
-            response_data = tz.localize(native_datetime)
-            return response_data
-        except ValueError as e:
-            # print(e)
+            parsed = _parse_date_format(text, date_format)
+            if date_format != known_format and len(_format_by_shape) < 1000:
+                _format_by_shape[shape] = date_format
+            if parsed.tzinfo is not None:
+                # В строке ISO уже есть смещение - время однозначное, сдвиг на час не нужен
+                return parsed.astimezone(tz)
+            return tz.localize(parsed - datetime.timedelta(hours=1))
+        except ValueError:
             pass
         except Exception as err:
             err_log.error(f'Ошибка распознавания даты из текста: {err}')
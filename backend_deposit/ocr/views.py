@@ -13,6 +13,7 @@ from django.views.generic import ListView, CreateView, DetailView, UpdateView
 from backend_deposit.settings import REMOTE_SERVER
 from ocr.forms import ScreenForm, ScreenDeviceSelectFrom
 from ocr.models import ScreenResponse
+from ocr.calibration import rank_pairs
 from ocr.tasks import response_parts
 
 logger = structlog.get_logger('deposit')
@@ -118,4 +119,5 @@ class ScreenListDetail(PermissionRequiredMixin, UpdateView, DetailView):
         context['recipients'] = recipients
         context['senders'] = senders
         context['response_dates'] = response_dates
+        context['ranked_pairs'] = rank_pairs(screen)[:20]
         return context
@@ -11,6 +11,7 @@ from django.http import HttpResponse, JsonResponse
 from rest_framework.decorators import api_view
 from rest_framework.request import Request
 
+from core.outbox_func import enqueue_task
 from deposit import tasks
 from ocr.models import ScreenResponse
 from ocr.ocr_func import bytes_to_str, response_text_from_image, date_m10_response
@@ -244,7 +245,8 @@ def receive_pay(request: Request):
             new_pay.image = image
             new_pay.save()
             new_pay.refresh_from_db()
-            tasks.send_screen_to_payment.delay(new_pay.id)
+            enqueue_task(tasks.send_screen_to_payment, args=[new_pay.id],
+                         dedup_key=f'send_screen_to_payment:{new_pay.id}')
             return HttpResponse(status=HTTPStatus.CREATED)
         return HttpResponse(status=HTTPStatus.OK)
     except Exception as err:
@@ -1,12 +1,16 @@
+import copy
+import time
+
 from django.apps import apps
 from django.conf import settings
 from django.contrib import admin
 from django.contrib.postgres.fields import ArrayField
+from django.core.cache import cache
 from django.core.mail import send_mail
 from django.contrib.auth.base_user import AbstractBaseUser
 from django.contrib.auth.models import PermissionsMixin, Group
 from django.contrib.auth.validators import UnicodeUsernameValidator
-from django.db import models
+from django.db import models, transaction
 from django.db.models.signals import post_save, pre_save
 from django.dispatch import receiver
 from django.core.exceptions import ValidationError
@@ -276,19 +280,93 @@ def update_card_monitoring_status(sender, instance, created, **kwargs):
 
 
 class SingletonModel(models.Model):
+    """
+    Модель с одной записью.
+    load() отдает копию записи из памяти процесса: БД не читается чаще чем раз в cache_max_age секунд,
+    а после cache_ttl сверяется номер версии в общем кэше, который увеличивается после коммита save().
+    Без общего кэша (CACHE_SHARED) версию из других процессов не увидеть - БД перечитывается через cache_ttl.
+    """
+    # Через сколько секунд сверять версию в общем кэше
+    cache_ttl = 5
+    # Через сколько секунд перечитывать из БД в любом случае
+    cache_max_age = 60
+    # {класс: (объект, время загрузки, время проверки версии, версия)}
+    _loaded = {}
+
     class Meta:
         abstract = True
 
     def save(self, *args, **kwargs):
         self.__class__.objects.exclude(id=self.id).delete()
         super(SingletonModel, self).save(*args, **kwargs)
+        self.__class__._changed()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        self.__class__._changed()
+        return result
 
     @classmethod
-    def load(cls):
+    def _changed(cls):
+        # Своя копия сбрасывается сразу, другие процессы узнают об изменении только после коммита,
+        # иначе они перечитают из БД старую запись и будут держать ее до cache_max_age
+        SingletonModel._loaded.pop(cls, None)
+        transaction.on_commit(cls.invalidate)
+
+    @classmethod
+    def _version_key(cls) -> str:
+        return f'singleton_version:{cls._meta.label_lower}'
+
+    @classmethod
+    def invalidate(cls):
+        """Сброс копии в памяти и увеличение версии для других процессов"""
+        SingletonModel._loaded.pop(cls, None)
         try:
-            return cls.objects.get()
+            cache.incr(cls._version_key())
+        except ValueError:
+            cache.set(cls._version_key(), 1, timeout=None)
+
+    def on_load(self):
+        """Подготовка производных значений после чтения из БД"""
+
+    @classmethod
+    def cached(cls):
+        """
+        Общий экземпляр из памяти процесса (перечитывается по версии и cache_max_age).
+        Только для чтения: изменять его нельзя, для изменений - load()
+        """
+        now = time.monotonic()
+        cached = SingletonModel._loaded.get(cls)
+        if cached:
+            obj, loaded_at, checked_at, version = cached
+            max_age = cls.cache_max_age if settings.CACHE_SHARED else cls.cache_ttl
+            if now - loaded_at < max_age:
+                if now - checked_at < cls.cache_ttl:
+                    return obj
+                if cache.get(cls._version_key()) == version:
+                    SingletonModel._loaded[cls] = (obj, loaded_at, now, version)
+                    return obj
+        version = cache.get(cls._version_key())
+        try:
+            obj = cls.objects.get()
         except cls.DoesNotExist:
-            return cls()
+            obj = cls()
+        obj.on_load()
+        SingletonModel._loaded[cls] = (obj, now, now, version)
+        return obj
+
+    @classmethod
+    def load(cls):
+        """
+        Копия общего экземпляра: копируются только изменяемые значения полей (списки, словари),
+        неизменяемые производные значения (frozenset из on_load) общие
+        """
+        obj = copy.copy(cls.cached())
+        for field in obj._meta.concrete_fields:
+            value = obj.__dict__.get(field.attname)
+            if isinstance(value, (list, dict, set)):
+                obj.__dict__[field.attname] = copy.deepcopy(value)
+        return obj
 
 
 class Options(SingletonModel):
@@ -314,7 +392,19 @@ class Options(SingletonModel):
     birpay_painter_list = ArrayField(models.CharField(max_length=1000), blank=True, default=list)
     card_monitoring_minutes = models.PositiveIntegerField(verbose_name='Время мониторинга карт (минуты)', default=20)
 
+    # Списки в виде frozenset для проверки принадлежности без перебора
+    moshennik_set = frozenset()
+    painter_set = frozenset()
 
+    def on_load(self):
+        self.moshennik_set = frozenset(self.birpay_moshennik_list)
+        self.painter_set = frozenset(self.birpay_painter_list)
+
+    @classmethod
+    def fraud_sets(cls) -> tuple[frozenset, frozenset]:
+        """(мошенники, художники) из общего экземпляра - без копирования Options на каждую проверку"""
+        options = cls.cached()
+        return options.moshennik_set, options.painter_set
 
     def __str__(self):
         return f'Options({self.birpay_check})'
@@ -58,6 +58,17 @@ class TrashIncoming(Base):
     text: Mapped[str] = mapped_column(Text())
 
 
+class CardDayVolume(Base):
+    """Объемы поступлений по карте за день (заполняет backend_deposit)"""
+    __tablename__ = 'deposit_carddayvolume'
+    id: Mapped[int] = mapped_column(BigInteger(), primary_key=True)
+    recipient: Mapped[str] = mapped_column(String(50))
+    day: Mapped[datetime.date] = mapped_column(Date())
+    count: Mapped[int] = mapped_column(Integer())
+    sum: Mapped[float] = mapped_column(Float())
+    last_date: Mapped[time] = mapped_column(DateTime(timezone=True), nullable=True)
+
+
 # if not database_exists(db_url):
 #     create_database(db_url)
 
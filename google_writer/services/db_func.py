@@ -2,11 +2,11 @@ import asyncio
 import time
 import datetime
 
-from sqlalchemy import select, func, Date, Time, and_
+from sqlalchemy import select, func, Date, Time, and_, or_, case, desc
 from sqlalchemy.exc import IntegrityError
 
 from config_data.bot_conf import get_my_loggers, tz
-from database.db import Session, Incoming, TrashIncoming
+from database.db import Session, Incoming, TrashIncoming, CardDayVolume
 
 logger, err_log, logger1, logger2 = get_my_loggers()
 
@@ -68,12 +68,12 @@ def add_to_trash(text: str):
         raise err
 
 
-def read_new_incomings(last_num=0, sms_types: list[str] = []):
+def read_new_incomings(last_num=0, sms_types: list[str] = [], limit: int = None):
     logger.debug(f'Читаем базу где id > {last_num}')
     try:
         session = Session()
         with session:
-            incomings = select(Incoming).where(Incoming.id > last_num).order_by('id')
+            incomings = select(Incoming).where(Incoming.id > last_num).order_by('id').limit(limit)
             res = session.scalars(incomings).all()
             logger.debug(f'Результат {res}')
             return res
@@ -81,11 +81,11 @@ def read_new_incomings(last_num=0, sms_types: list[str] = []):
         logger.debug(f'Ошибка при чтении базы', exc_info=True)
 
 
-def read_new_trashincomings(last_num=0):
+def read_new_trashincomings(last_num=0, limit: int = None):
     try:
         session = Session()
         with session:
-            incomings = select(TrashIncoming).where(TrashIncoming.id > last_num).order_by('id')
+            incomings = select(TrashIncoming).where(TrashIncoming.id > last_num).order_by('id').limit(limit)
             res = session.scalars(incomings).all()
             logger.debug(f'Результат {res}')
             return res
@@ -111,107 +111,76 @@ def find_new_out(last_num=0):
         raise err
 
 
-def get_day_report_rows():
-    logger.debug(f'Считаем сменные отчеты')
-
-    def bad_ids():
-        """
-        Функция аходит id которые не надо учитывать:
-        m10 с отправителем картой
-        m10 sender с полным номером телефона кроме 00 000 00 00
-        :return:
-        """
-        session = Session()
-        with session:
-            # m10 с отправителем картой
-            finded_sender_as_card = select(Incoming).where(Incoming.type.in_(['m10', 'm10_short'])).filter(
-                    Incoming.sender.regexp_match(r'\d\d\d\d \d\d.*\d\d\d\d')
-            ).distinct()
-            finded_sender_as_card = session.execute(finded_sender_as_card).scalars().all()
-            # print(finded_sender_as_card)
-
-            # m10 sender с полным номером телефона кроме 00 000 00 00
-            finded_sender_full_phone = select(Incoming).where(Incoming.type.in_(['m10', 'm10_short'])).filter(
-                Incoming.sender.regexp_match(r'\d\d\d \d\d \d\d\d \d\d \d\d')).filter(~
-                Incoming.sender.regexp_match(r'00 000 00 00')).distinct()
-            finded_sender_full_phone = session.execute(finded_sender_full_phone).scalars().all()
-            # print(finded_sender_full_phone)
-
-            finded_total_bad_sender = set()
-            finded_total_bad_ids = set()
-
-            total_bad_incomings = finded_sender_as_card + finded_sender_full_phone
-
-            for bad in total_bad_incomings:
-                finded_total_bad_sender.add(bad.sender)
-                finded_total_bad_ids.add(bad.id)
-            logger1.info(f'Не учитываются sender: {len(finded_total_bad_sender)} шт: {finded_total_bad_sender}')
-            logger1.info(f'Ид которые не учитываются: {len(finded_total_bad_ids)} шт: {finded_total_bad_ids}')
-        return [finded_total_bad_ids, finded_total_bad_sender]
-
-    def period_report(start='00:00', end='23:59:59.999999', sended_bad_ids=[]):
-        """
-        Находит сумму и количество pay за период времени
-        :param start: '00:00'
-        :param end: '23:59:59.999999'
-        :sended_bad_ids: id которые не учитываются
-        :return: [(datetime.date(2023, 8, 26), 500.0, 1)]
-        """
-
-        # Найдем кроме тех что выше:
-        step = select(func.cast(Incoming.register_date, Date),
-                      func.sum(Incoming.pay),
-                      func.count(Incoming.pay)).where(
-            and_(func.cast(Incoming.register_date, Time) >= start, func.cast(Incoming.register_date, Time) <= end)
-        ).where(Incoming.pay > 0).where(Incoming.id.not_in(sended_bad_ids)).group_by(
-            func.cast(Incoming.register_date, Date)
+def bad_incoming_predicate():
+    """
+    Условие для строк, которые не учитываются в сменных отчетах:
+    m10 с отправителем картой,
+    m10 sender с полным номером телефона кроме 00 000 00 00
+    """
+    return and_(
+        Incoming.type.in_(['m10', 'm10_short']),
+        or_(
+            Incoming.sender.regexp_match(r'\d\d\d\d \d\d.*\d\d\d\d'),
+            and_(Incoming.sender.regexp_match(r'\d\d\d \d\d \d\d\d \d\d \d\d'),
+                 ~Incoming.sender.regexp_match(r'00 000 00 00')),
         )
-        return step
+    )
 
+
+def get_day_report_rows(days: int = 90):
+    """
+    Сменные отчеты за последние days дней одним запросом: сумма и количество pay > 0
+    по дате и смене (0-8, 8-16, 16-24 по времени register_date), плохие строки исключаются условием.
+    """
+    logger.debug(f'Считаем сменные отчеты')
     try:
         session = Session()
-        not_calc_ids, bad_senders = bad_ids()
-
         with session:
-            step1 = period_report('00:00', '07:59:59.999999', not_calc_ids)
-            results1 = session.execute(step1).all()
-
-            step2 = period_report('08:00', '15:59:59.999999', not_calc_ids)
-            results2 = session.execute(step2).all()
-
-            step3 = period_report('16:00', '23:59:59.999999', not_calc_ids)
-            results3 = session.execute(step3).all()
-
-            all_steps = period_report(sended_bad_ids=not_calc_ids)
-            results_all = session.execute(all_steps).all()
-
-            dates = select(func.cast(Incoming.register_date, Date)).order_by(func.cast(Incoming.register_date, Date).desc()).distinct()
-            dates_result = session.execute(dates).scalars().all()
-
-            str_not_calc_ids = [str(x) for x in sorted(not_calc_ids)]
-            str_not_calc_ids = ', '.join(str_not_calc_ids)
+            since = datetime.datetime.now(tz=tz).date() - datetime.timedelta(days=days - 1)
+            day = func.cast(Incoming.register_date, Date)
+            reg_time = func.cast(Incoming.register_date, Time)
+            shift = case(
+                (reg_time < datetime.time(8), 1),
+                (reg_time < datetime.time(16), 2),
+                else_=3,
+            )
+            bad = bad_incoming_predicate()
+            counted = and_(Incoming.pay > 0, ~bad)
+            # Группировка по именам колонок: выражения с параметрами в GROUP BY не совпадут с SELECT
+            report = select(
+                day.label('report_day'), shift.label('shift_num'),
+                func.sum(Incoming.pay).filter(counted),
+                func.count(Incoming.pay).filter(counted),
+            ).where(Incoming.register_date >= since).group_by('report_day', 'shift_num').order_by(desc('report_day'))
+            results = session.execute(report).all()
+
+            bad_rows = session.execute(
+                select(Incoming.id, Incoming.sender).where(Incoming.register_date >= since).where(bad).order_by(Incoming.id)
+            ).all()
+            bad_senders = sorted({row.sender for row in bad_rows})
+            logger1.info(f'Не учитываются sender: {len(bad_senders)} шт: {bad_senders}')
 
             rows = [
-
-                list(bad_senders),
+                bad_senders,
                 ['ID, которые пропускаются:'],
-                [str_not_calc_ids],
+                [', '.join(str(row.id) for row in bad_rows)],
                 ['-'],
-                [datetime.datetime.now(tz=tz).strftime('%d.%m.%Y  %H:%M:%S'),	'За день', 'Смена 1', 'Смена 2', 'Смена 3']
+                [datetime.datetime.now(tz=tz).strftime('%d.%m.%Y  %H:%M:%S'), 'За день', 'Смена 1', 'Смена 2', 'Смена 3']
             ]
-            for date in dates_result:
-                print(date)
-                row = [date.strftime('%d.%m.%Y'), '0 - 0', '0 - 0', '0 - 0', '0 - 0']
-                for num, step in enumerate([results_all, results1, results2, results3], 1):
-                    print('---', step)
-                    for step_day in step:
-                        if step_day[0] == date:
-                            day_text = f'{round(step_day[1], 2)} - {step_day[2]}'
-                            row[num] = day_text
+            # date: [сумма, количество] за день и по сменам
+            days_totals = {}
+            for date, shift_num, pay_sum, pay_count in results:
+                totals = days_totals.setdefault(date, [[0, 0] for _ in range(4)])
+                for num in (0, shift_num):
+                    totals[num][0] += pay_sum or 0
+                    totals[num][1] += pay_count
+            for date, totals in days_totals.items():
+                row = [date.strftime('%d.%m.%Y')]
+                for pay_sum, pay_count in totals:
+                    row.append(f'{round(pay_sum, 2)} - {pay_count}' if pay_count else '0 - 0')
                 rows.append(row)
 
             logger1.debug(f'Сменные отчеты: {rows}')
-            print(bad_senders)
             return rows
 
     except Exception as err:
@@ -297,10 +266,11 @@ def get_card_volume_rows(select_cards: list):  # ['4127*4297', '+994 51 927 05 6
     try:
         logger.debug(f'get_card_volume_rows. Карты: {select_cards}')
         session = Session()
-        cards = select(Incoming.recipient, func.sum(Incoming.pay), func.count(Incoming.pay), func.max(Incoming.response_date)).where(
-            Incoming.pay > 0).where(
-            Incoming.recipient.in_(select_cards)
-        ).group_by(Incoming.recipient)
+        # Объемы по дням из сводки CardDayVolume вместо подсчета по всем поступлениям
+        cards = select(CardDayVolume.recipient, func.sum(CardDayVolume.sum), func.sum(CardDayVolume.count),
+                       func.max(CardDayVolume.last_date)).where(
+            CardDayVolume.recipient.in_(select_cards)
+        ).group_by(CardDayVolume.recipient)
         results = session.execute(cards).fetchall()
         # [('4127*4297', 7926.64, 319), ('+994 51 927 05 68', 151542.00999999995, 1809), ('4127*6822', 41097.64, 1420)]
         logger.debug(f'card_volume: {results}')
@@ -313,7 +283,7 @@ def get_card_volume_rows(select_cards: list):  # ['4127*4297', '+994 51 927 05 6
                     row[1] = result[0]
                     row[2] = result[1]
                     row[3] = result[2]
-                    row[4] = result[3].strftime('%Y.%m.%d %H:%M')
+                    row[4] = result[3].strftime('%Y.%m.%d %H:%M') if result[3] else '-'
 
             rows.append(row)
         return rows
@@ -0,0 +1,58 @@
+import asyncio
+import time
+
+from config_data.bot_conf import get_my_loggers
+from database.redis_db import r
+from services.google_func import SheetWriter
+
+logger, err_log, logger1, logger2 = get_my_loggers()
+
+
+class TableExporter:
+    """
+    Дозапись новых строк базы в лист таблицы порциями.
+
+    Строки читаются порциями по chunk_size (id > последнего выгруженного), каждая порция -
+    один запрос batch_update. Отметка {name}_last_num в redis сдвигается только после
+    успешной записи порции, поэтому после сбоя порция перезаписывается в те же строки, без дублей.
+    Номер строки в листе: last_num + 2 - {name}_offset (как раньше).
+    """
+
+    def __init__(self, name: str, writer: SheetWriter, reader, to_row, sheets_num=0, chunk_size=1000):
+        self.name = name
+        self.writer = writer
+        self.reader = reader
+        self.to_row = to_row
+        self.sheets_num = sheets_num
+        self.chunk_size = chunk_size
+
+    def _get_int(self, key: str) -> int:
+        value = r.get(key)
+        return int(value.decode()) if value else 0
+
+    async def export_chunk(self) -> int:
+        """Выгружает одну порцию. Возвращает количество записанных строк"""
+        last_num = self._get_int(f'{self.name}_last_num')
+        offset = self._get_int(f'{self.name}_offset')
+        objects = self.reader(last_num, limit=self.chunk_size)
+        if objects is None:
+            raise RuntimeError(f'{self.name}: ошибка чтения базы после id {last_num}')
+        if not objects:
+            return 0
+        start = time.perf_counter()
+        rows = [self.to_row(obj) for obj in objects]
+        await self.writer.write(rows, start_row=last_num + 2 - offset, sheets_num=self.sheets_num)
+        r.set(f'{self.name}_last_num', objects[-1].id)
+        logger1.debug(f'{self.name}: добавлено {len(rows)} строк до id {objects[-1].id} '
+                      f'за {time.perf_counter() - start:.2f} c')
+        return len(rows)
+
+    async def export_new(self) -> int:
+        """Выгружает все новые строки порциями (догоняет отставание без одного большого запроса)"""
+        total = 0
+        while True:
+            count = await self.export_chunk()
+            total += count
+            if count < self.chunk_size:
+                return total
+            await asyncio.sleep(0)
@@ -25,20 +25,84 @@ def get_creds():
     return scoped
 
 
+class SheetWriter:
+    """
+    Одно авторизованное подключение к таблице на весь процесс.
+    Клиент обновляет токен сам (AsyncioGspreadClientManager), таблица и листы открываются один раз.
+    Запросы на запись разносятся не чаще min_interval секунд (квота Sheets API - 60 запросов в минуту).
+    """
+
+    def __init__(self, url=conf.tg_bot.TABLE_1, min_interval=1.1):
+        self.url = url
+        self.min_interval = min_interval
+        self.agcm = gspread_asyncio.AsyncioGspreadClientManager(get_creds)
+        self._sheet = None
+        self._worksheets = {}
+        self._last_request = 0
+        self._lock = asyncio.Lock()
+
+    async def worksheet(self, sheets_num=0):
+        agc = await self.agcm.authorize()
+        if self._sheet is None:
+            logger1.debug(f'Открываем таблицу {self.url}')
+            self._sheet = await agc.open_by_url(self.url)
+        if sheets_num not in self._worksheets:
+            self._worksheets[sheets_num] = await self._sheet.get_worksheet(sheets_num)
+        return self._worksheets[sheets_num]
+
+    def reset(self):
+        """Сброс открытых листов (после ошибки API откроются заново)"""
+        self._sheet = None
+        self._worksheets = {}
+
+    async def _throttle(self):
+        delay = self._last_request + self.min_interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self._last_request = time.monotonic()
+
+    async def read(self, sheets_num=0, diap='А:А'):
+        logger1.debug(f'Читаем таблицу {self.url}, лист {sheets_num}, диапазон: {diap}')
+        async with self._lock:
+            await self._throttle()
+            table = await self.worksheet(sheets_num)
+            return await table.get_values(diap)
+
+    async def write(self, rows: list[list], start_row=1, sheets_num=0, delta_col=0):
+        if not rows:
+            return
+        num_rows = len(rows)
+        num_col = max(len(row) for row in rows)
+        diap = f'{rowcol_to_a1(start_row, 1 + delta_col)}:{rowcol_to_a1(start_row + num_rows, num_col + delta_col)}'
+        logger.debug(f'Добавляем {num_rows} строк в {diap}')
+        async with self._lock:
+            await self._throttle()
+            table = await self.worksheet(sheets_num)
+            try:
+                await table.batch_update([{'range': diap, 'values': rows}])
+            except Exception:
+                self.reset()
+                raise
+        return True
+
+
+_writers: dict[str, SheetWriter] = {}
+
+
+def get_writer(url=conf.tg_bot.TABLE_1) -> SheetWriter:
+    """Общий SheetWriter для таблицы"""
+    if url not in _writers:
+        _writers[url] = SheetWriter(url)
+    return _writers[url]
+
+
 async def load_range_values(url=conf.tg_bot.TABLE_1, sheets_num=0, diap='А:А'):
-    logger1.debug(f'Читаем таблицу {url}, лист {sheets_num}, диапазон: {diap}')
-    agcm = gspread_asyncio.AsyncioGspreadClientManager(get_creds)
-    agc = await agcm.authorize()
-    sheet = await agc.open_by_url(url)
-    table = await sheet.get_worksheet(sheets_num)
-    values = await table.get_values(diap)
-    print(values)
-    return values
+    return await get_writer(url).read(sheets_num=sheets_num, diap=diap)
 
 
 async def write_to_table(rows: list[list], start_row=1, url=conf.tg_bot.TABLE_1, sheets_num=0, delta_col=0):
     """
-    Функция отправки анкеты CSI через бота
+    Запись строк в таблицу
     :param rows: список строк для вставки
     :param start_row: Номер первой строки
     :param url: адрес таблицы
@@ -46,25 +110,7 @@ async def write_to_table(rows: list[list], start_row=1, url=conf.tg_bot.TABLE_1,
     :param delta_col: смещение по столбцам
     :return:
     """
-    if not rows:
-        return
-    logger.debug(f'Добавляем c {start_row}: {rows}')
-    agcm = gspread_asyncio.AsyncioGspreadClientManager(get_creds)
-    agc = await agcm.authorize()
-    sheet = await agc.open_by_url(url)
-    table = await sheet.get_worksheet(sheets_num)
-    # await table.append_rows(rows)
-    num_rows = len(rows)
-    num_col = len(rows[0])
-    logger.debug(f'{rowcol_to_a1(start_row, 1 + delta_col)}:{rowcol_to_a1(start_row + num_rows, num_col + delta_col)}')
-    x = await table.batch_update([{
-        'range': f'{rowcol_to_a1(start_row, 1 + delta_col)}:{rowcol_to_a1(start_row + num_rows, num_col + delta_col)}',
-        'values': rows,
-    }])
-    print('x', x)
-    return True
-
-
+    return await get_writer(url).write(rows, start_row=start_row, sheets_num=sheets_num, delta_col=delta_col)
 
 
 if __name__ == '__main__':